@@ -1,431 +1,1635 @@
 import streamlit as st
-import mysql.connector
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from mysql.connector import Error
+from mysql.connector.errors import IntegrityError, InterfaceError, OperationalError, PoolError
 from dotenv import load_dotenv
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from cachetools import TTLCache
+import functools
+from collections import deque
+import ipaddress
+import logging
+import multiprocessing
 import os
-import bcrypt
-from datetime import date, timedelta
-from init_db import create_database  # Add this line
+import random
+import re
+import sys
+import time
+import threading
+import auth
+import storage
+from datetime import date, datetime, timedelta
+from recommend import fetch_recommendations, recommend_with_sql, refresh_user_recommendations
+from overdue import DEFAULT_DAILY_FINE, DEFAULT_LOAN_DAYS, loan_due_date
+import branches
+import holds
+import items
 
 load_dotenv()
 
-# Database connection
-def create_connection():
+logger = logging.getLogger('library')
+
+# Threads that outlive the session that started them (the event log worker)
+# run without a script run context, and st.cache_resource builds a fresh
+# value on every call from such a thread. They get the resources they use
+# bound once, from a session, through bind_resources().
+thread_resources = threading.local()
+
+def thread_bound(func):
+    @functools.wraps(func)
+    def wrapper():
+        bound = getattr(thread_resources, 'values', None)
+        return bound[func.__name__] if bound is not None else func()
+    return wrapper
+
+def bind_resources(*getters):
+    # Resolves the getters in the calling session; a thread passes the result
+    # to use_resources() before touching them
+    return {getter.__name__: getter() for getter in getters}
+
+def use_resources(resources):
+    thread_resources.values = resources
+
+# Database connection pool, shared by every session of the Streamlit process
+@thread_bound
+@st.cache_resource
+def get_connection_pool():
+    return storage.create_pool(int(os.getenv('DB_POOL_SIZE', 10)))
+
+def new_pool_state():
+    return {
+        'lock': threading.Lock(),
+        'stats': {'acquired': 0, 'waits': 0, 'timeouts': 0, 'recycled': 0,
+                  'total_wait': 0.0, 'max_wait': 0.0},
+    }
+
+@thread_bound
+@st.cache_resource
+def get_pool_state():
+    return new_pool_state()
+
+def acquire_connection(pool=None, timeout=None, state=None):
+    # state holds the counters for the pool, the primary's by default
+    pool = pool or get_connection_pool()
+    state = state or get_pool_state()
+    timeout = float(os.getenv('DB_POOL_TIMEOUT', 5)) if timeout is None else timeout
+    max_lifetime = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))
+    start = time.monotonic()
+    # The pool does not block when exhausted, so poll until the borrow timeout
+    while True:
+        try:
+            # get_connection() pings idle connections and reconnects dead ones
+            conn = pool.get_connection()
+            break
+        except PoolError:
+            if time.monotonic() - start >= timeout:
+                with state['lock']:
+                    state['stats']['timeouts'] += 1
+                raise
+            time.sleep(0.01)
+    waited = time.monotonic() - start
+
+    # The open time lives on the connection, so it follows reconnects and
+    # goes away with the connection
+    recycle = time.monotonic() - storage.opened_at(conn) > max_lifetime
+    with state['lock']:
+        if recycle:
+            state['stats']['recycled'] += 1
+        stats = state['stats']
+        stats['acquired'] += 1
+        stats['total_wait'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+        if waited > 0.01:
+            stats['waits'] += 1
+    if recycle:
+        conn.reconnect()
+        # Stamp the new connection now rather than at its next checkout
+        storage.opened_at(conn)
+    return conn
+
+def get_pool_stats():
+    state = get_pool_state()
+    with state['lock']:
+        return dict(state['stats'])
+
+# Read replicas (DB_REPLICAS). Reads that can live with slightly old data
+# pass replica=True to get_cursor() and go to a replica that has caught up
+# far enough; every other read and every write stays on the primary. Lag is
+# measured with the replication_heartbeat row, which a monitor thread
+# rewrites on the primary with the current time and reads back from each
+# replica: a replica's copy says up to when it has applied the primary's
+# writes. App hosts' clocks are assumed to be in sync.
+REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 1))
+REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 10))
+
+@st.cache_resource
+def get_replica_state():
+    state = {
+        'lock': threading.Lock(),
+        'heartbeat_error': None,
+        'replicas': {replica: {'pool': None, 'beat_at': None, 'error': None} for replica in storage.REPLICAS},
+        # Fallbacks found no replica caught up; spills found every connection
+        # of the chosen replica busy. Both go to the primary.
+        'stats': {'replica_reads': 0, 'fallbacks': 0, 'spills': 0},
+        # Counters of the replica pools, kept apart from the primary's
+        'pool': new_pool_state(),
+    }
+    if storage.REPLICAS:
+        threading.Thread(target=monitor_replicas, args=(state,), name='replica-monitor', daemon=True).start()
+    return state
+
+def read_heartbeat(connection):
+    # The replica's copy of the heartbeat, or None if it has no row yet
+    cursor = connection.cursor()
+    cursor.execute("SELECT beat_at FROM replication_heartbeat WHERE id = 1")
+    row = cursor.fetchone()
+    # End the read so the next one sees rows replicated since
+    connection.rollback()
+    return row[0] if row else None
+
+def check_replicas(state, connections, pool_size):
     try:
-        connection = mysql.connector.connect(
-            host=os.getenv('DB_HOST'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD'),
-            database='library_management'
-        )
-        return connection
+        if 'primary' not in connections:
+            connections['primary'] = storage.connect('library_management')
+        cursor = connections['primary'].cursor()
+        cursor.execute("UPDATE replication_heartbeat SET beat_at = %s WHERE id = 1", (time.time(),))
+        if cursor.rowcount == 0:
+            # Seeded by migration 11; put back if it went missing
+            cursor.execute(storage.insert_ignore("INSERT INTO replication_heartbeat (id, beat_at) VALUES (1, %s)"),
+                           (time.time(),))
+        connections['primary'].commit()
+        heartbeat_error = None
     except Error as e:
-        st.error(f"Error connecting to MySQL: {e}")
-        return None
+        connections.pop('primary', None)
+        heartbeat_error = str(e)
+    with state['lock']:
+        state['heartbeat_error'] = heartbeat_error
+    for replica, info in state['replicas'].items():
+        pool, beat_at, error = info['pool'], None, None
+        try:
+            if replica not in connections:
+                connections[replica] = storage.connect('library_management', replica)
+            beat_at = read_heartbeat(connections[replica])
+            if beat_at is None:
+                error = "no heartbeat row replicated yet"
+            # Replicas that were down at startup get their pool once reachable
+            pool = pool or storage.create_pool(pool_size, replica)
+        except Error as e:
+            connections.pop(replica, None)
+            beat_at, error = None, str(e)
+        with state['lock']:
+            info.update(pool=pool, beat_at=beat_at, error=error)
+
+def monitor_replicas(state):
+    pool_size = int(os.getenv('DB_REPLICA_POOL_SIZE', os.getenv('DB_POOL_SIZE', 10)))
+    connections = {}
+    while True:
+        try:
+            check_replicas(state, connections, pool_size)
+        except Exception:
+            # Keep monitoring: a dead thread would leave every replica at its
+            # last known lag, or unused, with nothing to show why
+            logger.exception("Replica check failed")
+            for connection in connections.values():
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            connections.clear()
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+def note_write():
+    # The session's reads from now on must see what it just wrote; the event
+    # log worker has no session
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.session_state.last_write_at = time.time()
+
+def read_floor(name):
+    # A replica read has to see every write made before this time: the
+    # session's own last write, the last catalog write, and the last
+    # invalidation of the shared cache the read may be refilling
+    floor = max(get_data_version_state()['bumped_at'], get_query_cache_state()['invalidated_at'].get(name, 0))
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        floor = max(floor, st.session_state.get('last_write_at', 0))
+    return floor
+
+def acquire_replica_connection(name):
+    # Returns a connection to a replica that has caught up, or None for the
+    # primary to serve the read
+    state = get_replica_state()
+    floor = read_floor(name)
+    now = time.time()
+    with state['lock']:
+        pools = [info['pool'] for info in state['replicas'].values()
+                 if info['pool'] is not None and info['beat_at'] is not None
+                 and info['beat_at'] >= floor and now - info['beat_at'] <= REPLICA_MAX_LAG]
+    conn = None
+    outcome = 'fallbacks'
+    if pools:
+        try:
+            # A busy replica pool spills the read over to the primary
+            # rather than making it wait
+            conn = acquire_connection(random.choice(pools), timeout=0, state=state['pool'])
+            outcome = 'replica_reads'
+        except Error:
+            outcome = 'spills'
+    with state['lock']:
+        state['stats'][outcome] += 1
+    return conn
+
+def get_replica_status():
+    state = get_replica_state()
+    now = time.time()
+    with state['lock']:
+        status = {
+            'heartbeat_error': state['heartbeat_error'],
+            'replicas': {replica: {'lag_s': round(now - info['beat_at'], 1) if info['beat_at'] is not None else None,
+                                   'error': info['error']}
+                         for replica, info in state['replicas'].items()},
+            **state['stats'],
+        }
+    with state['pool']['lock']:
+        status['pool'] = dict(state['pool']['stats'])
+    return status
+
+# Query instrumentation. Every get_cursor() block is timed and attributed to
+# the data function that opened it.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LATENCY_SAMPLES = 1000
+
+@thread_bound
+@st.cache_resource
+def get_query_metrics_state():
+    return {'lock': threading.Lock(), 'functions': {}}
+
+def record_query(name, elapsed, acquire_time, rows, failed):
+    state = get_query_metrics_state()
+    with state['lock']:
+        metrics = state['functions'].get(name)
+        if metrics is None:
+            metrics = state['functions'][name] = {
+                'calls': 0, 'errors': 0, 'rows': 0, 'total_time': 0.0, 'acquire_time': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                'samples': deque(maxlen=LATENCY_SAMPLES),
+            }
+        metrics['calls'] += 1
+        metrics['errors'] += failed
+        metrics['rows'] += rows
+        metrics['total_time'] += elapsed
+        metrics['acquire_time'] += acquire_time
+        metrics['buckets'][sum(elapsed > bound for bound in LATENCY_BUCKETS)] += 1
+        metrics['samples'].append(elapsed)
+    if elapsed * 1000 >= float(os.getenv('SLOW_QUERY_MS', 500)):
+        logger.warning("Slow query in %s: %.0f ms, %d rows, %.0f ms waiting for a connection",
+                       name, elapsed * 1000, rows, acquire_time * 1000)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def get_query_metrics():
+    state = get_query_metrics_state()
+    with state['lock']:
+        functions = {name: dict(m, samples=sorted(m['samples'])) for name, m in state['functions'].items()}
+    report = []
+    for name, m in sorted(functions.items()):
+        report.append({
+            'function': name,
+            'calls': m['calls'],
+            'errors': m['errors'],
+            'rows': m['rows'],
+            'mean_ms': m['total_time'] / m['calls'] * 1000,
+            'p50_ms': percentile(m['samples'], 0.50) * 1000,
+            'p95_ms': percentile(m['samples'], 0.95) * 1000,
+            'p99_ms': percentile(m['samples'], 0.99) * 1000,
+            'acquire_ms': m['acquire_time'] / m['calls'] * 1000,
+        })
+    return report
+
+def get_prometheus_metrics():
+    state = get_query_metrics_state()
+    with state['lock']:
+        functions = {name: dict(m, buckets=list(m['buckets'])) for name, m in state['functions'].items()}
+    lines = [
+        "# HELP library_query_duration_seconds Wall time of data-layer calls",
+        "# TYPE library_query_duration_seconds histogram",
+    ]
+    for name, m in sorted(functions.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), m['buckets']):
+            cumulative += count
+            lines.append(f'library_query_duration_seconds_bucket{{function="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'library_query_duration_seconds_sum{{function="{name}"}} {m["total_time"]}')
+        lines.append(f'library_query_duration_seconds_count{{function="{name}"}} {m["calls"]}')
+    for metric, key, help_text in (
+        ('library_query_rows_total', 'rows', "Rows returned or affected by data-layer calls"),
+        ('library_query_errors_total', 'errors', "Data-layer calls that raised an error"),
+        ('library_connection_acquire_seconds_total', 'acquire_time', "Time spent waiting for a pooled connection"),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, m in sorted(functions.items()):
+            lines.append(f'{metric}{{function="{name}"}} {m[key]}')
+    return "\n".join(lines) + "\n"
+
+# Single path for database access: borrows a pooled connection, commits on
+# success, rolls back on error and always hands the connection back.
+@contextmanager
+def get_cursor(dictionary=False, isolation_level=None, name=None, replica=False):
+    # Attribute the block to the function that opened it
+    name = name or sys._getframe(2).f_code.co_name
+    start = time.perf_counter()
+    conn = acquire_replica_connection(name) if replica and storage.REPLICAS else None
+    if conn is None:
+        conn = acquire_connection()
+    acquired = time.perf_counter()
+    cursor = None
+    failed = False
+    try:
+        if isolation_level:
+            conn.start_transaction(isolation_level=isolation_level)
+        cursor = conn.cursor(dictionary=dictionary)
+        yield cursor
+        conn.commit()
+    except Exception:
+        failed = True
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        rows = max(cursor.rowcount, 0) if cursor is not None else 0
+        record_query(name, time.perf_counter() - acquired, acquired - start, rows, failed)
+
+# MySQL deadlock and lock wait timeout errors (a busy SQLite database is
+# reported as the latter). get_cursor() rolls the whole
+# transaction back on either, so the work can safely be run again.
+RETRYABLE_ERRORS = {1213, 1205}
+TRANSACTION_RETRIES = 3
+
+def run_transaction(work, *args):
+    for attempt in range(TRANSACTION_RETRIES + 1):
+        try:
+            with get_cursor(isolation_level='READ COMMITTED', name=work.__name__) as cursor:
+                return work(cursor, *args)
+        except Error as e:
+            if e.errno not in RETRYABLE_ERRORS or attempt == TRANSACTION_RETRIES:
+                raise
+            # Exponential backoff with jitter so competing sessions spread out
+            time.sleep(0.05 * 2 ** attempt * (1 + random.random()))
+
+# Concurrent fetching for pages made of independent sections. Each call runs
+# on its own pooled connection, so a page waits for its slowest query rather
+# than the sum of all of them.
+@st.cache_resource
+def get_query_executor():
+    return ThreadPoolExecutor(max_workers=int(os.getenv('QUERY_WORKERS', 8)), thread_name_prefix='library-query')
+
+def fetch_concurrently(calls):
+    # calls maps a section name to (function, *args); yields (name, result)
+    # in completion order so each section can be drawn as soon as it is ready
+    if os.getenv('CONCURRENT_QUERIES', '1') == '0':
+        for name, (func, *args) in calls.items():
+            yield name, func(*args)
+        return
+
+    ctx = get_script_run_ctx()
+
+    def run(func, *args):
+        # Attach the session so st.error() from a failing data function still
+        # reaches the page
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    try:
+        futures = {get_query_executor().submit(run, func, *args): name
+                   for name, (func, *args) in calls.items()}
+    except RuntimeError:
+        # The executor is shutting down; fall back to fetching in sequence
+        for name, (func, *args) in calls.items():
+            yield name, func(*args)
+        return
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+# Shared query-result cache for dashboard reads. Each cached function gets
+# its own TTL cache; write functions invalidate the reads they affect.
+@thread_bound
+@st.cache_resource
+def get_query_cache_state():
+    return {'lock': threading.Lock(), 'caches': {}, 'stats': {}, 'generations': {}, 'invalidated_at': {}}
+
+def cached_query(ttl, error_message, default=list):
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            state = get_query_cache_state()
+            with state['lock']:
+                if name not in state['caches']:
+                    state['caches'][name] = TTLCache(maxsize=int(os.getenv('QUERY_CACHE_SIZE', 128)), ttl=ttl)
+                    state['stats'][name] = {'hits': 0, 'misses': 0}
+                    state['generations'][name] = 0
+                cache = state['caches'][name]
+                if args in cache:
+                    state['stats'][name]['hits'] += 1
+                    return cache[args]
+                state['stats'][name]['misses'] += 1
+                generation = state['generations'][name]
+            try:
+                result = func(*args)
+            except Error as e:
+                # Errors are reported but never cached
+                st.error(f"{error_message}: {e}")
+                return default()
+            with state['lock']:
+                # Skip the store if the cache was invalidated while querying
+                if state['generations'][name] == generation:
+                    cache[args] = result
+            return result
+
+        def cache_clear():
+            state = get_query_cache_state()
+            with state['lock']:
+                if name in state['caches']:
+                    state['caches'][name].clear()
+                    state['generations'][name] += 1
+                state['invalidated_at'][name] = time.time()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+def invalidate_queries(*queries):
+    for query in queries:
+        query.cache_clear()
+    note_write()
+
+def get_query_cache_stats():
+    state = get_query_cache_state()
+    with state['lock']:
+        return {name: dict(stats, size=len(state['caches'][name]))
+                for name, stats in state['stats'].items()}
+
+# Per-session cache for the logged-in user's own data (open loans,
+# recommendations, recent searches), kept in st.session_state. It is cleared
+# after the user's own writes, and every session drops it when a catalog
+# write bumps the shared data version. Empty results are cached like any
+# other; a load that failed is not, so it is simply retried on the next rerun.
+SESSION_CACHE_SIZE = 32
+# Marks a key with no cached result, since None and [] are valid results
+MISSING = object()
+
+@st.cache_resource
+def get_data_version_state():
+    return {'lock': threading.Lock(), 'version': 0, 'bumped_at': 0}
+
+def get_data_version():
+    state = get_data_version_state()
+    with state['lock']:
+        return state['version']
+
+def bump_data_version():
+    state = get_data_version_state()
+    with state['lock']:
+        state['version'] += 1
+        state['bumped_at'] = time.time()
+    note_write()
+
+def session_cached(loader, *args):
+    version = get_data_version()
+    cache = st.session_state.get('data_cache')
+    if cache is None or cache['version'] != version:
+        avoided = cache['avoided_queries'] if cache else 0
+        cache = {'version': version, 'entries': {}, 'avoided_queries': avoided}
+        st.session_state.data_cache = cache
+    key = (loader.__name__, args)
+    result = cache['entries'].get(key, MISSING)
+    if result is not MISSING:
+        cache['avoided_queries'] += 1
+        return result
+    failures = st.session_state.get('load_failures', 0)
+    result = loader(*args)
+    if st.session_state.get('load_failures', 0) == failures:
+        if len(cache['entries']) >= SESSION_CACHE_SIZE:
+            del cache['entries'][next(iter(cache['entries']))]
+        cache['entries'][key] = result
+    return result
+
+def load_failed(message):
+    # For loaders used with session_cached(): the error is shown as usual and
+    # counted, so the fallback result is not cached
+    st.error(message)
+    st.session_state.load_failures = st.session_state.get('load_failures', 0) + 1
+
+def invalidate_session_cache():
+    if 'data_cache' in st.session_state:
+        st.session_state.data_cache['entries'].clear()
+    note_write()
+
+def get_session_cache_stats():
+    cache = st.session_state.get('data_cache')
+    if cache is None:
+        return {'entries': 0, 'avoided_queries': 0}
+    return {'entries': len(cache['entries']), 'avoided_queries': cache['avoided_queries']}
+
+# Password hashing. bcrypt is CPU bound, so it runs in a small pool of worker
+# processes instead of the session's script thread.
+@st.cache_resource
+def get_hashing_pool():
+    return ProcessPoolExecutor(max_workers=int(os.getenv('BCRYPT_WORKERS', 2)),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+def run_hashing(func, *args):
+    try:
+        return get_hashing_pool().submit(func, *args).result()
+    except BrokenProcessPool:
+        # A crashed worker breaks the pool; start a fresh one next time
+        get_hashing_pool.clear()
+        return func(*args)
+
+def bcrypt_rounds():
+    return int(os.getenv('BCRYPT_ROUNDS', 12))
 
 # Helper functions
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return run_hashing(auth.hash_password, password, bcrypt_rounds())
 
 def verify_password(plain_password, hashed_password):
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+    return run_hashing(auth.verify_password, plain_password, hashed_password)
+
+# Login throttling: failed attempts per username and per client address
+# within a sliding window. Throttled attempts are refused before hashing.
+@st.cache_resource
+def get_login_attempts():
+    return {'lock': threading.Lock(), 'failures': {}}
+
+def client_connection():
+    # The peer address and request headers of the session's browser
+    # connection, or (None, {}) outside a Streamlit server
+    context = getattr(st, 'context', None)
+    if context is not None and hasattr(context, 'ip_address'):
+        return context.ip_address, context.headers
+    # Older Streamlit releases expose neither publicly: read them off the
+    # session's websocket request. Imported here: it pulls in the Tornado web
+    # server, which only the login path needs and which would otherwise slow
+    # every cold import of the app.
+    from streamlit import runtime
+    from streamlit.web.server.browser_websocket_handler import BrowserWebSocketHandler
+
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None or not runtime.exists():
+        return None, {}
+    client = runtime.get_instance().get_client(ctx.session_id)
+    if not isinstance(client, BrowserWebSocketHandler):
+        return None, {}
+    return client.request.remote_ip, client.request.headers
+
+def trusted_proxies():
+    return [ipaddress.ip_network(proxy.strip(), strict=False)
+            for proxy in os.getenv('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+
+def is_trusted_proxy(address, proxies):
+    try:
+        return any(ipaddress.ip_address(address) in proxy for proxy in proxies)
+    except ValueError:
+        return False
+
+def login_client_address():
+    # Anyone can send X-Forwarded-For, so it is only believed on connections
+    # from a trusted proxy. The client is then the last address in it that is
+    # not one of the proxies themselves.
+    proxies = trusted_proxies()
+    if not proxies:
+        return None
+    peer, headers = client_connection()
+    if peer is None or not is_trusted_proxy(peer, proxies):
+        return None
+    for address in reversed((headers.get('X-Forwarded-For') or '').split(',')):
+        address = address.strip()
+        if address and not is_trusted_proxy(address, proxies):
+            return address
+    return None
+
+def login_throttle_keys(username):
+    # Without a trusted proxy in front, attempts are counted per username only
+    keys = [('user', username.lower())]
+    client = login_client_address()
+    if client:
+        keys.append(('ip', client))
+    return keys
+
+def is_login_throttled(keys):
+    attempts = get_login_attempts()
+    window_start = time.monotonic() - float(os.getenv('LOGIN_WINDOW_SECONDS', 300))
+    max_failures = int(os.getenv('LOGIN_MAX_FAILURES', 5))
+    with attempts['lock']:
+        for key in keys:
+            failures = attempts['failures'].get(key)
+            while failures and failures[0] < window_start:
+                failures.popleft()
+            if failures is not None and not failures:
+                del attempts['failures'][key]
+            elif failures and len(failures) >= max_failures:
+                return True
+    return False
+
+def record_login_failure(keys):
+    attempts = get_login_attempts()
+    with attempts['lock']:
+        for key in keys:
+            attempts['failures'].setdefault(key, deque()).append(time.monotonic())
+
+def clear_login_failures(username):
+    attempts = get_login_attempts()
+    with attempts['lock']:
+        attempts['failures'].pop(('user', username.lower()), None)
 
 def authenticate_user(username, password):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
+    keys = login_throttle_keys(username)
+    if is_login_throttled(keys):
+        st.error("Too many failed login attempts. Please try again later.")
+        return None
+    try:
+        with get_cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT user_id, username, email, password, is_admin FROM users WHERE username = %s",
+                           (username,))
             user = cursor.fetchone()
-            if user and verify_password(password, user['password']):
-                return user
-        except Error as e:
-            st.error(f"Authentication error: {e}")
-        finally:
-            conn.close()
+        # Hash outside the cursor block so no connection is held while hashing
+        if user and verify_password(password, user['password']):
+            if auth.hash_rounds(user['password']) != bcrypt_rounds():
+                # The configured cost changed: upgrade the stored hash transparently
+                new_hash = hash_password(password)
+                with get_cursor() as cursor:
+                    cursor.execute("UPDATE users SET password = %s WHERE user_id = %s",
+                                   (new_hash, user['user_id']))
+            clear_login_failures(username)
+            del user['password']
+            return user
+        record_login_failure(keys)
+    except Error as e:
+        st.error(f"Authentication error: {e}")
     return None
 
 def create_user(username, email, password):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            hashed_password = hash_password(password)
+    try:
+        hashed_password = hash_password(password)
+        with get_cursor() as cursor:
             cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
                            (username, email, hashed_password))
-            conn.commit()
-            st.success("User created successfully!")
-        except Error as e:
-            st.error(f"Error creating user: {e}")
-        finally:
-            conn.close()
+        invalidate_queries(get_book_stats)
+        st.success("User created successfully!")
+    except Error as e:
+        st.error(f"Error creating user: {e}")
 
-def get_book_stats():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
+# Catalog aggregates take an optional branch_id and then read only that
+# branch's slice of branch_stock, whose primary key leads with branch_id
+@cached_query(ttl=60, error_message="Error fetching stats", default=lambda: (None, None))
+def get_book_stats(branch_id=None):
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        if branch_id is None:
             cursor.execute("SELECT COUNT(*) as total_books, SUM(quantity) as total_quantity FROM books")
-            book_stats = cursor.fetchone()
-            cursor.execute("SELECT COUNT(*) as total_users FROM users")
-            user_stats = cursor.fetchone()
-            return book_stats, user_stats
-        except Error as e:
-            st.error(f"Error fetching stats: {e}")
-        finally:
-            conn.close()
-    return None, None
-
-def get_books_by_category():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
+        else:
+            cursor.execute("""
+                SELECT COUNT(*) as total_books, SUM(quantity) as total_quantity
+                FROM branch_stock
+                WHERE branch_id = %s AND quantity > 0
+            """, (branch_id,))
+        book_stats = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) as total_users FROM users")
+        user_stats = cursor.fetchone()
+        return book_stats, user_stats
+
+@cached_query(ttl=300, error_message="Error fetching books by category")
+def get_books_by_category(branch_id=None):
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        if branch_id is None:
             cursor.execute("""
                 SELECT c.name as category, COUNT(*) as book_count
                 FROM books b
                 JOIN categories c ON b.category_id = c.category_id
                 GROUP BY c.category_id
             """)
-            return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching books by category: {e}")
-        finally:
-            conn.close()
-    return []
+        else:
+            cursor.execute("""
+                SELECT c.name as category, COUNT(*) as book_count
+                FROM branch_stock s
+                JOIN books b ON b.book_id = s.book_id
+                JOIN categories c ON b.category_id = c.category_id
+                WHERE s.branch_id = %s AND s.quantity > 0
+                GROUP BY c.category_id
+            """, (branch_id,))
+        return cursor.fetchall()
 
+@cached_query(ttl=300, error_message="Error fetching branches")
+def get_branches():
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        cursor.execute("SELECT branch_id, name FROM branches ORDER BY branch_id")
+        return cursor.fetchall()
+
+# Each branch's totals come from its own slice of branch_stock; the library
+# total is their sum
+@cached_query(ttl=60, error_message="Error fetching branch stock")
+def get_branch_stats():
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        cursor.execute("""
+            SELECT br.branch_id, br.name as branch, COUNT(s.book_id) as titles,
+                   COALESCE(SUM(s.quantity), 0) as copies, COALESCE(SUM(s.available_quantity), 0) as available
+            FROM branches br
+            LEFT JOIN branch_stock s ON s.branch_id = br.branch_id AND s.quantity > 0
+            GROUP BY br.branch_id, br.name
+            ORDER BY br.branch_id
+        """)
+        return cursor.fetchall()
+
+@cached_query(ttl=30, error_message="Error fetching top rated books")
 def get_top_rated_books_with_availability():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT b.book_id, b.title, b.cover_image, b.available_quantity, 
-                       COALESCE(AVG(r.rating), 0) as avg_rating
-                FROM books b
-                LEFT JOIN reviews r ON b.book_id = r.book_id
-                GROUP BY b.book_id
-                ORDER BY avg_rating DESC, b.title
-                LIMIT 5
-            """)
-            return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching top rated books: {e}")
-        finally:
-            conn.close()
-    return []
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        cursor.execute("""
+            SELECT b.book_id, b.title, b.cover_image, b.available_quantity, s.avg_rating
+            FROM book_stats s
+            JOIN books b ON b.book_id = s.book_id
+            ORDER BY s.avg_rating DESC, s.book_id DESC
+            LIMIT 5
+        """)
+        return cursor.fetchall()
 
 def get_borrowed_books(user_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
+    try:
+        with get_cursor(dictionary=True) as cursor:
             cursor.execute("""
-                SELECT b.title, l.loan_date, l.return_date, b.book_id
+                SELECT b.title, l.loan_date, l.due_date, l.return_date, b.book_id
                 FROM loans l
                 JOIN books b ON l.book_id = b.book_id
                 WHERE l.user_id = %s AND l.return_date IS NULL
             """, (user_id,))
             return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching borrowed books: {e}")
-        finally:
-            conn.close()
+    except Error as e:
+        load_failed(f"Error fetching borrowed books: {e}")
     return []
 
-def get_available_books():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
+AVAILABLE_PAGE_SIZES = [10, 20, 50]
+
+# Pass the last row of the previous page as `after` to fetch the next page.
+# With a branch_id only copies on that branch's shelves count.
+def get_available_books(category_id=None, genre=None, author_prefix=None, branch_id=None, after=None, limit=20):
+    source = "books b"
+    available = "b.available_quantity"
+    conditions = []
+    params = []
+    if branch_id is not None:
+        source = "branch_stock s JOIN books b ON b.book_id = s.book_id"
+        available = "s.available_quantity"
+        conditions.append("s.branch_id = %s")
+        params.append(branch_id)
+    conditions.append(f"{available} > 0")
+    if category_id is not None:
+        conditions.append("b.category_id = %s")
+        params.append(category_id)
+    if genre:
+        conditions.append("b.genre = %s")
+        params.append(genre)
+    if author_prefix:
+        conditions.append("b.author LIKE %s ESCAPE '!'")
+        params.append(f"{escape_like(author_prefix)}%")
+    if after:
+        conditions.append("(b.title > %s OR (b.title = %s AND b.book_id > %s))")
+        params += [after['title'], after['title'], after['book_id']]
+    try:
+        with get_cursor(dictionary=True, replica=True) as cursor:
+            cursor.execute(f"""
+                SELECT b.book_id, b.title, b.author, {available} as available_quantity
+                FROM {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY b.title, b.book_id
+                LIMIT %s
+            """, (*params, limit))
+            return cursor.fetchall()
+    except Error as e:
+        st.error(f"Error fetching available books: {e}")
+    return []
+
+def checkout(cursor, user_id, book_id, item_id=None, branch_id=None):
+    # A copy held for the user is already theirs. Otherwise the book row lock
+    # serializes borrowers of the title and only a copy still on the shelf is
+    # lent, so concurrent borrows can never oversell. item_id is the copy
+    # scanned at the desk; online borrowing takes any copy, or any at the
+    # user's branch.
+    held = holds.claim_hold(cursor, user_id, book_id, item_id)
+    if held is not None:
+        item_id = held
+    else:
+        holds.lock_book(cursor, book_id)
+        item_id = items.take_copy(cursor, book_id, item_id, branch_id)
+        if item_id is None:
+            return False
+        holds.drop_waiting_hold(cursor, user_id, book_id)
+    loan_date = date.today()
+    cursor.execute("INSERT INTO loans (user_id, book_id, item_id, loan_date, due_date) VALUES (%s, %s, %s, %s, %s)",
+                   (user_id, book_id, item_id, loan_date, loan_due_date(cursor, book_id, loan_date)))
+    cursor.execute("""
+        UPDATE book_stats
+        SET loan_count = loan_count + 1, active_loans = active_loans + 1
+        WHERE book_id = %s
+    """, (book_id,))
+    refresh_user_recommendations(cursor, user_id, book_id)
+    return True
+
+def close_loan(cursor, loan_id, book_id, item_id, return_date=None, branch_id=None):
+    # Take the book row lock first, as checkout does, so a return racing a
+    # borrow of the same title waits instead of deadlocking on loans
+    holds.lock_book(cursor, book_id)
+    # Only give the copy back if the loan was still open
+    cursor.execute("UPDATE loans SET return_date = %s WHERE id = %s AND return_date IS NULL",
+                   (return_date or date.today(), loan_id))
+    if cursor.rowcount == 0:
+        return False
+    if branch_id is not None:
+        # Returned at another branch's desk: the copy stays there
+        items.move_copy(cursor, book_id, item_id, branch_id)
+    # Drop the returned loan from the overdue snapshot without waiting for
+    # the next overdue.py run
+    cursor.execute("DELETE FROM overdue_loans WHERE loan_id = %s", (loan_id,))
+    cursor.execute("UPDATE book_stats SET active_loans = active_loans - 1 WHERE book_id = %s", (book_id,))
+    # The copy goes to the next hold in line, or back on the shelf
+    holds.release_copy(cursor, book_id, item_id)
+    return True
+
+def checkin(cursor, user_id, book_id, return_date=None):
+    # Close exactly one open loan of the title, the oldest
+    cursor.execute("""
+        SELECT id, item_id FROM loans
+        WHERE user_id = %s AND book_id = %s AND return_date IS NULL
+        ORDER BY loan_date, id
+        LIMIT 1
+    """, (user_id, book_id))
+    row = cursor.fetchone()
+    return row is not None and close_loan(cursor, row[0], book_id, row[1], return_date)
+
+# Circulation desk: copies are scanned by barcode, so each scan goes straight
+# to one copy through the unique barcode index and, for returns, to its open
+# loan through idx_loans_item_open.
+def lend_copy(cursor, username, barcode):
+    # Returns 'lent', or why not: 'no_user', 'unknown' or the copy's status
+    cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
+    user = cursor.fetchone()
+    if user is None:
+        return 'no_user'
+    item = items.find_item(cursor, barcode)
+    if item is None:
+        return 'unknown'
+    item_id, book_id, status = item
+    return 'lent' if checkout(cursor, user[0], book_id, item_id) else status
+
+def return_copy(cursor, barcode, branch_id=None):
+    # Returns the title and borrower of the closed loan, or None
+    cursor.execute("""
+        SELECT l.id, l.book_id, i.item_id, b.title, u.username
+        FROM items i
+        JOIN loans l ON l.item_id = i.item_id AND l.return_date IS NULL
+        JOIN books b ON b.book_id = l.book_id
+        JOIN users u ON u.user_id = l.user_id
+        WHERE i.barcode = %s
+    """, (barcode,))
+    row = cursor.fetchone()
+    if row is None or not close_loan(cursor, *row[:3], branch_id=branch_id):
+        return None
+    return row[3], row[4]
+
+DESK_REFUSALS = {
+    'no_user': "No user has that username.",
+    'unknown': "No copy has that barcode.",
+    'loaned': "This copy is already lent out. Check it in first.",
+    'held': "This copy is set aside for another user's hold.",
+    'withdrawn': "This copy has been withdrawn from stock.",
+    'available': "This copy could not be lent. Scan it again.",
+}
+
+# Desk loans and returns change another user's data, which their own session
+# cache picks up on their next write; bumping the shared data version on
+# every scan would empty every session's cache several times a minute.
+def desk_checkout(username, barcode):
+    try:
+        result = run_transaction(lend_copy, username, barcode)
+        if result == 'lent':
+            invalidate_queries(get_top_rated_books_with_availability, get_most_borrowed_books, get_overdue_books)
+            st.success(f"Copy {barcode} lent to {username}.")
+            return True
+        st.warning(DESK_REFUSALS[result])
+    except Error as e:
+        st.error(f"Error lending copy: {e}")
+    return False
+
+def desk_checkin(barcode, branch_id=None):
+    try:
+        returned = run_transaction(return_copy, barcode, branch_id)
+        if returned is None:
+            st.warning("This copy is not lent out.")
+            return False
+        invalidate_queries(get_top_rated_books_with_availability, get_overdue_books, get_unread_count)
+        st.success(f"'{returned[0]}' returned by {returned[1]}.")
+        return True
+    except Error as e:
+        st.error(f"Error returning copy: {e}")
+    return False
+
+def get_copies(book_id):
+    try:
+        with get_cursor(dictionary=True) as cursor:
             cursor.execute("""
-                SELECT b.book_id, b.title, b.author, b.available_quantity
-                FROM books b
-                WHERE b.available_quantity > 0
-            """)
+                SELECT i.item_id, i.barcode, br.name as branch, i.status, u.username, l.due_date
+                FROM items i
+                JOIN branches br ON br.branch_id = i.branch_id
+                LEFT JOIN loans l ON l.item_id = i.item_id AND l.return_date IS NULL
+                LEFT JOIN users u ON u.user_id = l.user_id
+                WHERE i.book_id = %s
+                ORDER BY i.item_id
+            """, (book_id,))
             return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching available books: {e}")
-        finally:
-            conn.close()
+    except Error as e:
+        st.error(f"Error fetching copies: {e}")
     return []
 
-def borrow_book(user_id, book_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            loan_date = date.today()
-            cursor.execute("INSERT INTO loans (user_id, book_id, loan_date) VALUES (%s, %s, %s)",
-                           (user_id, book_id, loan_date))
-            cursor.execute("UPDATE books SET available_quantity = available_quantity - 1 WHERE book_id = %s", (book_id,))
-            conn.commit()
-            st.success("Book borrowed successfully!")
-        except Error as e:
-            st.error(f"Error borrowing book: {e}")
-        finally:
-            conn.close()
+# Branches and transfers between them; see branches.py
+def add_branch(name):
+    try:
+        with get_cursor() as cursor:
+            branches.add_branch(cursor, name)
+        invalidate_queries(get_branches, get_branch_stats)
+        st.success(f"Branch '{name}' added!")
+        return True
+    except Error as e:
+        st.error(f"Error adding branch: {e}")
+    return False
+
+def add_branch_copies(book_id, count, branch_id):
+    try:
+        with get_cursor() as cursor:
+            holds.lock_book(cursor, book_id)
+            items.add_copies(cursor, book_id, count, branch_id)
+            items.refresh_counts(cursor, [book_id])
+        invalidate_queries(get_book_stats, get_books_by_category, get_branch_stats,
+                           get_top_rated_books_with_availability)
+        bump_data_version()
+        st.success(f"{count} {'copy' if count == 1 else 'copies'} added!")
+        return True
+    except Error as e:
+        st.error(f"Error adding copies: {e}")
+    return False
+
+def request_transfer(book_id, branch_id):
+    try:
+        result = run_transaction(branches.request_transfer, book_id, branch_id)
+        if result == 'requested':
+            st.success("Transfer requested. The copy is on its way.")
+            return True
+        st.warning({
+            'on_shelf': "This branch already has a copy on the shelf.",
+            'none': "No other branch has a copy on the shelf.",
+            'missing': "This book no longer exists.",
+        }[result])
+    except Error as e:
+        st.error(f"Error requesting transfer: {e}")
+    return False
+
+def finish_transfer(transfer_id, receive):
+    try:
+        work = branches.receive_transfer if receive else branches.cancel_transfer
+        if not run_transaction(work, transfer_id):
+            st.warning("This transfer is no longer in transit.")
+            return False
+        # The copy may have gone to a hold, whose holder is notified
+        invalidate_queries(get_top_rated_books_with_availability, get_unread_count, get_branch_stats)
+        return True
+    except Error as e:
+        st.error(f"Error updating transfer: {e}")
+    return False
+
+def get_transfers(branch_id):
+    # Copies in transit to and from the branch, through idx_transfers_to and
+    # idx_transfers_from
+    transfers = {}
+    try:
+        with get_cursor(dictionary=True) as cursor:
+            for direction, column, other in (('incoming', 'to_branch_id', 'from_branch_id'),
+                                             ('outgoing', 'from_branch_id', 'to_branch_id')):
+                cursor.execute(f"""
+                    SELECT t.id, t.requested_at, b.title, i.barcode, br.name as branch
+                    FROM transfers t
+                    JOIN books b ON b.book_id = t.book_id
+                    JOIN items i ON i.item_id = t.item_id
+                    JOIN branches br ON br.branch_id = t.{other}
+                    WHERE t.{column} = %s AND t.status = 'in_transit'
+                    ORDER BY t.id
+                """, (branch_id,))
+                transfers[direction] = cursor.fetchall()
+            return transfers
+    except Error as e:
+        st.error(f"Error fetching transfers: {e}")
+    return {'incoming': [], 'outgoing': []}
+
+def borrow_book(user_id, book_id, branch_id=None):
+    try:
+        if not run_transaction(checkout, user_id, book_id, None, branch_id):
+            if branch_id is None:
+                st.warning("Sorry, no copies of this book are available right now.")
+            else:
+                st.warning("Sorry, no copies of this book are available at this branch right now.")
+            return False
+        invalidate_queries(get_top_rated_books_with_availability, get_most_borrowed_books, get_overdue_books)
+        invalidate_session_cache()
+        st.success("Book borrowed successfully!")
+        return True
+    except Error as e:
+        st.error(f"Error borrowing book: {e}")
+    return False
 
 def return_book(user_id, book_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            # Update the loan record
+    if WRITE_BEHIND:
+        return log_event('return', "Error returning book", user_id=user_id, book_id=book_id,
+                         return_date=date.today().isoformat())
+    try:
+        if not run_transaction(checkin, user_id, book_id):
+            st.warning("You have no open loan for this book.")
+            return False
+        # The copy may have gone to a hold, whose holder is notified
+        invalidate_queries(get_top_rated_books_with_availability, get_overdue_books, get_unread_count)
+        invalidate_session_cache()
+        return True
+    except Error as e:
+        st.error(f"Error returning book: {e}")
+    return False
+
+# Holds on titles with no copy on the shelf; see holds.py
+def place_hold(user_id, book_id):
+    try:
+        result = run_transaction(holds.place_hold, user_id, book_id)
+        if result == 'placed':
+            st.success("Hold placed. You will be notified in your inbox when a copy is ready.")
+            return True
+        st.warning({
+            'available': "A copy is on the shelf right now, so you can borrow it straight away.",
+            'duplicate': "You already have a hold on this book.",
+            'missing': "This book no longer exists.",
+        }[result])
+    except Error as e:
+        st.error(f"Error placing hold: {e}")
+    return False
+
+def cancel_hold(user_id, hold_id):
+    try:
+        if run_transaction(holds.cancel_hold, user_id, hold_id):
+            # A cancelled ready hold passes its copy on
+            invalidate_queries(get_top_rated_books_with_availability, get_unread_count)
+            return True
+        st.warning("This hold is no longer active.")
+    except Error as e:
+        st.error(f"Error cancelling hold: {e}")
+    return False
+
+def get_holds(user_id):
+    try:
+        with get_cursor(dictionary=True) as cursor:
+            # Queue position counts the waiting holds ahead on idx_holds_queue
             cursor.execute("""
-                UPDATE loans 
-                SET return_date = CURDATE() 
-                WHERE user_id = %s AND book_id = %s AND return_date IS NULL
-            """, (user_id, book_id))
-            
-            # Increase the available quantity of the book
+                SELECT h.id, h.book_id, b.title, h.status, h.placed_at, h.expires_at,
+                       (SELECT COUNT(*) FROM holds q
+                        WHERE q.book_id = h.book_id AND q.status = 'waiting' AND q.id < h.id) + 1 AS position
+                FROM holds h
+                JOIN books b ON b.book_id = h.book_id
+                WHERE h.user_id = %s AND h.status IN ('waiting', 'ready')
+                ORDER BY h.id
+            """, (user_id,))
+            return cursor.fetchall()
+    except Error as e:
+        st.error(f"Error fetching holds: {e}")
+    return []
+
+# In-app inbox. The unread count is read on every rerun of a logged-in
+# session, so it comes from the shared cache.
+@cached_query(ttl=30, error_message="Error fetching notifications", default=lambda: 0)
+def get_unread_count(user_id):
+    with get_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM notifications WHERE user_id = %s AND read_at IS NULL", (user_id,))
+        return cursor.fetchone()[0]
+
+def get_notifications(user_id, limit=50):
+    try:
+        with get_cursor(dictionary=True) as cursor:
             cursor.execute("""
-                UPDATE books 
-                SET available_quantity = available_quantity + 1 
-                WHERE book_id = %s
-            """, (book_id,))
-            
-            conn.commit()
-        except Error as e:
-            st.error(f"Error returning book: {e}")
-        finally:
-            conn.close()
+                SELECT id, message, created_at, read_at
+                FROM notifications
+                WHERE user_id = %s
+                ORDER BY id DESC
+                LIMIT %s
+            """, (user_id, limit))
+            return cursor.fetchall()
+    except Error as e:
+        st.error(f"Error fetching notifications: {e}")
+    return []
+
+def mark_notifications_read(user_id):
+    try:
+        with get_cursor() as cursor:
+            cursor.execute("UPDATE notifications SET read_at = %s WHERE user_id = %s AND read_at IS NULL",
+                           (datetime.now().replace(microsecond=0), user_id))
+        invalidate_queries(get_unread_count)
+    except Error as e:
+        st.error(f"Error updating notifications: {e}")
 
 def add_book(title, author, isbn, publication_year, genre, description, quantity, category_id, cover_image):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with get_cursor() as cursor:
             cursor.execute("""
                 INSERT INTO books (title, author, isbn, publication_year, genre, description, quantity, available_quantity, category_id, cover_image)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             """, (title, author, isbn, publication_year, genre, description, quantity, quantity, category_id, cover_image))
-            conn.commit()
-            st.success("Book added successfully!")
-        except Error as e:
-            st.error(f"Error adding book: {e}")
-        finally:
-            conn.close()
+            book_id = cursor.lastrowid
+            cursor.execute("INSERT INTO book_stats (book_id) VALUES (%s)", (book_id,))
+            items.add_copies(cursor, book_id, quantity)
+            items.refresh_counts(cursor, [book_id])
+        invalidate_queries(get_book_stats, get_books_by_category, get_branch_stats,
+                           get_top_rated_books_with_availability)
+        bump_data_version()
+        prefetch_cover(cover_image)
+        st.success("Book added successfully!")
+    except Error as e:
+        st.error(f"Error adding book: {e}")
+
+def get_loan_policies():
+    try:
+        with get_cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT category_id, loan_days, daily_fine FROM loan_policies")
+            return {p['category_id']: p for p in cursor.fetchall()}
+    except Error as e:
+        st.error(f"Error fetching loan policies: {e}")
+    return {}
+
+def set_loan_policy(category_id, loan_days, daily_fine):
+    try:
+        with get_cursor() as cursor:
+            cursor.execute(storage.query('set_loan_policy'), (category_id, loan_days, daily_fine))
+        st.success("Loan policy saved!")
+    except Error as e:
+        st.error(f"Error saving loan policy: {e}")
+
+# Cover thumbnails, fetched once and served from the local disk cache
+@st.cache_resource
+def get_cover_cache():
+    # Imported on first use so requests and Pillow stay off the startup path
+    import covers
+    return covers.CoverCache(
+        os.getenv('COVER_CACHE_DIR', '.cover_cache'),
+        max_bytes=int(float(os.getenv('COVER_CACHE_MAX_MB', 200)) * 1024 * 1024),
+        fetch_timeout=float(os.getenv('COVER_FETCH_TIMEOUT', 3)),
+    )
+
+def prefetch_cover(url):
+    if url:
+        get_cover_cache().prefetch(url)
 
 def get_categories():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
+    try:
+        with get_cursor(dictionary=True, replica=True) as cursor:
             cursor.execute("SELECT * FROM categories")
             return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching categories: {e}")
-        finally:
-            conn.close()
+    except Error as e:
+        st.error(f"Error fetching categories: {e}")
     return []
 
-def search_books(query):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            search = f"%{query}%"
-            cursor.execute("""
-                SELECT b.*, c.name as category_name
-                FROM books b
-                LEFT JOIN categories c ON b.category_id = c.category_id
-                WHERE b.title LIKE %s OR b.author LIKE %s OR b.isbn LIKE %s
-            """, (search, search, search))
+SEARCH_PAGE_SIZE = 20
+BOOK_PICKER_SIZE = 50
+# InnoDB ignores full-text terms shorter than innodb_ft_min_token_size
+FT_MIN_TOKEN_SIZE = 3
+ISBN_PATTERN = re.compile(r'\d{9}[\dX]|\d{13}')
+
+# '!' rather than backslash, whose escaping differs between MySQL and SQLite
+def escape_like(text):
+    return text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+# Pass the last row of the previous page as `after` to fetch the next page.
+# limit=None returns every match. With a branch_id only titles the branch
+# stocks are found, with its own availability.
+def search_books(query, limit=SEARCH_PAGE_SIZE, after=None, branch_id=None):
+    columns = "b.book_id, b.title, b.author, b.isbn, b.available_quantity, c.name as category_name"
+    join = ""
+    join_params = []
+    if branch_id is not None:
+        columns = columns.replace("b.available_quantity", "s.available_quantity")
+        join = "JOIN branch_stock s ON s.branch_id = %s AND s.book_id = b.book_id AND s.quantity > 0"
+        join_params = [branch_id]
+    isbn = re.sub(r'[\s-]', '', query).upper()
+    terms = [t for t in re.findall(r'\w+', query.lower()) if len(t) >= FT_MIN_TOKEN_SIZE]
+    limit_clause = f"LIMIT {int(limit)}" if limit else ""
+    try:
+        with get_cursor(dictionary=True, replica=True) as cursor:
+            if ISBN_PATTERN.fullmatch(isbn):
+                # Exact ISBN lookups go straight to the unique index
+                if after:
+                    return []
+                cursor.execute(f"""
+                    SELECT {columns}
+                    FROM books b
+                    LEFT JOIN categories c ON b.category_id = c.category_id
+                    {join}
+                    WHERE b.isbn = %s
+                """, (*join_params, isbn))
+            elif terms:
+                cursor.execute(*storage.fulltext_search(columns, terms, after, limit_clause, join, join_params))
+            else:
+                # Queries too short for the full-text index fall back to a
+                # title prefix scan; an empty query browses the whole catalog
+                params = [*join_params, f"{escape_like(query.strip())}%"]
+                keyset = ""
+                if after:
+                    keyset = "AND (b.title > %s OR (b.title = %s AND b.book_id > %s))"
+                    params += [after['title'], after['title'], after['book_id']]
+                cursor.execute(f"""
+                    SELECT {columns}
+                    FROM books b
+                    LEFT JOIN categories c ON b.category_id = c.category_id
+                    {join}
+                    WHERE b.title LIKE %s ESCAPE '!' {keyset}
+                    ORDER BY b.title, b.book_id
+                    {limit_clause}
+                """, params)
             return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error searching books: {e}")
-        finally:
-            conn.close()
+    except Error as e:
+        load_failed(f"Error searching books: {e}")
     return []
 
+# Lightweight id/title listing for pickers, ordered by title. Pass the last
+# row of the previous page as `after` to fetch the next page.
+def list_books(prefix="", after=None, limit=BOOK_PICKER_SIZE):
+    params = [f"{escape_like(prefix.strip())}%"]
+    keyset = ""
+    if after:
+        keyset = "AND (title > %s OR (title = %s AND book_id > %s))"
+        params += [after['title'], after['title'], after['book_id']]
+    try:
+        with get_cursor(dictionary=True, replica=True) as cursor:
+            cursor.execute(f"""
+                SELECT book_id, title
+                FROM books
+                WHERE title LIKE %s ESCAPE '!' {keyset}
+                ORDER BY title, book_id
+                LIMIT %s
+            """, (*params, limit))
+            return cursor.fetchall()
+    except Error as e:
+        st.error(f"Error listing books: {e}")
+    return []
+
+def get_book(book_id):
+    try:
+        with get_cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT * FROM books WHERE book_id = %s", (book_id,))
+            return cursor.fetchone()
+    except Error as e:
+        st.error(f"Error fetching book: {e}")
+    return None
+
+def record_review(cursor, user_id, book_id, rating, comment, review_date):
+    cursor.execute("""
+        INSERT INTO reviews (user_id, book_id, rating, comment, review_date)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (user_id, book_id, rating, comment, review_date))
+    cursor.execute("""
+        UPDATE book_stats
+        SET review_count = review_count + 1, rating_sum = rating_sum + %s
+        WHERE book_id = %s
+    """, (rating, book_id))
+    if rating >= 4:
+        refresh_user_recommendations(cursor, user_id, book_id)
+
 def add_review(user_id, book_id, rating, comment):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            review_date = date.today()
-            cursor.execute("""
-                INSERT INTO reviews (user_id, book_id, rating, comment, review_date)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (user_id, book_id, rating, comment, review_date))
-            conn.commit()
+    if WRITE_BEHIND:
+        if log_event('review', "Error adding review", user_id=user_id, book_id=book_id, rating=rating,
+                     comment=comment, review_date=date.today().isoformat()):
             st.success("Review added successfully!")
-        except Error as e:
-            st.error(f"Error adding review: {e}")
-        finally:
-            conn.close()
+        return
+    try:
+        with get_cursor() as cursor:
+            record_review(cursor, user_id, book_id, rating, comment, date.today())
+        invalidate_queries(get_top_rated_books_with_availability)
+        invalidate_session_cache()
+        st.success("Review added successfully!")
+    except Error as e:
+        st.error(f"Error adding review: {e}")
+
+# Write-behind path for reviews and returns (WRITE_BEHIND=1): the event is
+# appended to a local log and a background worker group-commits it to the
+# database. Borrowing always stays synchronous, since it has to check stock
+# before answering.
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+
+EVENT_HANDLERS = {
+    'review': record_review,
+    'return': checkin,
+}
+
+def apply_event_batch(cursor, events):
+    applied_at = datetime.now().replace(microsecond=0)
+    applied = []
+    for event in events:
+        # The idempotency key commits with the event's own writes, so an
+        # event replayed after a crash is skipped here
+        cursor.execute(storage.query('claim_event'), (event['id'], applied_at))
+        if cursor.rowcount == 0:
+            continue
+        EVENT_HANDLERS[event['type']](cursor, **event['payload'])
+        applied.append(event)
+    return applied
+
+def apply_events(events):
+    applied = run_transaction(apply_event_batch, events)
+    if applied:
+        invalidate_queries(get_top_rated_books_with_availability, get_overdue_books, get_unread_count)
+    return applied
+
+def is_transient_error(e):
+    # The database being down, unreachable or busy says nothing about the
+    # events, so they are retried for as long as it takes
+    return (isinstance(e, (InterfaceError, OperationalError, PoolError))
+            or isinstance(e, Error) and e.errno in RETRYABLE_ERRORS)
+
+@st.cache_resource
+def get_event_log():
+    import eventlog
+    # The worker serves every session, so it runs without a script run
+    # context and uses the process-wide resources resolved here
+    resources = bind_resources(get_connection_pool, get_pool_state, get_query_metrics_state,
+                               get_query_cache_state)
+
+    def apply(events):
+        use_resources(resources)
+        return apply_events(events)
+
+    log = eventlog.EventLog(
+        os.getenv('EVENT_LOG_PATH', 'events.log'), apply,
+        # A review of a book deleted in the meantime can never be applied
+        is_permanent=lambda e: isinstance(e, IntegrityError),
+        is_transient=is_transient_error,
+        batch_size=int(os.getenv('EVENT_BATCH_SIZE', 500)),
+        flush_interval=float(os.getenv('EVENT_FLUSH_INTERVAL', 0.2)),
+    )
+    # Events left over from a previous run are replayed by the first flush
+    log.start()
+    return log
+
+def log_event(kind, error_message, **payload):
+    try:
+        event = get_event_log().append(kind, **payload)
+    except OSError as e:
+        st.error(f"{error_message}: {e}")
+        return False
+    st.session_state.setdefault('pending_events', []).append(event)
+    invalidate_session_cache()
+    return True
+
+def pending_events(kind):
+    # The session's own write-behind events not yet in the database, so the
+    # acting user sees their writes before the worker applies them
+    events = st.session_state.get('pending_events')
+    if not events:
+        return []
+    log = get_event_log()
+    pending = [event for event in events if not log.is_applied(event)]
+    if len(pending) < len(events):
+        # Reads cached before those events landed are stale now
+        invalidate_session_cache()
+        st.session_state.pending_events = pending
+    return [event for event in pending if event['type'] == kind]
+
+def hide_pending_returns(borrowed_books):
+    borrowed_books = list(borrowed_books)
+    for event in pending_events('return'):
+        for i, book in enumerate(borrowed_books):
+            if book['book_id'] == event['payload']['book_id']:
+                del borrowed_books[i]
+                break
+    return borrowed_books
 
 def remove_book(book_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with get_cursor() as cursor:
             # First, remove any associated loans
+            cursor.execute("DELETE FROM overdue_loans WHERE book_id = %s", (book_id,))
             cursor.execute("DELETE FROM loans WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM loans_archive WHERE book_id = %s", (book_id,))
             # Then, remove any associated reviews
             cursor.execute("DELETE FROM reviews WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM reviews_archive WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM holds WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM transfers WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM branch_stock WHERE book_id = %s", (book_id,))
+            cursor.execute("DELETE FROM items WHERE book_id = %s", (book_id,))
+            # Drop the book's materialized aggregates
+            cursor.execute("DELETE FROM book_stats WHERE book_id = %s", (book_id,))
             # Finally, remove the book
             cursor.execute("DELETE FROM books WHERE book_id = %s", (book_id,))
-            conn.commit()
-            st.success("Book removed successfully!")
-        except Error as e:
-            st.error(f"Error removing book: {e}")
-        finally:
-            conn.close()
+        invalidate_queries(get_book_stats, get_books_by_category, get_branch_stats,
+                           get_top_rated_books_with_availability, get_most_borrowed_books, get_overdue_books)
+        bump_data_version()
+        st.success("Book removed successfully!")
+    except Error as e:
+        st.error(f"Error removing book: {e}")
 
+@cached_query(ttl=300, error_message="Error fetching most borrowed books")
 def get_most_borrowed_books():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT b.title, COUNT(*) as borrow_count
-                FROM loans l
-                JOIN books b ON l.book_id = b.book_id
-                GROUP BY l.book_id
-                ORDER BY borrow_count DESC
-                LIMIT 5
-            """)
-            return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching most borrowed books: {e}")
-        finally:
-            conn.close()
-    return []
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        cursor.execute("""
+            SELECT b.title, s.loan_count as borrow_count
+            FROM book_stats s
+            JOIN books b ON b.book_id = s.book_id
+            WHERE s.loan_count > 0
+            ORDER BY s.loan_count DESC, s.book_id DESC
+            LIMIT 5
+        """)
+        return cursor.fetchall()
 
+@cached_query(ttl=300, error_message="Error fetching overdue books")
 def get_overdue_books():
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT b.title, u.username, l.loan_date
-                FROM loans l
-                JOIN books b ON l.book_id = b.book_id
-                JOIN users u ON l.user_id = u.user_id
-                WHERE l.return_date IS NULL AND l.loan_date < DATE_SUB(CURDATE(), INTERVAL 14 DAY)
-                ORDER BY l.loan_date
-            """)
-            return cursor.fetchall()
-        except Error as e:
-            st.error(f"Error fetching overdue books: {e}")
-        finally:
-            conn.close()
-    return []
+    with get_cursor(dictionary=True, replica=True) as cursor:
+        # Materialized by overdue.py; returns are removed as they happen
+        cursor.execute("""
+            SELECT title, username, loan_date, due_date, days_overdue, fine, refreshed_at
+            FROM overdue_loans
+            ORDER BY due_date, loan_id
+        """)
+        return cursor.fetchall()
 
 def get_book_recommendations(user_id):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
-                SELECT DISTINCT b.book_id, b.title, b.author, b.genre, c.name as category_name
-                FROM books b
-                JOIN loans l ON b.book_id = l.book_id
-                JOIN categories c ON b.category_id = c.category_id
-                WHERE l.user_id = %s
-                UNION
-                SELECT DISTINCT b.book_id, b.title, b.author, b.genre, c.name as category_name
-                FROM books b
-                JOIN reviews r ON b.book_id = r.book_id
-                JOIN categories c ON b.category_id = c.category_id
-                WHERE r.user_id = %s AND r.rating >= 4
-            """, (user_id, user_id))
-            user_preferences = cursor.fetchall()
-
-            if not user_preferences:
-                return []
-
-            genres = set(book['genre'] for book in user_preferences)
-            categories = set(book['category_name'] for book in user_preferences)
-
-            placeholders = ', '.join(['%s'] * len(genres))
-            category_placeholders = ', '.join(['%s'] * len(categories))
-
-            cursor.execute(f"""
-                SELECT b.book_id, b.title, b.author, b.genre, c.name as category_name,
-                       AVG(r.rating) as avg_rating
-                FROM books b
-                LEFT JOIN reviews r ON b.book_id = r.book_id
-                JOIN categories c ON b.category_id = c.category_id
-                WHERE b.genre IN ({placeholders})
-                   OR c.name IN ({category_placeholders})
-                   AND b.book_id NOT IN (
-                       SELECT book_id FROM loans WHERE user_id = %s
-                   )
-                GROUP BY b.book_id
-                ORDER BY avg_rating IS NULL, avg_rating DESC
-                LIMIT 5
-            """, (*genres, *categories, user_id))
-
-            recommendations = cursor.fetchall()
-            return recommendations
-        except Error as e:
-            st.error(f"Error getting book recommendations: {e}")
-        finally:
-            conn.close()
+    try:
+        with get_cursor(dictionary=True, replica=True) as cursor:
+            # Precomputed by recommend.py; users the batch job has not seen yet
+            # fall back to the per-request query
+            return fetch_recommendations(cursor, user_id) or recommend_with_sql(cursor, user_id)
+    except Error as e:
+        load_failed(f"Error getting book recommendations: {e}")
     return []
 
 def update_book(book_id, title, author, isbn, publication_year, genre, description, quantity, category_id, cover_image):
-    conn = create_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with get_cursor() as cursor:
+            # A new quantity adds copies or withdraws ones on the shelf, and
+            # both counters are recounted from the copies
+            holds.lock_book(cursor, book_id)
+            if not items.set_copy_count(cursor, book_id, quantity):
+                st.warning("Only copies on the shelf can be withdrawn, and too few are in. "
+                           "Try again once more copies are returned.")
+                return
             cursor.execute("""
                 UPDATE books 
                 SET title = %s, author = %s, isbn = %s, publication_year = %s, 
-                    genre = %s, description = %s, quantity = %s, 
+                    genre = %s, description = %s, 
                     category_id = %s, cover_image = %s
                 WHERE book_id = %s
             """, (title, author, isbn, publication_year, genre, description, 
-                  quantity, category_id, cover_image, book_id))
-            conn.commit()
-            st.success("Book updated successfully!")
-        except Error as e:
-            st.error(f"Error updating book: {e}")
-        finally:
-            conn.close()
+                  category_id, cover_image, book_id))
+        invalidate_queries(get_book_stats, get_books_by_category, get_branch_stats,
+                           get_top_rated_books_with_availability, get_most_borrowed_books, get_overdue_books)
+        bump_data_version()
+        prefetch_cover(cover_image)
+        st.success("Book updated successfully!")
+    except Error as e:
+        st.error(f"Error updating book: {e}")
+
+REQUIRED_TABLES = {'users', 'books', 'categories', 'loans', 'reviews', 'schema_migrations'}
+
+def read_schema_state():
+    with get_cursor() as cursor:
+        existing_tables = storage.list_tables(cursor)
+        schema_version = 0
+        if 'schema_migrations' in existing_tables:
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            schema_version = cursor.fetchone()[0]
+    return existing_tables, schema_version
 
+# Returns the schema version once every table exists and all migrations
+# have run, creating or migrating the database first if needed
 def ensure_database_exists():
-    conn = create_connection()
-    if conn:
+    # The DDL and migration code is only needed here, once per process
+    from init_db import create_database, LATEST_SCHEMA_VERSION
+
+    try:
+        existing_tables, schema_version = read_schema_state()
+    except Error as e:
+        print(f"Error checking database: {e}")
+        existing_tables, schema_version = set(), 0
+
+    if not REQUIRED_TABLES.issubset(existing_tables):
+        print("Database tables are missing. Running initialization...")
+    elif schema_version < LATEST_SCHEMA_VERSION:
+        print("Database schema is out of date. Running migrations...")
+    else:
+        print("Database and tables already exist.")
+        return schema_version
+
+    create_database()
+    existing_tables, schema_version = read_schema_state()
+    if not REQUIRED_TABLES.issubset(existing_tables) or schema_version < LATEST_SCHEMA_VERSION:
+        raise Error(msg=f"database initialization did not complete (schema version {schema_version})")
+    return schema_version
+
+# One-time startup phase. Streamlit re-executes this script on every
+# interaction, so the schema check runs once per process and later reruns
+# only read its recorded result.
+STARTUP_RETRY_SECONDS = 5
+
+@st.cache_resource
+def get_startup_state():
+    return {'lock': threading.Lock(), 'ready': False, 'schema_version': None,
+            'checked_at': None, 'duration': None, 'attempts': 0, 'error': None}
+
+def ensure_database_ready():
+    state = get_startup_state()
+    if state['ready']:
+        return True
+    with state['lock']:
+        # Another session may have finished the check while this one waited
+        if state['ready']:
+            return True
+        # A failed check is retried at most every few seconds, not on every rerun
+        if state['checked_at'] and time.time() - state['checked_at'] < STARTUP_RETRY_SECONDS:
+            return False
+        start = time.perf_counter()
         try:
-            cursor = conn.cursor()
-            cursor.execute("SHOW TABLES")
-            tables = cursor.fetchall()
-            required_tables = {'users', 'books', 'categories', 'loans', 'reviews'}
-            existing_tables = {table[0] for table in tables}
-            
-            if not required_tables.issubset(existing_tables):
-                print("Database tables are missing. Running initialization...")
-                create_database()
-            else:
-                print("Database and tables already exist.")
+            state['schema_version'] = ensure_database_exists()
+            state['ready'] = True
+            state['error'] = None
         except Error as e:
-            print(f"Error checking database: {e}")
-            create_database()
-        finally:
-            conn.close()
-    else:
-        print("Unable to connect to database. Running initialization...")
-        create_database()
+            state['error'] = str(e)
+        state['attempts'] += 1
+        state['checked_at'] = time.time()
+        state['duration'] = time.perf_counter() - start
+        print(f"Startup checks {'passed' if state['ready'] else 'failed'} in {state['duration'] * 1000:.0f} ms")
+    return state['ready']
 
-# Call this function before main
-ensure_database_exists()
+# Readiness reports the outcome of the startup phase; the database check
+# is live, so a lost connection shows up even after startup succeeded
+def health_check():
+    ensure_database_ready()
+    state = get_startup_state()
+    health = {
+        'ready': state['ready'],
+        'backend': storage.BACKEND,
+        'schema_version': state['schema_version'],
+        'startup_ms': round(state['duration'] * 1000, 1) if state['duration'] is not None else None,
+        'startup_attempts': state['attempts'],
+        'error': state['error'],
+        'database': None,
+    }
+    if state['ready']:
+        try:
+            with get_cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            health['database'] = 'ok'
+        except Error as e:
+            health['database'] = f"error: {e}"
+    if storage.REPLICAS:
+        health['replicas'] = get_replica_status()
+    return health
 
 def main():
+    # /?health renders the health check as JSON for load balancers and probes
+    if 'health' in st.experimental_get_query_params():
+        st.json(health_check())
+        return
+
+    if not ensure_database_ready():
+        st.error(f"The database is not available yet: {get_startup_state()['error']}")
+        st.stop()
+    if WRITE_BEHIND:
+        # Start the worker, and with it any replay, before the first write
+        get_event_log()
+    if storage.REPLICAS:
+        # Start measuring replica lag before the first read that could use it
+        get_replica_state()
+
     st.title("Library Management System")
 
     # Sidebar navigation
     st.sidebar.title("Navigation")
-    menu_items = ["Home", "Login", "Sign Up", "Borrow", "Book Management", "Review", "Book Search", "Reports"]
+    menu_items = ["Home", "Login", "Sign Up", "Borrow", "Book Management", "Circulation Desk", "Review",
+                  "Book Search", "Reports"]
     
     if "user" in st.session_state:
-        menu_items.append("Logout")
+        menu_items += ["Inbox", "Logout"]
     
     # Replace the buttons with a single selectbox
     selected = st.sidebar.selectbox("Go to", menu_items, key="nav_selectbox")
+    branch_names = {b['branch_id']: b['name'] for b in get_branches()}
+    st.sidebar.selectbox("Branch", options=[None, *branch_names],
+                         format_func=lambda x: "All branches" if x is None else branch_names[x], key="branch_id")
+    if "user" in st.session_state:
+        unread = get_unread_count(st.session_state.user['user_id'])
+        if unread:
+            st.sidebar.info(f"You have {unread} unread notification{'s' if unread != 1 else ''} in your Inbox.")
 
     if selected == "Home":
         home_page()
@@ -437,30 +1641,31 @@ def main():
         borrow_page()
     elif selected == "Book Management":
         book_management_page()
+    elif selected == "Circulation Desk":
+        circulation_desk_page()
     elif selected == "Review":
         review_page()
     elif selected == "Book Search":
         book_search_page()
     elif selected == "Reports":
         report_page()
+    elif selected == "Inbox":
+        inbox_page()
     elif selected == "Logout":
         logout()
 
-def home_page():
-    st.header("Welcome to the Library")
-    book_stats, user_stats = get_book_stats()
+def selected_branch():
+    # The branch picked in the sidebar, or None for the whole library
+    return st.session_state.get('branch_id')
+
+def render_book_stats(stats):
+    book_stats, user_stats = stats
     if book_stats and user_stats:
         st.write(f"Total Books: {book_stats['total_books']}")
         st.write(f"Total Book Quantity: {book_stats['total_quantity']}")
         st.write(f"Total Users: {user_stats['total_users']}")
 
-    st.subheader("Books by Category")
-    category_stats = get_books_by_category()
-    for cat in category_stats:
-        st.write(f"{cat['category']}: {cat['book_count']} books")
-
-    st.subheader("Top Rated Books")
-    top_books = get_top_rated_books_with_availability()
+def render_top_rated_grid(top_books):
     cols = st.columns(5)  # Display up to 5 books in a row
     for i, book in enumerate(top_books):
         with cols[i % 5]:
@@ -469,7 +1674,7 @@ def home_page():
             
             if book['cover_image']:
                 try:
-                    st.image(book['cover_image'], use_column_width=True)
+                    st.image(get_cover_cache().get(book['cover_image']), use_column_width=True)
                 except Exception as e:
                     st.write("(Image unavailable)")
             else:
@@ -478,14 +1683,38 @@ def home_page():
             if book['available_quantity'] > 0:
                 if st.button("Borrow", key=f"borrow_top_{book['book_id']}"):
                     if "user" in st.session_state:
-                        borrow_book(st.session_state.user['user_id'], book['book_id'])
-                        st.success(f"You have borrowed '{book['title']}'")
-                        st.rerun()
+                        if borrow_book(st.session_state.user['user_id'], book['book_id'], selected_branch()):
+                            st.success(f"You have borrowed '{book['title']}'")
+                            st.rerun()
                     else:
                         st.warning("Please login to borrow books")
             else:
                 st.write("Not available")
 
+def render_category_list(category_stats):
+    for cat in category_stats:
+        st.write(f"{cat['category']}: {cat['book_count']} books")
+
+def home_page():
+    st.header("Welcome to the Library")
+    # Lay out every section first, then fill each one as its data arrives
+    sections = {'stats': (st.empty(), render_book_stats)}
+    st.subheader("Books by Category")
+    sections['categories'] = (st.empty(), render_category_list)
+    st.subheader("Top Rated Books")
+    sections['top_books'] = (st.empty(), render_top_rated_grid)
+    for placeholder, _ in sections.values():
+        placeholder.caption("Loading...")
+
+    for name, result in fetch_concurrently({
+        'stats': (get_book_stats, selected_branch()),
+        'categories': (get_books_by_category, selected_branch()),
+        'top_books': (get_top_rated_books_with_availability,),
+    }):
+        placeholder, render = sections[name]
+        with placeholder.container():
+            render(result)
+
 def login_page():
     st.header("Login")
     username = st.text_input("Username", key="login_username")
@@ -516,36 +1745,101 @@ def borrow_page():
     
     # Borrowed Books Section
     st.subheader("Your Borrowed Books")
-    borrowed_books = get_borrowed_books(st.session_state.user['user_id'])
+    borrowed_books = hide_pending_returns(session_cached(get_borrowed_books, st.session_state.user['user_id']))
     if borrowed_books:
         for i, book in enumerate(borrowed_books):
             col1, col2 = st.columns([3, 1])
             with col1:
-                st.write(f"{book['title']} - Borrowed on: {book['loan_date']}")
+                st.write(f"{book['title']} - Borrowed on: {book['loan_date']}, due: {book['due_date']}")
             with col2:
                 if st.button(f"Return", key=f"return_{book['book_id']}_{i}"):
-                    return_book(st.session_state.user['user_id'], book['book_id'])
-                    st.success(f"You have returned '{book['title']}'")
-                    st.rerun()
+                    if return_book(st.session_state.user['user_id'], book['book_id']):
+                        st.success(f"You have returned '{book['title']}'")
+                        st.rerun()
     else:
         st.info("You haven't borrowed any books yet.")
 
+    # Holds Section
+    user_holds = get_holds(st.session_state.user['user_id'])
+    if user_holds:
+        st.subheader("Your Holds")
+        for hold in user_holds:
+            col1, col2, col3 = st.columns([3, 1, 1])
+            with col1:
+                if hold['status'] == 'ready':
+                    st.write(f"{hold['title']} - Ready, held for you until {hold['expires_at']}")
+                else:
+                    st.write(f"{hold['title']} - Waiting, number {hold['position']} in line")
+            with col2:
+                if hold['status'] == 'ready' and st.button("Borrow", key=f"borrow_hold_{hold['id']}"):
+                    if borrow_book(st.session_state.user['user_id'], hold['book_id']):
+                        st.rerun()
+            with col3:
+                if st.button("Cancel", key=f"cancel_hold_{hold['id']}"):
+                    if cancel_hold(st.session_state.user['user_id'], hold['id']):
+                        st.rerun()
+
     # Available Books Section
     st.subheader("Available Books")
-    available_books = get_available_books()
+    categories = get_categories()
+    category_names = {c['category_id']: c['name'] for c in categories}
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        category_id = st.selectbox("Category", options=[None, *category_names],
+                                   format_func=lambda x: "All" if x is None else category_names[x],
+                                   key="available_category")
+    with col2:
+        genre = st.text_input("Genre", key="available_genre")
+    with col3:
+        author_prefix = st.text_input("Author starts with", key="available_author")
+    with col4:
+        page_size = st.selectbox("Per page", AVAILABLE_PAGE_SIZES, index=1, key="available_page_size")
+
+    # Keyset paging: remember the last row of every page visited so far, and
+    # start over whenever a filter changes
+    filters = (category_id, genre.strip() or None, author_prefix.strip() or None, selected_branch())
+    paging = st.session_state.get('available_paging')
+    if not paging or paging['filters'] != filters or paging['page_size'] != page_size:
+        paging = {'filters': filters, 'page_size': page_size, 'cursors': [None]}
+        st.session_state.available_paging = paging
+    available_books = get_available_books(*filters, after=paging['cursors'][-1], limit=page_size + 1)
+    has_next_page = len(available_books) > page_size
+    available_books = available_books[:page_size]
+    if not available_books:
+        st.info("No available books match these filters.")
     for book in available_books:
         col1, col2 = st.columns([3, 1])
         with col1:
             st.write(f"{book['title']} by {book['author']} - Available: {book['available_quantity']}")
         with col2:
             if st.button(f"Borrow '{book['title']}'", key=f"borrow_{book['book_id']}"):
-                borrow_book(st.session_state.user['user_id'], book['book_id'])
-                st.success(f"You have borrowed '{book['title']}'")
+                if borrow_book(st.session_state.user['user_id'], book['book_id'], selected_branch()):
+                    st.success(f"You have borrowed '{book['title']}'")
+                    st.rerun()
+
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        if len(paging['cursors']) > 1 and st.button("Previous page", key="available_prev"):
+            paging['cursors'].pop()
+            st.rerun()
+    with page_col:
+        st.caption(f"Page {len(paging['cursors'])}")
+    with next_col:
+        if has_next_page and st.button("Next page", key="available_next"):
+            paging['cursors'].append(available_books[-1])
+            st.rerun()
+
+    # Books with no copy on the shelf can be put on hold instead of checked
+    # for again and again. The picker only queries once it is opened.
+    if st.checkbox("Place a hold on a book that is out", key="show_hold_picker"):
+        hold_book_id = book_picker("Book to hold", key="hold_book_select")
+        if hold_book_id is not None and st.button("Place Hold", key="place_hold_button"):
+            if place_hold(st.session_state.user['user_id'], hold_book_id):
                 st.rerun()
 
     # Book Recommendations Section
     st.subheader("Recommended Books")
-    recommendations = get_book_recommendations(st.session_state.user['user_id'])
+    recommendations = session_cached(get_book_recommendations, st.session_state.user['user_id'])
     if recommendations:
         for book in recommendations:
             col1, col2 = st.columns([3, 1])
@@ -555,12 +1849,21 @@ def borrow_page():
                     st.write(f"Average Rating: {book['avg_rating']:.2f}")
             with col2:
                 if st.button(f"Borrow '{book['title']}'", key=f"borrow_rec_{book['book_id']}"):
-                    borrow_book(st.session_state.user['user_id'], book['book_id'])
-                    st.success(f"You have borrowed '{book['title']}'")
-                    st.rerun()
+                    if borrow_book(st.session_state.user['user_id'], book['book_id'], selected_branch()):
+                        st.success(f"You have borrowed '{book['title']}'")
+                        st.rerun()
     else:
         st.info("No recommendations available. Try borrowing or reviewing more books!")
 
+def book_picker(label, key):
+    # Filtering happens in the database, so only one page of titles is loaded
+    prefix = st.text_input(f"{label} (type to filter by title)", key=f"{key}_filter")
+    books = list_books(prefix)
+    titles = {b['book_id']: b['title'] for b in books}
+    if len(books) == BOOK_PICKER_SIZE:
+        st.caption(f"Showing the first {BOOK_PICKER_SIZE} matches. Type more of the title to narrow the list.")
+    return st.selectbox(label, options=list(titles), format_func=titles.get, key=key)
+
 def book_management_page():
     if "user" not in st.session_state or not st.session_state.user.get('is_admin', False):
         st.warning("Only admins can access this page")
@@ -576,9 +1879,10 @@ def book_management_page():
     publication_year = st.number_input("Publication Year", min_value=1000, max_value=date.today().year, key="add_book_year")
     genre = st.text_input("Genre", key="add_book_genre")
     description = st.text_area("Description", key="add_book_description")
-    quantity = st.number_input("Quantity", min_value=1, key="add_book_quantity")
+    quantity = st.number_input("Quantity", min_value=1, max_value=items.MAX_COPIES, key="add_book_quantity")
     categories = get_categories()
-    category_id = st.selectbox("Category", options=[c['category_id'] for c in categories], format_func=lambda x: next(c['name'] for c in categories if c['category_id'] == x), key="add_book_category")
+    category_names = {c['category_id']: c['name'] for c in categories}
+    category_id = st.selectbox("Category", options=list(category_names), format_func=category_names.get, key="add_book_category")
     cover_image = st.text_input("Cover Image URL", key="add_book_cover")
 
     if st.button("Add Book", key="add_book_button"):
@@ -586,13 +1890,9 @@ def book_management_page():
 
     # Edit Book Section
     st.subheader("Edit Book")
-    books = search_books("")  # Get all books
-    book_to_edit = st.selectbox("Select a book to edit", 
-                                options=[b['book_id'] for b in books], 
-                                format_func=lambda x: next(b['title'] for b in books if b['book_id'] == x),
-                                key="edit_book_select")
+    book_to_edit = book_picker("Select a book to edit", key="edit_book_select")
     
-    selected_book = next((b for b in books if b['book_id'] == book_to_edit), None)
+    selected_book = get_book(book_to_edit) if book_to_edit else None
     
     if selected_book:
         with st.form(key='edit_book_form'):
@@ -602,14 +1902,14 @@ def book_management_page():
             edit_publication_year = st.number_input("Publication Year", min_value=1000, max_value=date.today().year, value=selected_book['publication_year'], key="edit_book_year")
             edit_genre = st.text_input("Genre", value=selected_book['genre'], key="edit_book_genre")
             edit_description = st.text_area("Description", value=selected_book['description'], key="edit_book_description")
-            edit_quantity = st.number_input("Quantity", min_value=1, value=selected_book['quantity'], key="edit_book_quantity")
-            categories = get_categories()
-            category_ids = [c['category_id'] for c in categories]
-            default_index = category_ids.index(selected_book['category_id']) if selected_book['category_id'] in category_ids else 0
+            edit_quantity = st.number_input("Quantity", min_value=1, max_value=items.MAX_COPIES,
+                                            value=selected_book['quantity'], key="edit_book_quantity")
+            category_ids = list(category_names)
+            default_index = category_ids.index(selected_book['category_id']) if selected_book['category_id'] in category_names else 0
             edit_category_id = st.selectbox("Category", 
                                             options=category_ids,
                                             index=default_index,
-                                            format_func=lambda x: next((c['name'] for c in categories if c['category_id'] == x), "Unknown"),
+                                            format_func=lambda x: category_names.get(x, "Unknown"),
                                             key="edit_book_category")
             edit_cover_image = st.text_input("Cover Image URL", value=selected_book['cover_image'], key="edit_book_cover")
 
@@ -618,44 +1918,145 @@ def book_management_page():
                             edit_genre, edit_description, edit_quantity, edit_category_id, edit_cover_image)
                 st.rerun()
 
+        if st.checkbox("Show copies", key="show_copies"):
+            copies = get_copies(book_to_edit)
+            if copies:
+                st.table([{'Barcode': c['barcode'], 'Branch': c['branch'], 'Status': c['status'],
+                           'Borrower': c['username'] or "", 'Due': c['due_date'] or ""} for c in copies])
+            branch_names = {b['branch_id']: b['name'] for b in get_branches()}
+            col1, col2, col3 = st.columns([2, 1, 1])
+            with col1:
+                copies_branch_id = st.selectbox("Branch", options=list(branch_names), format_func=branch_names.get,
+                                                key="add_copies_branch")
+            with col2:
+                copies_count = st.number_input("Copies", min_value=1, max_value=items.MAX_COPIES, key="add_copies_count")
+            with col3:
+                if st.button("Add Copies", key="add_copies_button") and copies_branch_id is not None:
+                    if add_branch_copies(book_to_edit, copies_count, copies_branch_id):
+                        st.rerun()
+
+    # Branches Section
+    st.subheader("Branches")
+    branch_name = st.text_input("New branch name", key="add_branch_name")
+    if st.button("Add Branch", key="add_branch_button") and branch_name.strip():
+        if add_branch(branch_name.strip()):
+            st.rerun()
+
+    # Loan Policy Section
+    st.subheader("Loan Policies")
+    policies = get_loan_policies()
+    policy_category = st.selectbox("Category", options=list(category_names), format_func=category_names.get,
+                                   key="policy_category")
+    policy = policies.get(policy_category, {})
+    with st.form(key='loan_policy_form'):
+        loan_days = st.number_input("Loan period (days)", min_value=1,
+                                    value=policy.get('loan_days', DEFAULT_LOAN_DAYS), key=f"policy_loan_days_{policy_category}")
+        daily_fine = st.number_input("Fine per overdue day", min_value=0.0, step=0.05,
+                                     value=float(policy.get('daily_fine', DEFAULT_DAILY_FINE)), key=f"policy_daily_fine_{policy_category}")
+        if st.form_submit_button("Save Policy") and policy_category is not None:
+            set_loan_policy(policy_category, loan_days, daily_fine)
+
     # Remove Book Section
     st.subheader("Remove Book")
-    books = search_books("")  # Get all books
-    book_to_remove = st.selectbox("Select a book to remove", 
-                                  options=[b['book_id'] for b in books], 
-                                  format_func=lambda x: next(b['title'] for b in books if b['book_id'] == x),
-                                  key="remove_book_select")
+    book_to_remove = book_picker("Select a book to remove", key="remove_book_select")
     
-    if st.button("Remove Book", key="remove_book_button"):
+    if st.button("Remove Book", key="remove_book_button") and book_to_remove is not None:
         remove_book(book_to_remove)
         st.success("Book removed successfully!")
         st.rerun()
 
+def circulation_desk_page():
+    if "user" not in st.session_state or not st.session_state.user.get('is_admin', False):
+        st.warning("Only admins can access this page")
+        return
+
+    st.header("Circulation Desk")
+    # Scanners type the barcode and press Enter, which submits the form; the
+    # field clears itself for the next scan
+    st.subheader("Check Out")
+    borrower = st.text_input("Borrower username", key="desk_borrower")
+    with st.form(key='desk_checkout_form', clear_on_submit=True):
+        barcode = st.text_input("Scan copy barcode", key="desk_checkout_barcode")
+        if st.form_submit_button("Check Out") and barcode.strip():
+            if not borrower.strip():
+                st.warning("Enter the borrower's username first.")
+            else:
+                desk_checkout(borrower.strip(), barcode.strip())
+
+    # Copies checked in at a branch's desk stay at that branch
+    branch_id = selected_branch()
+    st.subheader("Check In")
+    with st.form(key='desk_checkin_form', clear_on_submit=True):
+        barcode = st.text_input("Scan copy barcode", key="desk_checkin_barcode")
+        if st.form_submit_button("Check In") and barcode.strip():
+            desk_checkin(barcode.strip(), branch_id)
+
+    st.subheader("Transfers")
+    if branch_id is None:
+        st.info("Pick this desk's branch in the sidebar to request and receive transfers.")
+        return
+    transfer_book_id = book_picker("Book to bring to this branch", key="transfer_book_select")
+    if transfer_book_id is not None and st.button("Request Transfer", key="request_transfer_button"):
+        if request_transfer(transfer_book_id, branch_id):
+            st.rerun()
+    transfers = get_transfers(branch_id)
+    for direction, action, receive in (('incoming', "Receive", True), ('outgoing', "Cancel", False)):
+        for transfer in transfers[direction]:
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                way = "from" if receive else "to"
+                st.write(f"{transfer['title']} ({transfer['barcode']}) {way} {transfer['branch']}, "
+                         f"requested {transfer['requested_at']}")
+            with col2:
+                if st.button(action, key=f"transfer_{direction}_{transfer['id']}"):
+                    if finish_transfer(transfer['id'], receive):
+                        st.rerun()
+    if not transfers['incoming'] and not transfers['outgoing']:
+        st.info("No copies in transit to or from this branch.")
+
 def review_page():
     if "user" not in st.session_state:
         st.warning("Please login to review books")
         return
 
     st.header("Review Books")
-    books = search_books("")  # Get all books
-    book_id = st.selectbox("Select a book to review", options=[b['book_id'] for b in books], format_func=lambda x: next(b['title'] for b in books if b['book_id'] == x), key="review_book_select")
+    book_id = book_picker("Select a book to review", key="review_book_select")
     rating = st.slider("Rating", 1, 5, 3, key="review_rating")
     comment = st.text_area("Comment", key="review_comment")
     if st.button("Submit Review", key="submit_review_button"):
         add_review(st.session_state.user['user_id'], book_id, rating, comment)
+    saving = pending_events('review')
+    if saving:
+        st.caption(f"{len(saving)} of your reviews are still being saved.")
 
 def book_search_page():
     st.header("Book Search")
     search_query = st.text_input("Search for books (title, author, or ISBN)", key="book_search_query")
     if search_query:
-        results = search_books(search_query)
-        for book in results:
+        # Keep fetched pages across reruns until the query changes
+        search = st.session_state.get('book_search')
+        branch_id = selected_branch()
+        if not search or search['query'] != search_query or search['branch_id'] != branch_id:
+            results = session_cached(search_books, search_query, SEARCH_PAGE_SIZE, None, branch_id)
+            search = {'query': search_query, 'branch_id': branch_id, 'results': results,
+                      'more': len(results) == SEARCH_PAGE_SIZE}
+            st.session_state.book_search = search
+
+        for book in search['results']:
             st.write(f"Title: {book['title']}")
             st.write(f"Author: {book['author']}")
             st.write(f"ISBN: {book['isbn']}")
             st.write(f"Category: {book['category_name']}")
+            if branch_id is not None:
+                st.write(f"Available here: {book['available_quantity']}")
             st.write("---")
 
+        if search['more'] and st.button("Load more", key="book_search_more"):
+            results = search_books(search_query, after=search['results'][-1], branch_id=branch_id)
+            search['results'] = search['results'] + results
+            search['more'] = len(results) == SEARCH_PAGE_SIZE
+            st.rerun()
+
 def report_page():
     if "user" not in st.session_state or not st.session_state.user.get('is_admin', False):
         st.warning("Only admins can access this page")
@@ -663,41 +2064,125 @@ def report_page():
 
     st.header("Library Reports")
 
-    # General Statistics
-    st.subheader("General Statistics")
-    book_stats, user_stats = get_book_stats()
-    if book_stats and user_stats:
-        st.write(f"Total Books: {book_stats['total_books']}")
-        st.write(f"Total Book Quantity: {book_stats['total_quantity']}")
-        st.write(f"Total Users: {user_stats['total_users']}")
+    def render_category_chart(category_stats):
+        category_data = {cat['category']: cat['book_count'] for cat in category_stats}
+        st.bar_chart(category_data)
 
-    # Books by Category
-    st.subheader("Books by Category")
-    category_stats = get_books_by_category()
-    category_data = {cat['category']: cat['book_count'] for cat in category_stats}
-    st.bar_chart(category_data)
+    def render_top_rated(top_books):
+        for book in top_books:
+            st.write(f"{book['title']} - Average Rating: {book['avg_rating']:.2f}")
 
-    # Top Rated Books
-    st.subheader("Top Rated Books")
-    top_books = get_top_rated_books_with_availability()
-    for book in top_books:
-        st.write(f"{book['title']} - Average Rating: {book['avg_rating']:.2f}")
-
-    # Most Borrowed Books
-    st.subheader("Most Borrowed Books")
-    most_borrowed = get_most_borrowed_books()
-    for book in most_borrowed:
-        st.write(f"{book['title']} - Borrowed {book['borrow_count']} times")
-
-    # Overdue Books
-    st.subheader("Overdue Books")
-    overdue_books = get_overdue_books()
-    for book in overdue_books:
-        st.write(f"{book['title']} - Borrowed by {book['username']} on {book['loan_date']}")
+    def render_most_borrowed(most_borrowed):
+        for book in most_borrowed:
+            st.write(f"{book['title']} - Borrowed {book['borrow_count']} times")
+
+    def render_branch_stock(branch_stats):
+        if branch_stats:
+            # A title stocked at several branches counts once per branch, so
+            # the total row leaves titles out
+            totals = {'branch': "All branches", 'titles': "",
+                      'copies': sum(b['copies'] for b in branch_stats),
+                      'available': sum(b['available'] for b in branch_stats)}
+            st.table([{'Branch': b['branch'], 'Titles': b['titles'], 'Copies': b['copies'],
+                       'On the shelf': b['available']} for b in [*branch_stats, totals]])
+
+    def render_overdue(overdue_books):
+        if overdue_books:
+            st.caption(f"As of {overdue_books[0]['refreshed_at']}")
+        for book in overdue_books:
+            st.write(f"{book['title']} - Borrowed by {book['username']} on {book['loan_date']}, "
+                     f"due {book['due_date']} ({book['days_overdue']} days overdue, fine {book['fine']:.2f})")
+
+    # The report sections are independent, so fetch them concurrently and
+    # draw each one as soon as it is ready
+    sections = {}
+    for name, title, render in (
+        ('stats', "General Statistics", render_book_stats),
+        ('branches', "Stock by Branch", render_branch_stock),
+        ('categories', "Books by Category", render_category_chart),
+        ('top_books', "Top Rated Books", render_top_rated),
+        ('most_borrowed', "Most Borrowed Books", render_most_borrowed),
+        ('overdue', "Overdue Books", render_overdue),
+    ):
+        st.subheader(title)
+        placeholder = st.empty()
+        placeholder.caption("Loading...")
+        sections[name] = (placeholder, render)
+
+    for name, result in fetch_concurrently({
+        'stats': (get_book_stats, selected_branch()),
+        'branches': (get_branch_stats,),
+        'categories': (get_books_by_category, selected_branch()),
+        'top_books': (get_top_rated_books_with_availability,),
+        'most_borrowed': (get_most_borrowed_books,),
+        'overdue': (get_overdue_books,),
+    }):
+        placeholder, render = sections[name]
+        with placeholder.container():
+            render(result)
+
+    # Data layer performance
+    st.subheader("Query Performance")
+    metrics = get_query_metrics()
+    if metrics:
+        st.dataframe(metrics, use_container_width=True)
+    else:
+        st.info("No queries recorded yet.")
+    pool_stats = get_pool_stats()
+    st.write(f"Connections acquired: {pool_stats['acquired']}, waits: {pool_stats['waits']}, "
+             f"timeouts: {pool_stats['timeouts']}, max wait: {pool_stats['max_wait'] * 1000:.0f} ms")
+    for name, stats in get_query_cache_stats().items():
+        st.write(f"Cache {name}: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries")
+    st.write(f"Queries avoided by this session's cache: {get_session_cache_stats()['avoided_queries']}")
+    if storage.REPLICAS:
+        replica_status = get_replica_status()
+        replica_pool = replica_status['pool']
+        st.write(f"Replica reads: {replica_status['replica_reads']}, served by the primary instead: "
+                 f"{replica_status['fallbacks']} with no replica caught up, "
+                 f"{replica_status['spills']} with the replica pool busy")
+        st.write(f"Replica connections acquired: {replica_pool['acquired']}, "
+                 f"recycled: {replica_pool['recycled']}")
+        for replica, status in replica_status['replicas'].items():
+            lag = f"{status['lag_s']:.1f}s behind" if status['lag_s'] is not None else f"unavailable ({status['error']})"
+            st.write(f"Replica {replica}: {lag}")
+        if replica_status['heartbeat_error']:
+            st.warning(f"Replica lag cannot be measured: {replica_status['heartbeat_error']}")
+    cover_stats = get_cover_cache().get_stats()
+    st.write(f"Cover cache: {cover_stats['hits']} hits, {cover_stats['misses']} misses, "
+             f"{cover_stats['failures']} failed fetches, {cover_stats['size_bytes'] / 1024 / 1024:.1f} of "
+             f"{cover_stats['max_bytes'] / 1024 / 1024:.0f} MB used")
+    if WRITE_BEHIND:
+        log_stats = get_event_log().get_stats()
+        st.write(f"Event log: {log_stats['pending']} pending, {log_stats['applied']} applied in "
+                 f"{log_stats['batches']} batches, {log_stats['appended']} appended with "
+                 f"{log_stats['fsyncs']} fsyncs, {log_stats['rejected']} rejected")
+    st.download_button("Download Prometheus metrics", get_prometheus_metrics(),
+                       file_name="library_metrics.prom", mime="text/plain", key="download_metrics")
+
+def inbox_page():
+    if "user" not in st.session_state:
+        st.warning("Please login to see your notifications")
+        return
+
+    st.header("Inbox")
+    user_id = st.session_state.user['user_id']
+    notifications = get_notifications(user_id)
+    if not notifications:
+        st.info("No notifications yet.")
+        return
+    for notification in notifications:
+        marker = "" if notification['read_at'] else "**New** - "
+        st.write(f"{marker}{notification['created_at']}: {notification['message']}")
+    if any(n['read_at'] is None for n in notifications):
+        if st.button("Mark all as read", key="mark_notifications_read"):
+            mark_notifications_read(user_id)
+            st.rerun()
 
 def logout():
-    if "user" in st.session_state:
-        del st.session_state.user
+    # Everything the session holds belongs to the user leaving: cached reads,
+    # write-behind events not yet applied, the last write time, searches,
+    # paging and form inputs. The next login starts from nothing.
+    st.session_state.clear()
     st.success("Logged out successfully!")
     st.rerun()
 
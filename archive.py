@@ -0,0 +1,151 @@
+from mysql.connector import Error
+from datetime import date, timedelta
+import argparse
+import os
+import time
+from storage import connect, ITEM_LOAN_COLUMNS, REVIEW_COLUMNS
+
+# Closed loans and reviews older than these horizons move to the archive
+# tables, which keeps the hot tables bounded by recent activity. book_stats
+# counters are unaffected; the loan_history and review_history views read
+# both sides when the full history is needed.
+LOAN_HORIZON_DAYS = int(os.getenv('ARCHIVE_LOANS_AFTER_DAYS', 365))
+REVIEW_HORIZON_DAYS = int(os.getenv('ARCHIVE_REVIEWS_AFTER_DAYS', 730))
+# Idempotency keys only matter while their event could still be replayed from
+# the write-behind log, which is checkpointed within seconds
+EVENT_KEY_DAYS = 7
+# Finished holds and read notifications are kept this long for the inbox
+HOLD_HISTORY_DAYS = 90
+BATCH_SIZE = 1000
+
+ARCHIVES = {
+    'loans': (ITEM_LOAN_COLUMNS, "return_date IS NOT NULL AND return_date < %s"),
+    'reviews': (REVIEW_COLUMNS, "review_date < %s"),
+}
+
+def move_batch(cursor, table, cutoff, batch_size):
+    columns, condition = ARCHIVES[table]
+    cursor.execute(f"SELECT id FROM {table} WHERE {condition} LIMIT %s", (cutoff, batch_size))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"INSERT INTO {table}_archive ({columns}) SELECT {columns} FROM {table} WHERE id IN ({placeholders})",
+                   ids)
+    cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+def archive_table(connection, table, cutoff, batch_size=BATCH_SIZE):
+    cursor = connection.cursor()
+    moved = 0
+    start = time.perf_counter()
+    # Each batch is its own short transaction, so the app's writes to the
+    # hot table are never blocked for long
+    while True:
+        count = move_batch(cursor, table, cutoff, batch_size)
+        connection.commit()
+        if not count:
+            break
+        moved += count
+        print(f"{moved} {table} rows archived ({moved / (time.perf_counter() - start):.0f} rows/s)")
+    print(f"Archived {moved} {table} rows older than {cutoff}")
+    return moved
+
+def prune_event_keys(connection, days=EVENT_KEY_DAYS):
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM applied_events WHERE applied_at < %s", (date.today() - timedelta(days=days),))
+    connection.commit()
+    print(f"Pruned {cursor.rowcount} write-behind event keys older than {days} days")
+
+def prune_hold_history(connection, days=HOLD_HISTORY_DAYS):
+    cutoff = date.today() - timedelta(days=days)
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM holds WHERE status NOT IN ('waiting', 'ready') AND placed_at < %s", (cutoff,))
+    holds = cursor.rowcount
+    cursor.execute("DELETE FROM notifications WHERE read_at IS NOT NULL AND read_at < %s", (cutoff,))
+    connection.commit()
+    print(f"Pruned {holds} finished holds and {cursor.rowcount} read notifications older than {days} days")
+
+def archive(loan_days=LOAN_HORIZON_DAYS, review_days=REVIEW_HORIZON_DAYS, batch_size=BATCH_SIZE):
+    try:
+        connection = connect('library_management')
+        archive_table(connection, 'loans', date.today() - timedelta(days=loan_days), batch_size)
+        archive_table(connection, 'reviews', date.today() - timedelta(days=review_days), batch_size)
+        prune_event_keys(connection)
+        prune_hold_history(connection)
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+def status():
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        for table in ARCHIVES:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            hot = cursor.fetchone()[0]
+            cursor.execute(f"SELECT COUNT(*) FROM {table}_archive")
+            archived = cursor.fetchone()[0]
+            print(f"{table}: {hot} hot rows, {archived} archived rows")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+def parquet_schema(pa, table):
+    if table == 'loans':
+        return pa.schema([('id', pa.int64()), ('user_id', pa.int64()), ('book_id', pa.int64()),
+                          ('loan_date', pa.date32()), ('due_date', pa.date32()), ('return_date', pa.date32()),
+                          ('item_id', pa.int64())])
+    return pa.schema([('id', pa.int64()), ('user_id', pa.int64()), ('book_id', pa.int64()),
+                      ('rating', pa.int32()), ('comment', pa.string()), ('review_date', pa.date32())])
+
+def export_parquet(table, path, batch_size=BATCH_SIZE):
+    # Columnar copy of an archive table for offline analysis, written one
+    # batch at a time
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Error: exporting to Parquet requires pyarrow (pip install pyarrow)")
+        return
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor(dictionary=True)
+        columns = ARCHIVES[table][0]
+        schema = parquet_schema(pa, table)
+        exported, last_id = 0, 0
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while True:
+                cursor.execute(f"SELECT {columns} FROM {table}_archive WHERE id > %s ORDER BY id LIMIT %s",
+                               (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                exported += len(rows)
+        print(f"Exported {exported} archived {table} rows to {path}")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old loans and reviews into the archive tables")
+    parser.add_argument('--loan-days', type=int, default=LOAN_HORIZON_DAYS,
+                        help="archive loans returned more than this many days ago")
+    parser.add_argument('--review-days', type=int, default=REVIEW_HORIZON_DAYS,
+                        help="archive reviews written more than this many days ago")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--status', action='store_true', help="print hot and archived row counts")
+    parser.add_argument('--export', nargs=2, metavar=('TABLE', 'PATH'),
+                        help="write the archived rows of TABLE (loans or reviews) to a Parquet file")
+    args = parser.parse_args()
+    if args.status:
+        status()
+    elif args.export:
+        table, path = args.export
+        if table not in ARCHIVES:
+            parser.error("TABLE must be loans or reviews")
+        export_parquet(table, path, args.batch_size)
+    else:
+        archive(args.loan_days, args.review_days, args.batch_size)
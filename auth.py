@@ -0,0 +1,14 @@
+import bcrypt
+
+# Password hashing runs in worker processes, so these stay plain top-level
+# functions that can be pickled by reference.
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def verify_password(plain_password, hashed_password):
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def hash_rounds(hashed_password):
+    # bcrypt hashes look like $2b$<cost>$<salt and digest>
+    return int(hashed_password.split('$')[2])
@@ -0,0 +1,529 @@
+from streamlit.runtime.scriptrunner import ScriptRunContext, add_script_run_ctx
+from streamlit.runtime.state import SafeSessionState, SessionState
+from streamlit.runtime.memory_uploaded_file_manager import MemoryUploadedFileManager
+from mysql.connector import Error
+from contextlib import redirect_stdout
+from datetime import date, datetime
+import argparse
+import functools
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import storage
+from synthetic import PASSWORD, USER_PREFIX
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def headless_session(thread=None):
+    # st.cache_resource and st.session_state only work inside a script run, so
+    # benchmark threads get a session of their own whose output is discarded
+    ctx = ScriptRunContext(
+        session_id=f"benchmark-{threading.get_ident()}",
+        _enqueue=lambda msg: None,
+        query_string="",
+        session_state=SafeSessionState(SessionState()),
+        uploaded_file_mgr=MemoryUploadedFileManager("/_stcore/upload_file"),
+        page_script_hash="",
+        user_info={"email": None},
+    )
+    add_script_run_ctx(thread or threading.current_thread(), ctx)
+    return ctx
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<40} n={len(timings):<6} mean={statistics.mean(timings) * 1000:9.3f} ms  "
+          f"p50={statistics.median(timings) * 1000:9.3f} ms  p95={p95 * 1000:9.3f} ms")
+    return {'name': name, 'n': len(timings), 'mean_ms': statistics.mean(timings) * 1000,
+            'p50_ms': statistics.median(timings) * 1000, 'p95_ms': p95 * 1000}
+
+def timed_each(func, arg_sets):
+    timings = []
+    # The app logs progress with print(); keep it out of the report
+    with redirect_stdout(io.StringIO()):
+        for args in arg_sets:
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def timed(func, *args, repeat=1):
+    return timed_each(func, [args] * repeat)
+
+def import_time(module):
+    # Fresh interpreter each time so nothing is already imported
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f"import {module}"], cwd=PROJECT_DIR, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def benchmark_startup(repeat):
+    results = []
+    print("Startup")
+    streamlit_imports = [import_time('streamlit') for _ in range(max(repeat // 20, 3))]
+    app_imports = [import_time('app') for _ in range(max(repeat // 20, 3))]
+    results.append(summarize("import streamlit (baseline)", streamlit_imports))
+    results.append(summarize("import app", app_imports))
+
+    import app
+    state = app.get_startup_state()
+    app.ensure_database_ready()
+    print(f"  first startup check: {state['duration'] * 1000:.1f} ms, ready={state['ready']}")
+    # What every rerun of every session paid before the startup phase,
+    # against what a rerun pays now
+    results.append(summarize("rerun: full schema check (before)", timed(app.ensure_database_exists, repeat=repeat)))
+    results.append(summarize("rerun: readiness check (now)", timed(app.ensure_database_ready, repeat=repeat)))
+    return results
+
+BENCHMARK_COMMENT = "benchmark review"
+APPEND_THREADS = 4
+
+def remove_benchmark_reviews(app, book_id):
+    with app.get_cursor() as cursor:
+        cursor.execute("DELETE FROM reviews WHERE book_id = %s AND comment = %s", (book_id, BENCHMARK_COMMENT))
+        removed = cursor.rowcount
+        cursor.execute("""
+            UPDATE book_stats SET review_count = review_count - %s, rating_sum = rating_sum - %s
+            WHERE book_id = %s
+        """, (removed, removed * 3, book_id))
+    app.invalidate_queries(app.get_top_rated_books_with_availability)
+
+def benchmark_write_behind(repeat):
+    # Reviews written with a commit each, against the same reviews appended
+    # to the event log and group-committed by the worker. The benchmark
+    # reviews are deleted again afterwards.
+    import app
+    import eventlog
+    print("Write-behind")
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT MIN(user_id) FROM users")
+        user_id = cursor.fetchone()[0]
+        cursor.execute("SELECT MIN(book_id) FROM books")
+        book_id = cursor.fetchone()[0]
+    if user_id is None or book_id is None:
+        print("  skipped: needs at least one user and one book")
+        return []
+    payload = {'user_id': user_id, 'book_id': book_id, 'rating': 3, 'comment': BENCHMARK_COMMENT,
+               'review_date': date.today().isoformat()}
+    results = []
+    try:
+        app.WRITE_BEHIND = False
+        per_row = timed(app.add_review, user_id, book_id, 3, BENCHMARK_COMMENT, repeat=repeat)
+        results.append(summarize("review: commit per row", per_row))
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = eventlog.EventLog(os.path.join(directory, 'events.log'), app.apply_events)
+            appends = timed(lambda: log.append('review', **payload), repeat=repeat)
+            results.append(summarize("review: event log append", appends))
+            # Concurrent sessions share fsyncs
+            fsyncs = log.get_stats()['fsyncs']
+            def append_many(count):
+                for _ in range(count):
+                    log.append('review', **payload)
+
+            threads = [threading.Thread(target=append_many, args=(repeat // APPEND_THREADS,))
+                       for _ in range(APPEND_THREADS)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            concurrent_time = time.perf_counter() - start
+            concurrent_appends = repeat // APPEND_THREADS * APPEND_THREADS
+            print(f"  {APPEND_THREADS} appending threads: {concurrent_appends / concurrent_time:.0f} events/s, "
+                  f"{log.get_stats()['fsyncs'] - fsyncs} fsyncs for {concurrent_appends} events")
+
+            pending = log.get_stats()['pending']
+            flush_time = min(timed(log.flush))
+            log.close()
+            stats = log.get_stats()
+        print(f"  per-row commits: {repeat / sum(per_row):.0f} reviews/s; "
+              f"group commit: {pending / flush_time:.0f} reviews/s in {stats['batches']} batches")
+        results.append({'name': "review: group commit", 'n': pending, 'batches': stats['batches'],
+                        'events_per_s': pending / flush_time, 'per_row_events_per_s': repeat / sum(per_row)})
+    finally:
+        remove_benchmark_reviews(app, book_id)
+    return results
+
+def load_sample(app, size=1000):
+    # Ids and search inputs drawn from the loaded library; writes and logins
+    # only ever use the synthetic users
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT user_id, username FROM users WHERE username LIKE %s ORDER BY user_id LIMIT %s",
+                       (f"{USER_PREFIX}%", size))
+        users = cursor.fetchall()
+        cursor.execute("SELECT book_id, title, isbn FROM books ORDER BY book_id LIMIT %s", (size,))
+        books = cursor.fetchall()
+        cursor.execute("SELECT category_id FROM categories")
+        categories = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT branch_id FROM branches")
+        branches = [row[0] for row in cursor.fetchall()]
+    return {
+        'user_ids': [row[0] for row in users],
+        'usernames': [row[1] for row in users],
+        'book_ids': [row[0] for row in books],
+        'terms': sorted({word for row in books for word in row[1].split() if len(word) > 3}),
+        'prefixes': sorted({row[1][:2] for row in books}),
+        'isbns': [row[2] for row in books if row[2]],
+        'categories': categories,
+        'branches': branches,
+    }
+
+def benchmark_data(repeat):
+    # Every data function on its own, with inputs drawn from the library.
+    # Shared-cache reads are timed through the query, not the cache.
+    import app
+    print("Data functions")
+    sample = load_sample(app)
+    if not sample['book_ids'] or not sample['user_ids']:
+        print("  skipped: load a synthetic library first (python synthetic.py)")
+        return []
+    rng = random.Random(0)
+    calls = {
+        'get_book_stats': (app.get_book_stats.__wrapped__, lambda: ()),
+        'get_book_stats (branch)': (app.get_book_stats.__wrapped__, lambda: (rng.choice(sample['branches']),)),
+        'get_books_by_category': (app.get_books_by_category.__wrapped__, lambda: ()),
+        'get_books_by_category (branch)': (app.get_books_by_category.__wrapped__,
+                                           lambda: (rng.choice(sample['branches']),)),
+        'get_branch_stats': (app.get_branch_stats.__wrapped__, lambda: ()),
+        'get_top_rated_books_with_availability': (app.get_top_rated_books_with_availability.__wrapped__, lambda: ()),
+        'get_most_borrowed_books': (app.get_most_borrowed_books.__wrapped__, lambda: ()),
+        'get_overdue_books': (app.get_overdue_books.__wrapped__, lambda: ()),
+        'get_categories': (app.get_categories, lambda: ()),
+        'get_borrowed_books': (app.get_borrowed_books, lambda: (rng.choice(sample['user_ids']),)),
+        'get_available_books': (app.get_available_books, lambda: ()),
+        'get_available_books (category)': (app.get_available_books, lambda: (rng.choice(sample['categories']),)),
+        'get_available_books (author)': (app.get_available_books, lambda: (None, None, rng.choice(sample['prefixes']))),
+        'get_available_books (branch)': (app.get_available_books,
+                                         lambda: (None, None, None, rng.choice(sample['branches']))),
+        'search_books (words)': (app.search_books, lambda: (rng.choice(sample['terms']),)),
+        'search_books (words, branch)': (app.search_books, lambda: (rng.choice(sample['terms']), app.SEARCH_PAGE_SIZE,
+                                                                    None, rng.choice(sample['branches']))),
+        'search_books (isbn)': (app.search_books, lambda: (rng.choice(sample['isbns']),)),
+        'list_books': (app.list_books, lambda: (rng.choice(sample['prefixes']),)),
+        'get_book': (app.get_book, lambda: (rng.choice(sample['book_ids']),)),
+        'get_book_recommendations': (app.get_book_recommendations, lambda: (rng.choice(sample['user_ids']),)),
+    }
+    results = []
+    for name, (func, make_args) in calls.items():
+        results.append(summarize(name, timed_each(func, [make_args() for _ in range(repeat)])))
+
+    # Password hashing dominates logins, so fewer of them. The first login
+    # starts the hashing workers and is left out.
+    logins = [(rng.choice(sample['usernames']), PASSWORD) for _ in range(max(repeat // 20, 5) + 1)]
+    timed_each(app.authenticate_user, logins[:1])
+    logins = logins[1:]
+    results.append(summarize("authenticate_user", timed_each(app.authenticate_user, logins)))
+
+    def borrow_and_return(user_id, book_id):
+        if app.borrow_book(user_id, book_id):
+            app.return_book(user_id, book_id)
+
+    available = [book['book_id'] for book in app.get_available_books(limit=100)]
+    if available:
+        pairs = [(rng.choice(sample['user_ids']), rng.choice(available)) for _ in range(repeat)]
+        results.append(summarize("borrow_book + return_book", timed_each(borrow_and_return, pairs)))
+    return results
+
+SESSION_MIX = [('search', 40), ('browse', 25), ('borrow', 15), ('report', 10), ('recommendations', 10)]
+SESSIONS = 8
+
+def run_session(app, sample, seed, actions, timings, lock):
+    # One simulated user: log in, then a weighted mix of page actions
+    headless_session()
+    rng = random.Random(seed)
+    index = rng.randrange(len(sample['user_ids']))
+    user_id = sample['user_ids'][index]
+    own = {name: [] for name, _ in SESSION_MIX + [('login', 0)]}
+
+    def timed_action(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        own[name].append(time.perf_counter() - start)
+        return result
+
+    timed_action('login', app.authenticate_user, sample['usernames'][index], PASSWORD)
+    for action in rng.choices([name for name, _ in SESSION_MIX], [weight for _, weight in SESSION_MIX], k=actions):
+        if action == 'search':
+            timed_action(action, app.search_books, rng.choice(sample['terms']))
+        elif action == 'browse':
+            timed_action(action, app.get_available_books, rng.choice([None, *sample['categories']]))
+        elif action == 'borrow':
+            available = app.get_available_books(rng.choice(sample['categories']))
+            if available:
+                book_id = rng.choice(available)['book_id']
+                if timed_action(action, app.borrow_book, user_id, book_id):
+                    app.return_book(user_id, book_id)
+        elif action == 'report':
+            timed_action(action, lambda: dict(app.fetch_concurrently({
+                'stats': (app.get_book_stats,),
+                'categories': (app.get_books_by_category,),
+                'top_books': (app.get_top_rated_books_with_availability,),
+                'most_borrowed': (app.get_most_borrowed_books,),
+                'overdue': (app.get_overdue_books,),
+            })))
+        else:
+            timed_action(action, app.session_cached, app.get_book_recommendations, user_id)
+    with lock:
+        for name, values in own.items():
+            timings.setdefault(name, []).extend(values)
+
+def benchmark_sessions(repeat, sessions=SESSIONS):
+    # Concurrent simulated sessions sharing the app's pool and caches
+    import app
+    print(f"Concurrent sessions ({sessions})")
+    sample = load_sample(app)
+    if not sample['user_ids'] or not sample['terms']:
+        print("  skipped: load a synthetic library first (python synthetic.py)")
+        return []
+    # Start the hashing workers before the clock does
+    timed(app.authenticate_user, sample['usernames'][0], PASSWORD)
+    timings, lock = {}, threading.Lock()
+    threads = [threading.Thread(target=run_session, args=(app, sample, seed, repeat // sessions, timings, lock))
+               for seed in range(sessions)]
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    results = [summarize(f"session: {name}", values) for name, values in timings.items() if values]
+    actions = sum(len(values) for values in timings.values())
+    print(f"  {actions} actions in {elapsed:.1f}s: {actions / elapsed:.1f} actions/s")
+    results.append({'name': "sessions: throughput", 'sessions': sessions, 'actions': actions,
+                    'ops_per_s': actions / elapsed})
+    if storage.REPLICAS:
+        routing = app.get_replica_status()
+        print(f"  {routing['replica_reads']} reads served by replicas, {routing['fallbacks']} by the primary "
+              f"with no replica caught up, {routing['spills']} with the replica pool busy")
+        results.append({'name': "sessions: replica routing", 'replica_reads': routing['replica_reads'],
+                        'fallbacks': routing['fallbacks'], 'spills': routing['spills']})
+    return results
+
+OVERSELL_SESSIONS = 1000
+
+def benchmark_oversell(repeat, sessions=OVERSELL_SESSIONS):
+    # Many sessions borrow the last copies of one book at the same moment;
+    # never may more loans open than there were copies
+    import app
+    print("Oversell stress test")
+    sample = load_sample(app, size=sessions)
+    if len(sample['user_ids']) < 2:
+        print("  skipped: load a synthetic library first (python synthetic.py)")
+        return []
+    write_behind, app.WRITE_BEHIND = app.WRITE_BEHIND, False
+    timings, checks = [], []
+    try:
+        for round_number in range(max(repeat // 100, 1)):
+            with app.get_cursor() as cursor:
+                cursor.execute("SELECT book_id, available_quantity FROM books WHERE available_quantity > 0 "
+                               "ORDER BY available_quantity DESC, book_id LIMIT 1 OFFSET %s", (round_number,))
+                row = cursor.fetchone()
+            if row is None:
+                break
+            book_id, copies = row
+            borrowers = sample['user_ids']
+            barrier = threading.Barrier(len(borrowers))
+            borrowed, lock = [], threading.Lock()
+
+            def borrow(user_id):
+                headless_session()
+                barrier.wait()
+                start = time.perf_counter()
+                ok = app.borrow_book(user_id, book_id)
+                with lock:
+                    timings.append(time.perf_counter() - start)
+                    if ok:
+                        borrowed.append(user_id)
+
+            threads = [threading.Thread(target=borrow, args=(user_id,)) for user_id in borrowers]
+            with redirect_stdout(io.StringIO()):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            with app.get_cursor() as cursor:
+                cursor.execute("SELECT available_quantity FROM books WHERE book_id = %s", (book_id,))
+                left = cursor.fetchone()[0]
+            ok = len(borrowed) <= copies and left == copies - len(borrowed)
+            print(f"  book {book_id}: {len(borrowers)} sessions, {copies} copies, {len(borrowed)} borrowed, "
+                  f"{left} left - {'ok' if ok else 'OVERSOLD'}")
+            checks.append(ok)
+            with redirect_stdout(io.StringIO()):
+                for user_id in borrowed:
+                    app.return_book(user_id, book_id)
+    finally:
+        app.WRITE_BEHIND = write_behind
+    if not timings:
+        return []
+    return [summarize("borrow_book under contention", timings),
+            {'name': "oversell check", 'rounds': len(checks), 'ok': all(checks)}]
+
+HOLD_QUEUE = 2000
+
+def benchmark_holds(repeat, queue_length=HOLD_QUEUE):
+    # Returns of a title with a long hold queue: each return hands the copy
+    # to the head of the queue, who then borrows it
+    import app
+    print("Hold queue")
+    sample = load_sample(app, size=queue_length + 10)
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT book_id, available_quantity FROM books WHERE available_quantity > 0 "
+                       "ORDER BY available_quantity, book_id LIMIT 1")
+        row = cursor.fetchone()
+    if row is None or len(sample['user_ids']) <= row[1] + 1:
+        print("  skipped: load a synthetic library first (python synthetic.py)")
+        return []
+    book_id, copies = row
+    borrowers, waiting = sample['user_ids'][:copies], sample['user_ids'][copies:]
+    write_behind, app.WRITE_BEHIND = app.WRITE_BEHIND, False
+    returns, claims = [], []
+    try:
+        with redirect_stdout(io.StringIO()):
+            for user_id in borrowers:
+                app.borrow_book(user_id, book_id)
+            placed = sum(app.place_hold(user_id, book_id) for user_id in waiting)
+        print(f"  book {book_id}: {copies} copies, {placed} holds queued")
+        with redirect_stdout(io.StringIO()):
+            for holder in waiting[:min(repeat, placed)]:
+                start = time.perf_counter()
+                app.return_book(borrowers.pop(0), book_id)
+                returns.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                if app.borrow_book(holder, book_id):
+                    borrowers.append(holder)
+                claims.append(time.perf_counter() - start)
+    finally:
+        # Waiting holds go first, so the copies of ready holds and returned
+        # loans end up back on the shelf
+        with app.get_cursor() as cursor:
+            cursor.execute("UPDATE holds SET status = 'cancelled' WHERE book_id = %s AND status = 'waiting'", (book_id,))
+            cursor.execute("SELECT id, user_id FROM holds WHERE book_id = %s AND status = 'ready'", (book_id,))
+            ready = cursor.fetchall()
+        with redirect_stdout(io.StringIO()):
+            for hold_id, user_id in ready:
+                app.cancel_hold(user_id, hold_id)
+            for user_id in borrowers:
+                app.return_book(user_id, book_id)
+        app.WRITE_BEHIND = write_behind
+    return [summarize("return_book allocating to a hold", returns),
+            summarize("borrow_book claiming a hold", claims)]
+
+def benchmark_desk(repeat):
+    # Barcode scans at the circulation desk: each copy is checked out to a
+    # user and checked straight back in
+    import app
+    print("Circulation desk")
+    sample = load_sample(app)
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT barcode FROM items WHERE status = 'available' ORDER BY item_id LIMIT %s", (repeat,))
+        barcodes = [row[0] for row in cursor.fetchall()]
+    if not barcodes or not sample['usernames']:
+        print("  skipped: load a synthetic library first (python synthetic.py)")
+        return []
+    rng = random.Random(0)
+    scans = [(rng.choice(sample['usernames']), barcode) for barcode in barcodes]
+    start = time.perf_counter()
+    lends = timed_each(app.desk_checkout, scans)
+    returns = timed_each(app.desk_checkin, [(barcode,) for barcode in barcodes])
+    elapsed = time.perf_counter() - start
+    print(f"  {len(lends) + len(returns)} scans in {elapsed:.1f}s: {(len(lends) + len(returns)) / elapsed * 60:.0f} scans/min")
+    return [summarize("desk_checkout (scan)", lends),
+            summarize("desk_checkin (scan)", returns),
+            {'name': "desk: throughput", 'scans': len(lends) + len(returns),
+             'ops_per_s': (len(lends) + len(returns)) / elapsed}]
+
+SCENARIOS = {
+    'startup': benchmark_startup,
+    'write_behind': benchmark_write_behind,
+    'data': benchmark_data,
+    'sessions': benchmark_sessions,
+    'oversell': benchmark_oversell,
+    'holds': benchmark_holds,
+    'desk': benchmark_desk,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def library_size():
+    # Recorded with the results, so runs are only compared like for like
+    try:
+        connection = storage.connect('library_management')
+        cursor = connection.cursor()
+        size = {}
+        for table in ('books', 'branches', 'items', 'users', 'loans', 'reviews'):
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            size[table] = cursor.fetchone()[0]
+        connection.close()
+        return size
+    except Error:
+        return None
+
+def compare(baseline, results, threshold):
+    # Flags measurements that got slower than the baseline by more than
+    # threshold: a higher p50 latency, or lower throughput
+    print(f"Compared with {baseline['commit']} ({baseline['created_at']}, {baseline['library']})")
+    previous = {(scenario, row['name']): row for scenario, rows in baseline['results'].items() for row in rows}
+    regressions = 0
+    for scenario, rows in results.items():
+        for row in rows:
+            old = previous.get((scenario, row['name']))
+            if old is None:
+                continue
+            if 'p50_ms' in row:
+                before, after, unit = old['p50_ms'], row['p50_ms'], "ms p50"
+                change = after / before - 1 if before else 0
+            elif 'ops_per_s' in row:
+                before, after, unit = old['ops_per_s'], row['ops_per_s'], "ops/s"
+                change = before / after - 1 if after else 0
+            else:
+                continue
+            regressed = change > threshold
+            regressions += regressed
+            print(f"{row['name']:<40} {before:10.3f} -> {after:10.3f} {unit:<7} {change:+7.1%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the library app against the configured database")
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run: {', '.join(SCENARIOS)} (default all)")
+    parser.add_argument('--repeat', type=int, default=200, help="iterations per measurement")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare with results saved by --output")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    parser.add_argument('--sessions', type=int, default=SESSIONS, help="concurrent sessions in the sessions scenario")
+    parser.add_argument('--oversell-sessions', type=int, default=OVERSELL_SESSIONS,
+                        help="sessions borrowing the same book at once in the oversell scenario")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    SCENARIOS['sessions'] = functools.partial(benchmark_sessions, sessions=args.sessions)
+    SCENARIOS['oversell'] = functools.partial(benchmark_oversell, sessions=args.oversell_sessions)
+    headless_session()
+    results = {scenario: SCENARIOS[scenario](args.repeat) for scenario in args.scenarios or SCENARIOS}
+    run = {'commit': git_commit(), 'created_at': datetime.now().isoformat(timespec='seconds'),
+           'backend': storage.BACKEND, 'library': library_size(), 'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
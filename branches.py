@@ -0,0 +1,69 @@
+from datetime import datetime
+import holds
+import items
+
+# Branches and the transfers that move copies between them. A branch asks
+# for a title it has no copy of on the shelf; a copy is taken off the shelf
+# of the branch with the most of them and stays in transit, out of every
+# branch's available count, until the requesting branch receives it. The
+# received copy then belongs to that branch and goes to its hold queue or
+# shelf like a returned one.
+#
+# Transfer status: in_transit -> received, or cancelled.
+
+def add_branch(cursor, name):
+    cursor.execute("INSERT INTO branches (name) VALUES (%s)", (name,))
+    return cursor.lastrowid
+
+def request_transfer(cursor, book_id, to_branch_id, now=None):
+    # Returns 'requested', or why not: 'missing', 'on_shelf' (the branch has
+    # a copy already) or 'none' (no other branch has one on the shelf)
+    if holds.lock_book(cursor, book_id) is None:
+        return 'missing'
+    cursor.execute("SELECT available_quantity FROM branch_stock WHERE branch_id = %s AND book_id = %s",
+                   (to_branch_id, book_id))
+    row = cursor.fetchone()
+    if row and row[0] > 0:
+        return 'on_shelf'
+    cursor.execute("""
+        SELECT branch_id FROM branch_stock
+        WHERE book_id = %s AND branch_id <> %s AND available_quantity > 0
+        ORDER BY available_quantity DESC, branch_id
+        LIMIT 1
+    """, (book_id, to_branch_id))
+    row = cursor.fetchone()
+    if row is None:
+        return 'none'
+    item_id = items.take_copy(cursor, book_id, branch_id=row[0], status='transit')
+    if item_id is None:
+        return 'none'
+    cursor.execute("""
+        INSERT INTO transfers (item_id, book_id, from_branch_id, to_branch_id, status, requested_at)
+        VALUES (%s, %s, %s, %s, 'in_transit', %s)
+    """, (item_id, book_id, row[0], to_branch_id, now or datetime.now().replace(microsecond=0)))
+    return 'requested'
+
+def finish_transfer(cursor, transfer_id, status, now=None):
+    # Receiving rehomes the copy at the destination; cancelling leaves it
+    # where it was. Either way it is free again.
+    cursor.execute("SELECT item_id, book_id, to_branch_id FROM transfers WHERE id = %s AND status = 'in_transit'",
+                   (transfer_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    item_id, book_id, to_branch_id = row
+    holds.lock_book(cursor, book_id)
+    cursor.execute("UPDATE transfers SET status = %s, finished_at = %s WHERE id = %s AND status = 'in_transit'",
+                   (status, now or datetime.now().replace(microsecond=0), transfer_id))
+    if cursor.rowcount == 0:
+        return False
+    if status == 'received':
+        items.move_copy(cursor, book_id, item_id, to_branch_id)
+    holds.release_copy(cursor, book_id, item_id, now)
+    return True
+
+def receive_transfer(cursor, transfer_id, now=None):
+    return finish_transfer(cursor, transfer_id, 'received', now)
+
+def cancel_transfer(cursor, transfer_id, now=None):
+    return finish_transfer(cursor, transfer_id, 'cancelled', now)
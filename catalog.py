@@ -0,0 +1,187 @@
+from mysql.connector import Error
+import argparse
+import csv
+import json
+import sys
+import time
+import items
+import storage
+from storage import connect
+
+BATCH_SIZE = 1000
+FIELDS = ['title', 'author', 'isbn', 'publication_year', 'genre', 'description', 'quantity', 'category', 'cover_image']
+
+def normalize_isbn(isbn):
+    return (isbn or '').replace('-', '').replace(' ', '').upper()
+
+def is_valid_isbn(isbn):
+    if len(isbn) == 10 and isbn[:9].isdigit() and (isbn[9].isdigit() or isbn[9] == 'X'):
+        digits = [10 if c == 'X' else int(c) for c in isbn]
+        return sum((10 - i) * d for i, d in enumerate(digits)) % 11 == 0
+    if len(isbn) == 13 and isbn.isdigit():
+        return sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(isbn)) % 10 == 0
+    return False
+
+def read_records(path):
+    # Streams records one at a time so feeds of any size fit in memory
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+def load_category_map(cursor):
+    cursor.execute("SELECT category_id, name FROM categories")
+    return {name.lower(): category_id for category_id, name in cursor.fetchall()}
+
+def resolve_category(cursor, categories, name):
+    name = (name or '').strip()
+    if not name:
+        return None
+    if name.lower() not in categories:
+        cursor.execute("INSERT INTO categories (name) VALUES (%s)", (name,))
+        categories[name.lower()] = cursor.lastrowid
+    return categories[name.lower()]
+
+def to_row(record, cursor, categories):
+    isbn = normalize_isbn(record.get('isbn'))
+    if not is_valid_isbn(isbn):
+        raise ValueError(f"invalid ISBN {record.get('isbn')!r}")
+    title = (record.get('title') or '').strip()
+    author = (record.get('author') or '').strip()
+    if not title or not author:
+        raise ValueError("title and author are required")
+    # An empty field means one copy, but an explicit 0 is kept
+    quantity = record.get('quantity')
+    quantity = 1 if quantity is None or str(quantity).strip() == '' else int(quantity)
+    if quantity < 0:
+        raise ValueError("quantity must not be negative")
+    if quantity > items.MAX_COPIES:
+        raise ValueError(f"quantity must not be over {items.MAX_COPIES}")
+    year = record.get('publication_year')
+    return (title, author, isbn, int(year) if year else None, record.get('genre') or None,
+            record.get('description') or None, quantity, quantity,
+            resolve_category(cursor, categories, record.get('category')), record.get('cover_image') or None)
+
+def sync_copies(cursor, isbns):
+    # New titles get their copies in one batch; a changed quantity adds or
+    # withdraws copies and recounts the counters the upsert adjusted
+    placeholders = ', '.join(['%s'] * len(isbns))
+    cursor.execute(f"""
+        SELECT b.book_id, b.quantity, COUNT(i.item_id),
+               COALESCE(SUM(CASE WHEN i.status <> 'withdrawn' THEN 1 ELSE 0 END), 0)
+        FROM books b
+        LEFT JOIN items i ON i.book_id = b.book_id
+        WHERE b.isbn IN ({placeholders})
+        GROUP BY b.book_id, b.quantity
+    """, isbns)
+    new_books, new_copies = [], []
+    for book_id, quantity, numbered, copies in cursor.fetchall():
+        if numbered == 0:
+            new_books.append(book_id)
+            new_copies += [(book_id, items.copy_barcode(book_id, n), items.DEFAULT_BRANCH)
+                           for n in range(1, quantity + 1)]
+        elif quantity != copies and not items.set_copy_count(cursor, book_id, quantity):
+            print(f"Book {book_id}: too few copies on the shelf to withdraw down to {quantity}; "
+                  "keeping the current copies", file=sys.stderr)
+            items.refresh_counts(cursor, [book_id])
+    if new_copies:
+        cursor.executemany("INSERT INTO items (book_id, barcode, branch_id, status) VALUES (%s, %s, %s, 'available')",
+                           new_copies)
+    if new_books:
+        items.refresh_counts(cursor, new_books)
+
+def flush(connection, cursor, rows):
+    cursor.executemany(storage.query('upsert_book'), rows)
+    isbns = [row[2] for row in rows]
+    placeholders = ', '.join(['%s'] * len(rows))
+    cursor.execute(f"""
+        INSERT INTO book_stats (book_id)
+        SELECT b.book_id FROM books b
+        LEFT JOIN book_stats s ON s.book_id = b.book_id
+        WHERE b.isbn IN ({placeholders}) AND s.book_id IS NULL
+    """, isbns)
+    sync_copies(cursor, isbns)
+    connection.commit()
+
+def import_books(path, batch_size=BATCH_SIZE):
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        categories = load_category_map(cursor)
+        rows, imported, rejected = [], 0, 0
+        start = time.perf_counter()
+        for line_number, record in enumerate(read_records(path), start=1):
+            try:
+                rows.append(to_row(record, cursor, categories))
+            except (ValueError, TypeError) as e:
+                rejected += 1
+                print(f"Record {line_number} skipped: {e}", file=sys.stderr)
+                continue
+            if len(rows) >= batch_size:
+                flush(connection, cursor, rows)
+                imported += len(rows)
+                rows = []
+                elapsed = time.perf_counter() - start
+                print(f"{imported} books imported ({imported / elapsed:.0f} rows/s)")
+        if rows:
+            flush(connection, cursor, rows)
+            imported += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"Imported {imported} books, skipped {rejected} records in {elapsed:.1f}s "
+              f"({imported / elapsed if elapsed else 0:.0f} rows/s)")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+def export_books(path, batch_size=BATCH_SIZE):
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor(dictionary=True)
+        jsonl = path.endswith(('.jsonl', '.ndjson'))
+        exported, last_id = 0, 0
+        start = time.perf_counter()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = None if jsonl else csv.DictWriter(f, fieldnames=FIELDS)
+            if writer:
+                writer.writeheader()
+            # Keyset paging on book_id keeps only one batch in memory
+            while True:
+                cursor.execute("""
+                    SELECT b.book_id, b.title, b.author, b.isbn, b.publication_year, b.genre, b.description,
+                           b.quantity, c.name as category, b.cover_image
+                    FROM books b
+                    LEFT JOIN categories c ON b.category_id = c.category_id
+                    WHERE b.book_id > %s
+                    ORDER BY b.book_id
+                    LIMIT %s
+                """, (last_id, batch_size))
+                books = cursor.fetchall()
+                if not books:
+                    break
+                last_id = books[-1]['book_id']
+                for book in books:
+                    record = {field: book[field] for field in FIELDS}
+                    if writer:
+                        writer.writerow(record)
+                    else:
+                        f.write(json.dumps(record) + '\n')
+                exported += len(books)
+                print(f"{exported} books exported")
+        print(f"Exported {exported} books to {path} in {time.perf_counter() - start:.1f}s")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import or export the book catalog (CSV or JSONL)")
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('path', help="file to read or write; .jsonl/.ndjson for JSON lines, otherwise CSV")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    if args.command == 'import':
+        import_books(args.path, args.batch_size)
+    else:
+        export_books(args.path, args.batch_size)
@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from PIL import Image, ImageDraw
+import hashlib
+import io
+import logging
+import mmap
+import os
+import threading
+import time
+import requests
+
+# Cover image proxy. Remote covers are fetched once, shrunk to thumbnails
+# and stored on disk under the SHA-256 of the thumbnail bytes, so books that
+# share an image share one file. A small pointer file per URL records which
+# blob it resolved to. Blobs are evicted least recently used first once the
+# cache outgrows its size cap.
+
+THUMBNAIL_SIZE = (200, 300)
+# Remote images larger than this are rejected rather than downloaded
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+# Memory-mapped blobs kept open for repeat renders
+MAPPED_BLOBS = 64
+
+logger = logging.getLogger(__name__)
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail(size)
+        output = io.BytesIO()
+        image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+def make_placeholder(size=THUMBNAIL_SIZE):
+    image = Image.new('RGB', size, (225, 225, 225))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([(0, 0), (size[0] - 1, size[1] - 1)], outline=(180, 180, 180), width=2)
+    draw.text((size[0] // 2, size[1] // 2), "No cover", fill=(120, 120, 120), anchor='mm')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+def fetch_image(url, timeout):
+    with requests.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > MAX_DOWNLOAD_BYTES:
+                raise ValueError(f"cover image larger than {MAX_DOWNLOAD_BYTES} bytes")
+    return bytes(data)
+
+class CoverCache:
+    def __init__(self, directory, max_bytes, fetch_timeout=3.0, wait_timeout=0.5, retry_seconds=300, workers=4):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.url_dir = os.path.join(directory, 'urls')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.url_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.fetch_timeout = fetch_timeout
+        self.wait_timeout = wait_timeout
+        self.retry_seconds = retry_seconds
+        self.placeholder = make_placeholder()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cover-fetch')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = {}
+        self.mapped = {}
+        self.stats = {'hits': 0, 'misses': 0, 'fetched': 0, 'failures': 0, 'placeholders': 0, 'evicted': 0}
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.blob_dir))
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest + '.jpg')
+
+    def pointer_path(self, url):
+        return os.path.join(self.url_dir, url_key(url))
+
+    def lookup(self, url):
+        # Returns the blob path for a cached URL, or None
+        try:
+            with open(self.pointer_path(url)) as f:
+                path = self.blob_path(f.read().strip())
+        except FileNotFoundError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def read(self, path):
+        # Reads go through a memory map kept open per blob, so repeat renders
+        # are served from the page cache without a read() per request
+        with self.lock:
+            mapped = self.mapped.pop(path, None)
+            if mapped is None:
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped[path] = mapped
+            while len(self.mapped) > MAPPED_BLOBS:
+                self.mapped.pop(next(iter(self.mapped))).close()
+            data = mapped[:]
+        # The modification time doubles as the last-used time for eviction
+        os.utime(path)
+        return data
+
+    def store(self, url, thumbnail):
+        digest = hashlib.sha256(thumbnail).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            # Write then rename so readers never see a partial file
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(thumbnail)
+            # Two fetches of the same image can both get here; only the one
+            # that creates the blob counts its size
+            with self.lock:
+                created = not os.path.exists(path)
+                if created:
+                    os.replace(temp_path, path)
+                    self.total_bytes += len(thumbnail)
+            if not created:
+                os.remove(temp_path)
+        temp_pointer = f"{self.pointer_path(url)}.{threading.get_ident()}.tmp"
+        with open(temp_pointer, 'w') as f:
+            f.write(digest)
+        os.replace(temp_pointer, self.pointer_path(url))
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return path
+
+    def evict(self):
+        # Drop least recently used blobs until the cache is back under 90% of
+        # its cap; pointers to evicted blobs simply become misses
+        blobs = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.blob_dir) if entry.name.endswith('.jpg'))
+        for _, size, path in blobs:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            with self.lock:
+                mapped = self.mapped.pop(path, None)
+            if mapped is not None:
+                mapped.close()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another thread evicted it first
+                continue
+            with self.lock:
+                self.total_bytes -= size
+                self.stats['evicted'] += 1
+
+    def fetch(self, url):
+        try:
+            thumbnail = make_thumbnail(fetch_image(url, self.fetch_timeout))
+            path = self.store(url, thumbnail)
+            with self.lock:
+                self.stats['fetched'] += 1
+                self.failed.pop(url, None)
+            return path
+        except Exception as e:
+            # Any network, HTTP or decoding failure is remembered so a dead
+            # host is not retried on every render
+            with self.lock:
+                self.stats['failures'] += 1
+                self.failed[url] = time.monotonic()
+            logger.warning("Cover fetch failed for %s: %s", url, e)
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(url, None)
+
+    def prefetch(self, url):
+        # Starts a background fetch unless the cover is cached or in flight
+        if not url or self.lookup(url):
+            return None
+        with self.lock:
+            future = self.pending.get(url)
+            if future is None:
+                self.failed.pop(url, None)
+                future = self.pending[url] = self.executor.submit(self.fetch, url)
+        return future
+
+    def get(self, url):
+        # Thumbnail bytes for url. A miss waits briefly for the fetch and
+        # otherwise returns the placeholder while the fetch carries on in the
+        # background for the next render.
+        path = self.lookup(url)
+        if path:
+            with self.lock:
+                self.stats['hits'] += 1
+            try:
+                return self.read(path)
+            except (FileNotFoundError, ValueError):
+                # Evicted between lookup and read
+                pass
+        with self.lock:
+            self.stats['misses'] += 1
+            failed_at = self.failed.get(url)
+        if failed_at is None or time.monotonic() - failed_at > self.retry_seconds:
+            future = self.prefetch(url)
+            if future is not None:
+                try:
+                    path = future.result(timeout=self.wait_timeout)
+                except TimeoutError:
+                    path = None
+                if path:
+                    return self.read(path)
+        with self.lock:
+            self.stats['placeholders'] += 1
+        return self.placeholder
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, size_bytes=self.total_bytes, max_bytes=self.max_bytes)
@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+# Write-behind event log. Writes that need no synchronous check are appended
+# to a local file and fsynced, which is all the acting user waits for; a
+# background worker then applies them to the database in batches, one
+# transaction per batch. Every event carries an idempotency key that the
+# apply step records in the same transaction, so replaying the log after a
+# crash skips whatever had already landed.
+
+FLUSH_INTERVAL = 0.2
+BATCH_SIZE = 500
+# A fully applied log is truncated once it grows past this
+ROTATE_BYTES = 16 * 1024 * 1024
+MAX_RETRY_DELAY = 5.0
+# Failures of a batch before it is split up, and of a single event before it
+# is set aside, unless the error is transient
+MAX_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+class EventLog:
+    def __init__(self, path, apply_batch, is_permanent=lambda e: False, is_transient=lambda e: False,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, rotate_bytes=ROTATE_BYTES,
+                 max_attempts=MAX_ATTEMPTS):
+        # apply_batch(events) writes the events in one transaction and returns
+        # the ones it applied; errors for which is_permanent(e) holds are
+        # blamed on a single event, which is set aside instead of retried.
+        # Errors for which is_transient(e) holds (the database is down) are
+        # retried indefinitely; any other error is retried max_attempts
+        # times, so one event that keeps failing cannot stall the log.
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.rejected_path = path + '.rejected'
+        self.apply_batch = apply_batch
+        self.is_permanent = is_permanent
+        self.is_transient = is_transient
+        self.max_attempts = max_attempts
+        # Failed attempts by (first seq, single event), and ids of the events
+        # set aside, until the batch they are in lands
+        self.attempts = {}
+        self.set_aside = set()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {'appended': 0, 'fsyncs': 0, 'batches': 0, 'applied': 0, 'duplicates': 0,
+                      'rejected': 0, 'failures': 0, 'recovered': 0}
+        self.offset, self.applied_seq = self.read_checkpoint()
+        self.seq = self.recover()
+        self.synced_seq = self.seq
+        self.file = open(path, 'ab')
+        self.worker = threading.Thread(target=self.run, name='event-log-flush', daemon=True)
+
+    def read_checkpoint(self):
+        # "<byte offset> <sequence number>" of the last applied event
+        try:
+            with open(self.checkpoint_path) as f:
+                offset, seq = f.read().split()
+            return int(offset), int(seq)
+        except FileNotFoundError:
+            return 0, 0
+
+    def save_checkpoint(self, offset, seq):
+        # Not fsynced: a stale checkpoint only means replaying events whose
+        # keys are already recorded
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(f"{offset} {seq}")
+        os.replace(temp_path, self.checkpoint_path)
+        with self.lock:
+            self.offset, self.applied_seq = offset, seq
+
+    def recover(self):
+        # Finds the last sequence number and counts the events still to
+        # apply. A torn last line from a crash mid-append was never
+        # acknowledged, so it is cut off.
+        if not os.path.exists(self.path):
+            return self.applied_seq
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        if self.offset > end:
+            # Crashed between truncating a rotated log and saving the checkpoint
+            self.offset = 0
+        seq = self.applied_seq
+        for line in data[self.offset:end].splitlines():
+            seq = max(seq, json.loads(line)['seq'])
+            self.stats['recovered'] += 1
+        return seq
+
+    def start(self):
+        self.worker.start()
+
+    def append(self, kind, **payload):
+        # Returns once the event is on disk
+        with self.lock:
+            self.seq += 1
+            event = {'seq': self.seq, 'id': uuid.uuid4().hex, 'type': kind, 'at': time.time(), 'payload': payload}
+            self.file.write(json.dumps(event).encode('utf-8') + b'\n')
+            self.file.flush()
+            self.stats['appended'] += 1
+        self.sync(event['seq'])
+        return event
+
+    def sync(self, seq):
+        # Group fsync: appenders queue here and one fsync covers every line
+        # written before it started, so concurrent writers share the cost
+        with self.sync_lock:
+            if self.synced_seq >= seq:
+                return
+            with self.lock:
+                target = self.seq
+            os.fsync(self.file.fileno())
+            self.synced_seq = target
+            with self.lock:
+                self.stats['fsyncs'] += 1
+
+    def is_applied(self, event):
+        with self.lock:
+            return event['seq'] <= self.applied_seq
+
+    def read_batch(self):
+        batch = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            offset = self.offset
+            while len(batch) < self.batch_size:
+                line = f.readline()
+                # End of the log, or a line still being written
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                batch.append((json.loads(line), offset))
+        return batch
+
+    def gave_up(self, events, error):
+        if self.is_permanent(error):
+            return True
+        if self.is_transient(error):
+            return False
+        key = (events[0]['seq'], len(events) == 1)
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        return self.attempts[key] >= self.max_attempts
+
+    def apply(self, events):
+        # Events rejected before a retry of their batch are not rejected again
+        events = [event for event in events if event['id'] not in self.set_aside]
+        if not events:
+            return
+        try:
+            applied = self.apply_batch(events)
+        except Exception as e:
+            if not self.gave_up(events, e):
+                raise
+            if len(events) == 1:
+                self.reject(events[0], e)
+                return
+            # Apply one at a time so a single bad event does not hold back
+            # the rest of the batch
+            for event in events:
+                self.apply([event])
+            return
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['applied'] += len(applied)
+            self.stats['duplicates'] += len(events) - len(applied)
+
+    def reject(self, event, error):
+        self.set_aside.add(event['id'])
+        with open(self.rejected_path, 'a') as f:
+            f.write(json.dumps(dict(event, error=str(error))) + '\n')
+        with self.lock:
+            self.stats['rejected'] += 1
+        logger.error("Rejected %s event %s: %s", event['type'], event['id'], error)
+
+    def flush(self):
+        # Applies everything logged so far, a batch per transaction
+        with self.flush_lock:
+            while True:
+                batch = self.read_batch()
+                if not batch:
+                    break
+                self.apply([event for event, _ in batch])
+                self.attempts.clear()
+                self.set_aside.clear()
+                last_event, offset = batch[-1]
+                self.save_checkpoint(offset, last_event['seq'])
+            self.rotate()
+
+    def rotate(self):
+        with self.lock:
+            if self.offset < self.rotate_bytes or self.file.tell() != self.offset:
+                return
+            self.file.truncate(0)
+            self.file.seek(0)
+        self.save_checkpoint(0, self.applied_seq)
+
+    def run(self):
+        delay = self.flush_interval
+        while not self.stopped.wait(delay):
+            try:
+                self.flush()
+                delay = self.flush_interval
+            except Exception as e:
+                # The events stay in the log; back off while the database is down
+                with self.lock:
+                    self.stats['failures'] += 1
+                logger.warning("Event log flush failed, retrying: %s", e)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def close(self):
+        self.stopped.set()
+        if self.worker.is_alive():
+            self.worker.join()
+        self.file.close()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, pending=self.seq - self.applied_seq)
@@ -0,0 +1,160 @@
+from mysql.connector import Error
+from datetime import datetime, timedelta
+import argparse
+import os
+import time
+import items
+import storage
+from storage import connect
+
+# Hold queues for titles with no copy on the shelf. A returned copy goes to
+# the oldest waiting hold instead of back on the shelf, in the same
+# transaction as the return, and the holder is told through the in-app
+# inbox. A ready hold that is not picked up within the pickup window expires
+# and the copy moves on down the queue.
+#
+# Hold status: waiting -> ready -> fulfilled, or cancelled/expired.
+# A ready hold has its own copy set aside (items status 'held'), which is not
+# counted in available_quantity.
+
+PICKUP_DAYS = int(os.getenv('HOLD_PICKUP_DAYS', 3))
+BATCH_SIZE = 1000
+ACTIVE_STATUSES = ('waiting', 'ready')
+
+def notify(cursor, user_id, message, now):
+    cursor.execute("INSERT INTO notifications (user_id, message, created_at) VALUES (%s, %s, %s)",
+                   (user_id, message, now))
+
+def lock_book(cursor, book_id):
+    # Serializes queue changes for one title; returns its available copies,
+    # or None if the book does not exist
+    cursor.execute(storage.query('lock_book'), (book_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def place_hold(cursor, user_id, book_id, now=None):
+    # Returns 'placed', or why not: 'missing', 'available' or 'duplicate'
+    available = lock_book(cursor, book_id)
+    if available is None:
+        return 'missing'
+    if available > 0:
+        return 'available'
+    cursor.execute("SELECT id FROM holds WHERE user_id = %s AND book_id = %s AND status IN ('waiting', 'ready')",
+                   (user_id, book_id))
+    if cursor.fetchone():
+        return 'duplicate'
+    cursor.execute("INSERT INTO holds (user_id, book_id, status, placed_at) VALUES (%s, %s, 'waiting', %s)",
+                   (user_id, book_id, now or datetime.now().replace(microsecond=0)))
+    return 'placed'
+
+def allocate_copy(cursor, book_id, item_id, now=None):
+    # Hands a copy that just came free to the head of the queue, if there is
+    # one. Callers hold the book row lock (see lock_book).
+    now = now or datetime.now().replace(microsecond=0)
+    cursor.execute("""
+        SELECT h.id, h.user_id, b.title
+        FROM holds h
+        JOIN books b ON b.book_id = h.book_id
+        WHERE h.book_id = %s AND h.status = 'waiting'
+        ORDER BY h.id
+        LIMIT 1
+    """, (book_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    hold_id, user_id, title = row
+    cursor.execute("SELECT br.name FROM items i JOIN branches br ON br.branch_id = i.branch_id WHERE i.item_id = %s",
+                   (item_id,))
+    branch = cursor.fetchone()[0]
+    expires_at = now + timedelta(days=PICKUP_DAYS)
+    cursor.execute("UPDATE holds SET status = 'ready', expires_at = %s, item_id = %s WHERE id = %s",
+                   (expires_at, item_id, hold_id))
+    cursor.execute("UPDATE items SET status = 'held' WHERE item_id = %s", (item_id,))
+    notify(cursor, user_id, f"'{title}' is being held for you at {branch} until {expires_at:%Y-%m-%d %H:%M}. "
+                            "Borrow it from your holds on the Borrow page.", now)
+    return True
+
+def release_copy(cursor, book_id, item_id, now=None):
+    # A copy is free again: the next hold gets it, otherwise the shelf does
+    lock_book(cursor, book_id)
+    if not allocate_copy(cursor, book_id, item_id, now):
+        items.shelve_copy(cursor, book_id, item_id)
+
+def claim_hold(cursor, user_id, book_id, item_id=None):
+    # Borrowing a title held for the user takes the copy set aside for them;
+    # returns its id. At the desk only that copy's barcode claims the hold.
+    cursor.execute("SELECT id, item_id FROM holds WHERE user_id = %s AND book_id = %s AND status = 'ready'",
+                   (user_id, book_id))
+    row = cursor.fetchone()
+    if row is None or row[1] is None or item_id not in (None, row[1]):
+        return None
+    cursor.execute("UPDATE holds SET status = 'fulfilled' WHERE id = %s AND status = 'ready'", (row[0],))
+    if cursor.rowcount == 0:
+        return None
+    cursor.execute("UPDATE items SET status = 'loaned' WHERE item_id = %s", (row[1],))
+    return row[1]
+
+def drop_waiting_hold(cursor, user_id, book_id):
+    # The user found a copy on the shelf, so their place in the queue is moot
+    cursor.execute("UPDATE holds SET status = 'cancelled' WHERE user_id = %s AND book_id = %s AND status = 'waiting'",
+                   (user_id, book_id))
+
+def cancel_hold(cursor, user_id, hold_id, now=None):
+    cursor.execute("SELECT book_id, status, item_id FROM holds WHERE id = %s AND user_id = %s", (hold_id, user_id))
+    row = cursor.fetchone()
+    if row is None or row[1] not in ACTIVE_STATUSES:
+        return False
+    book_id, status, item_id = row
+    lock_book(cursor, book_id)
+    cursor.execute("UPDATE holds SET status = 'cancelled' WHERE id = %s AND status = %s", (hold_id, status))
+    if cursor.rowcount == 0:
+        return False
+    if status == 'ready':
+        release_copy(cursor, book_id, item_id, now)
+    return True
+
+def expire_holds(cursor, now=None, limit=BATCH_SIZE):
+    # Ready holds past their pickup window, found through idx_holds_expiry
+    now = now or datetime.now().replace(microsecond=0)
+    cursor.execute("""
+        SELECT h.id, h.user_id, h.book_id, h.item_id, b.title
+        FROM holds h
+        JOIN books b ON b.book_id = h.book_id
+        WHERE h.status = 'ready' AND h.expires_at < %s
+        ORDER BY h.expires_at
+        LIMIT %s
+    """, (now, limit))
+    expired = cursor.fetchall()
+    for hold_id, user_id, book_id, item_id, title in expired:
+        lock_book(cursor, book_id)
+        cursor.execute("UPDATE holds SET status = 'expired' WHERE id = %s AND status = 'ready'", (hold_id,))
+        if cursor.rowcount == 0:
+            # Borrowed or cancelled in the meantime
+            continue
+        notify(cursor, user_id, f"Your hold on '{title}' expired before it was borrowed.", now)
+        release_copy(cursor, book_id, item_id, now)
+    return len(expired)
+
+def run_expiry(now=None):
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        start = time.perf_counter()
+        total = 0
+        # One short transaction per batch
+        while True:
+            count = expire_holds(cursor, now)
+            connection.commit()
+            total += count
+            if count < BATCH_SIZE:
+                break
+        print(f"Expired {total} holds ({time.perf_counter() - start:.1f}s)")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expire holds that were not picked up and pass the copies on")
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help="time to expire holds at (default now)")
+    args = parser.parse_args()
+    run_expiry(args.as_of)
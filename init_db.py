@@ -1,30 +1,478 @@
-import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
-import os
+from datetime import date
+import argparse
+import storage
+from storage import (connect, column_exists, index_exists, table_exists,
+                     ITEM_LOAN_COLUMNS, LOAN_COLUMNS, REVIEW_COLUMNS)
+from overdue import DEFAULT_LOAN_DAYS
+from items import BRANCH_COUNTS, DEFAULT_BRANCH, MAX_COPIES, REFRESH_COUNTS
 
 load_dotenv()
 
-def create_database():
-    try:
-        connection = mysql.connector.connect(
-            host=os.getenv('DB_HOST'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
+# Schema migrations. Each migration is a generator that inspects the live
+# schema and yields only the statements still needed, so every step is
+# idempotent and a partially applied migration can simply be re-run.
+# Statements are written for both backends; storage spells out the parts
+# that differ.
+def add_index(cursor, table, index_name, columns):
+    if not index_exists(cursor, table, index_name):
+        yield storage.create_index(table, index_name, columns)
+
+def add_fulltext_index(cursor, table, index_name, columns, key):
+    if not storage.fulltext_exists(cursor, table, index_name):
+        yield from storage.create_fulltext_index(table, index_name, columns, key)
+
+def migration_1(cursor):
+    # Search and hot-query indexes
+    yield from add_fulltext_index(cursor, 'books', 'ft_books_title_author', 'title, author', 'book_id')
+    yield from add_index(cursor, 'books', 'idx_books_title', 'title')
+    yield from add_index(cursor, 'books', 'idx_books_available', 'available_quantity')
+    yield from add_index(cursor, 'books', 'idx_books_genre', 'genre')
+    yield from add_index(cursor, 'books', 'idx_books_category_title', 'category_id, title')
+    yield from add_index(cursor, 'loans', 'idx_loans_user_open', 'user_id, return_date, book_id')
+    yield from add_index(cursor, 'loans', 'idx_loans_open_loan_date', 'return_date, loan_date')
+    yield from add_index(cursor, 'reviews', 'idx_reviews_book_rating', 'book_id, rating')
+    yield from add_index(cursor, 'reviews', 'idx_reviews_user_rating', 'user_id, rating')
+
+# Per-book aggregates recomputed from the loans and reviews history,
+# including rows moved to the archive tables by archive.py
+def book_stats_query(loans='loan_history', reviews='review_history'):
+    return f"""
+    SELECT b.book_id,
+           (SELECT COUNT(*) FROM {reviews} r WHERE r.book_id = b.book_id) as review_count,
+           (SELECT COALESCE(SUM(r.rating), 0) FROM {reviews} r WHERE r.book_id = b.book_id) as rating_sum,
+           (SELECT COUNT(*) FROM {loans} l WHERE l.book_id = b.book_id) as loan_count,
+           (SELECT COUNT(*) FROM loans l WHERE l.book_id = b.book_id AND l.return_date IS NULL) as active_loans
+    FROM books b
+    """
+
+def rebuild_book_stats_statement(loans='loan_history', reviews='review_history'):
+    return f"""
+    REPLACE INTO book_stats (book_id, review_count, rating_sum, loan_count, active_loans)
+    {book_stats_query(loans, reviews)}
+    """
+
+def migration_2(cursor):
+    # Materialized rating and borrow aggregates, kept current by the write functions
+    if not table_exists(cursor, 'book_stats'):
+        yield """
+        CREATE TABLE book_stats (
+            book_id INT PRIMARY KEY,
+            review_count INT NOT NULL DEFAULT 0,
+            rating_sum INT NOT NULL DEFAULT 0,
+            loan_count INT NOT NULL DEFAULT 0,
+            active_loans INT NOT NULL DEFAULT 0,
+            avg_rating DECIMAL(6,4) GENERATED ALWAYS AS
+                (CASE WHEN review_count = 0 THEN 0 ELSE 1.0 * rating_sum / review_count END) STORED,
+            FOREIGN KEY (book_id) REFERENCES books(book_id)
+        )
+        """
+    yield from add_index(cursor, 'book_stats', 'idx_book_stats_rating', 'avg_rating, book_id')
+    yield from add_index(cursor, 'book_stats', 'idx_book_stats_loans', 'loan_count, book_id')
+    # Nothing is archived yet; the history views arrive in migration 6
+    yield rebuild_book_stats_statement('loans', 'reviews')
+
+def migration_3(cursor):
+    # Tables filled by the batch recommendation job in recommend.py
+    if not table_exists(cursor, 'book_similarities'):
+        yield """
+        CREATE TABLE book_similarities (
+            book_id INT NOT NULL,
+            similar_book_id INT NOT NULL,
+            score DOUBLE NOT NULL,
+            PRIMARY KEY (book_id, similar_book_id)
+        )
+        """
+    if not table_exists(cursor, 'user_recommendations'):
+        yield """
+        CREATE TABLE user_recommendations (
+            user_id INT NOT NULL,
+            book_id INT NOT NULL,
+            score DOUBLE NOT NULL,
+            PRIMARY KEY (user_id, book_id)
+        )
+        """
+    yield from add_index(cursor, 'user_recommendations', 'idx_user_recommendations_score', 'user_id, score')
+
+def migration_4(cursor):
+    # Author prefix filter on the paginated available-books list
+    yield from add_index(cursor, 'books', 'idx_books_author', 'author')
+
+def migration_5(cursor):
+    # Per-category loan policies, due dates and the overdue snapshot that
+    # overdue.py rebuilds for the report page
+    if not table_exists(cursor, 'loan_policies'):
+        yield """
+        CREATE TABLE loan_policies (
+            category_id INT PRIMARY KEY,
+            loan_days INT NOT NULL,
+            daily_fine DECIMAL(6,2) NOT NULL,
+            FOREIGN KEY (category_id) REFERENCES categories(category_id)
+        )
+        """
+    if not column_exists(cursor, 'loans', 'due_date'):
+        yield "ALTER TABLE loans ADD COLUMN due_date DATE"
+    # Closed history keeps a NULL due date; only open loans are ever checked
+    yield (f"UPDATE loans SET due_date = {storage.add_days('loan_date', DEFAULT_LOAN_DAYS)} "
+           "WHERE due_date IS NULL AND return_date IS NULL")
+    # Open loans sort first on return_date IS NULL, so this index holds the
+    # active loans ordered by due date apart from the closed history
+    yield from add_index(cursor, 'loans', 'idx_loans_open_due', 'return_date, due_date')
+    if not table_exists(cursor, 'overdue_loans'):
+        yield """
+        CREATE TABLE overdue_loans (
+            loan_id INT PRIMARY KEY,
+            user_id INT NOT NULL,
+            book_id INT NOT NULL,
+            title VARCHAR(255) NOT NULL,
+            username VARCHAR(50) NOT NULL,
+            loan_date DATE NOT NULL,
+            due_date DATE NOT NULL,
+            days_overdue INT NOT NULL,
+            fine DECIMAL(8,2) NOT NULL,
+            refreshed_at DATETIME NOT NULL
+        )
+        """
+    yield from add_index(cursor, 'overdue_loans', 'idx_overdue_loans_due', 'due_date')
+
+def migration_6(cursor):
+    # Archive tables for closed loans and old reviews moved out by archive.py,
+    # and views that read hot and archived rows together
+    if not table_exists(cursor, 'loans_archive'):
+        yield storage.ddl("""
+        CREATE TABLE loans_archive (
+            id INT PRIMARY KEY,
+            user_id INT NOT NULL,
+            book_id INT NOT NULL,
+            loan_date DATE NOT NULL,
+            due_date DATE,
+            return_date DATE NOT NULL
+        ) ROW_FORMAT=COMPRESSED
+        """)
+    yield from add_index(cursor, 'loans_archive', 'idx_loans_archive_book', 'book_id')
+    yield from add_index(cursor, 'loans_archive', 'idx_loans_archive_user', 'user_id, book_id')
+    if not table_exists(cursor, 'reviews_archive'):
+        yield storage.ddl("""
+        CREATE TABLE reviews_archive (
+            id INT PRIMARY KEY,
+            user_id INT NOT NULL,
+            book_id INT NOT NULL,
+            rating INT NOT NULL,
+            comment TEXT,
+            review_date DATE NOT NULL
+        ) ROW_FORMAT=COMPRESSED
+        """)
+    yield from add_index(cursor, 'reviews_archive', 'idx_reviews_archive_book', 'book_id, rating')
+    # Lets archive.py find old reviews without scanning the table
+    yield from add_index(cursor, 'reviews', 'idx_reviews_date', 'review_date')
+    yield storage.create_view('loan_history', f"SELECT {LOAN_COLUMNS} FROM loans "
+                                              f"UNION ALL SELECT {LOAN_COLUMNS} FROM loans_archive")
+    yield storage.create_view('review_history', f"SELECT {REVIEW_COLUMNS} FROM reviews "
+                                                f"UNION ALL SELECT {REVIEW_COLUMNS} FROM reviews_archive")
+
+def migration_7(cursor):
+    # Idempotency keys of write-behind events already applied, so replaying
+    # the event log after a crash never applies an event twice
+    if not table_exists(cursor, 'applied_events'):
+        yield """
+        CREATE TABLE applied_events (
+            event_id CHAR(32) PRIMARY KEY,
+            applied_at DATETIME NOT NULL
+        )
+        """
+    # Lets archive.py prune old keys without scanning the table
+    yield from add_index(cursor, 'applied_events', 'idx_applied_events_at', 'applied_at')
+
+def migration_8(cursor):
+    # Hold queues for titles with no copy on the shelf, and the in-app inbox
+    # that tells users when a held copy is ready
+    if not table_exists(cursor, 'holds'):
+        yield storage.ddl("""
+        CREATE TABLE holds (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            book_id INT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            placed_at DATETIME NOT NULL,
+            expires_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (book_id) REFERENCES books(book_id)
+        )
+        """)
+    # The head of a title's queue is the first entry of this index, so each
+    # allocation is one index seek however long the queue is
+    yield from add_index(cursor, 'holds', 'idx_holds_queue', 'book_id, status, id')
+    yield from add_index(cursor, 'holds', 'idx_holds_user', 'user_id, status')
+    yield from add_index(cursor, 'holds', 'idx_holds_expiry', 'status, expires_at')
+    if not table_exists(cursor, 'notifications'):
+        yield storage.ddl("""
+        CREATE TABLE notifications (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            message VARCHAR(500) NOT NULL,
+            created_at DATETIME NOT NULL,
+            read_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        """)
+    yield from add_index(cursor, 'notifications', 'idx_notifications_user', 'user_id, read_at')
+
+def copy_barcode_sql(book_id, copy_number):
+    # SQL spelling of items.copy_barcode()
+    return storage.concat(f"CAST({book_id} AS CHAR)", "'-'", f"CAST({copy_number} AS CHAR)")
+
+def migration_9(cursor):
+    # One row per physical copy, and the copy each open loan and ready hold
+    # has. Existing titles get generated barcodes, enough copies for their
+    # quantity and whatever is already out, and counters recomputed from the
+    # copies, which also repairs any drift they had. Every backfill step
+    # only touches rows it has not done yet, so an interrupted run (MySQL
+    # commits each DDL statement) is finished by running it again.
+    if not table_exists(cursor, 'branches'):
+        yield storage.ddl("""
+        CREATE TABLE branches (
+            branch_id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) UNIQUE NOT NULL
+        )
+        """)
+    # Seeded on every run: copies and stock rows below reference it
+    yield storage.insert_ignore(f"INSERT INTO branches (branch_id, name) VALUES ({DEFAULT_BRANCH}, 'Main')")
+    if not table_exists(cursor, 'items'):
+        yield storage.ddl("""
+        CREATE TABLE items (
+            item_id INT AUTO_INCREMENT PRIMARY KEY,
+            book_id INT NOT NULL,
+            barcode VARCHAR(32) UNIQUE NOT NULL,
+            branch_id INT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            FOREIGN KEY (book_id) REFERENCES books(book_id),
+            FOREIGN KEY (branch_id) REFERENCES branches(branch_id)
+        )
+        """)
+    # A title's copies on the shelf are the first entries under
+    # (book_id, 'available'), so lending picks one with a single seek
+    yield from add_index(cursor, 'items', 'idx_items_book_status', 'book_id, status, item_id')
+    for table in ('loans', 'loans_archive', 'holds'):
+        if not column_exists(cursor, table, 'item_id'):
+            yield f"ALTER TABLE {table} ADD COLUMN item_id INT"
+    # Check-in by barcode finds the copy's open loan through this index
+    yield from add_index(cursor, 'loans', 'idx_loans_item_open', 'item_id, return_date')
+    yield "DROP VIEW IF EXISTS loan_history"
+    yield storage.create_view('loan_history', f"SELECT {ITEM_LOAN_COLUMNS} FROM loans "
+                                              f"UNION ALL SELECT {ITEM_LOAN_COLUMNS} FROM loans_archive")
+    # Copies for titles that have none yet. Copy numbers come from a cross
+    # join of digits rather than a recursive CTE, which MySQL stops at 1000
+    # rows; titles are capped at MAX_COPIES.
+    yield f"""
+    INSERT INTO items (book_id, barcode, branch_id, status)
+    WITH
+        out_copies (book_id, copies) AS (
+            SELECT book_id, COUNT(*) FROM loans WHERE return_date IS NULL GROUP BY book_id
+            UNION ALL
+            SELECT book_id, COUNT(*) FROM holds WHERE status = 'ready' GROUP BY book_id
+        ),
+        stock (book_id, copies) AS (
+            SELECT b.book_id, CASE WHEN b.quantity > COALESCE(SUM(o.copies), 0)
+                                   THEN b.quantity ELSE SUM(o.copies) END
+            FROM books b
+            LEFT JOIN out_copies o ON o.book_id = b.book_id
+            WHERE NOT EXISTS (SELECT 1 FROM items i WHERE i.book_id = b.book_id)
+            GROUP BY b.book_id, b.quantity
+        ),
+        digits (d) AS (
+            SELECT 0 UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4
+            UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8 UNION ALL SELECT 9
+        ),
+        copy_numbers (n) AS (
+            SELECT d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d + 1
+            FROM digits d1, digits d2, digits d3, digits d4
+            WHERE d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d < (SELECT MAX(copies) FROM stock)
+        )
+    SELECT s.book_id, {copy_barcode_sql('s.book_id', 'c.n')}, {DEFAULT_BRANCH}, 'available'
+    FROM stock s
+    JOIN copy_numbers c ON c.n <= s.copies AND c.n <= {MAX_COPIES}
+    """
+    # The k-th open loan of a title gets copy k, and its ready holds the
+    # copies after those. Rows linked by an earlier run keep their copy.
+    yield storage.update_from('loans', 'item_id', 'i.item_id', """
+        (SELECT id, book_id, ROW_NUMBER() OVER (PARTITION BY book_id ORDER BY id) as n
+         FROM loans WHERE return_date IS NULL) o, items i""",
+        f"o.id = t.id AND t.item_id IS NULL AND i.barcode = {copy_barcode_sql('o.book_id', 'o.n')}")
+    yield storage.update_from('holds', 'item_id', 'i.item_id', """
+        (SELECT h.id, h.book_id,
+                ROW_NUMBER() OVER (PARTITION BY h.book_id ORDER BY h.id)
+                + (SELECT COUNT(*) FROM loans l WHERE l.book_id = h.book_id AND l.return_date IS NULL) as n
+         FROM holds h WHERE h.status = 'ready') r, items i""",
+        f"r.id = t.id AND t.item_id IS NULL AND i.barcode = {copy_barcode_sql('r.book_id', 'r.n')}")
+    yield "UPDATE items SET status = 'loaned' WHERE item_id IN (SELECT item_id FROM loans WHERE return_date IS NULL)"
+    yield "UPDATE items SET status = 'held' WHERE item_id IN (SELECT item_id FROM holds WHERE status = 'ready')"
+    yield REFRESH_COUNTS
+
+def migration_10(cursor):
+    # Per-branch stock and transfers between branches. Branch-scoped tables
+    # and indexes lead with branch_id, so a branch's queries only read its
+    # own contiguous slice of them.
+    if not table_exists(cursor, 'branch_stock'):
+        yield """
+        CREATE TABLE branch_stock (
+            branch_id INT NOT NULL,
+            book_id INT NOT NULL,
+            quantity INT NOT NULL,
+            available_quantity INT NOT NULL,
+            PRIMARY KEY (branch_id, book_id),
+            FOREIGN KEY (branch_id) REFERENCES branches(branch_id),
+            FOREIGN KEY (book_id) REFERENCES books(book_id)
+        )
+        """
+    yield from add_index(cursor, 'branch_stock', 'idx_branch_stock_book', 'book_id')
+    yield from add_index(cursor, 'items', 'idx_items_branch_book', 'branch_id, book_id, status, item_id')
+    if not table_exists(cursor, 'transfers'):
+        yield storage.ddl("""
+        CREATE TABLE transfers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            item_id INT NOT NULL,
+            book_id INT NOT NULL,
+            from_branch_id INT NOT NULL,
+            to_branch_id INT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            requested_at DATETIME NOT NULL,
+            finished_at DATETIME,
+            FOREIGN KEY (item_id) REFERENCES items(item_id),
+            FOREIGN KEY (from_branch_id) REFERENCES branches(branch_id),
+            FOREIGN KEY (to_branch_id) REFERENCES branches(branch_id)
         )
+        """)
+    # Each branch's desk lists its incoming and outgoing transfers
+    yield from add_index(cursor, 'transfers', 'idx_transfers_to', 'to_branch_id, status, id')
+    yield from add_index(cursor, 'transfers', 'idx_transfers_from', 'from_branch_id, status, id')
+    # Stock for titles that have none yet, so a run interrupted after the
+    # CREATE TABLE (which MySQL commits on its own) is finished by a re-run
+    yield f"""
+    INSERT INTO branch_stock (branch_id, book_id, quantity, available_quantity)
+    {BRANCH_COUNTS}
+    WHERE book_id NOT IN (SELECT book_id FROM branch_stock)
+    GROUP BY branch_id, book_id
+    """
+
+def migration_11(cursor):
+    # A single row the app rewrites on the primary every second or so. How
+    # old its copy on a replica is tells how far the replica lags behind.
+    if not table_exists(cursor, 'replication_heartbeat'):
+        yield """
+        CREATE TABLE replication_heartbeat (
+            id INT PRIMARY KEY,
+            beat_at DOUBLE NOT NULL
+        )
+        """
+    # Outside the branch above, so a run interrupted after the CREATE TABLE
+    # (which MySQL commits on its own) still gets the row
+    yield storage.insert_ignore("INSERT INTO replication_heartbeat (id, beat_at) VALUES (1, 0)")
+
+MIGRATIONS = [
+    (1, "Search and hot-query indexes", migration_1),
+    (2, "Materialized per-book aggregates", migration_2),
+    (3, "Precomputed recommendations", migration_3),
+    (4, "Author index for catalog browsing", migration_4),
+    (5, "Loan policies and overdue snapshot", migration_5),
+    (6, "Archive tables for loan and review history", migration_6),
+    (7, "Idempotency keys for write-behind events", migration_7),
+    (8, "Hold queues and notifications", migration_8),
+    (9, "Per-copy inventory", migration_9),
+    (10, "Branch stock and transfers", migration_10),
+    (11, "Replication heartbeat", migration_11),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Representative queries whose plans are printed around migrations
+HOT_QUERIES = {
+    'get_borrowed_books': ("SELECT b.title, l.loan_date FROM loans l JOIN books b ON l.book_id = b.book_id "
+                           "WHERE l.user_id = %s AND l.return_date IS NULL", (1,)),
+    'get_available_books': ("SELECT book_id, title FROM books WHERE available_quantity > 0 "
+                            "ORDER BY title, book_id LIMIT 20", ()),
+    'get_available_books (branch)': ("SELECT b.book_id, b.title FROM branch_stock s JOIN books b ON b.book_id = s.book_id "
+                                     "WHERE s.branch_id = %s AND s.available_quantity > 0 "
+                                     "ORDER BY b.title, b.book_id LIMIT 20", (1,)),
+    'get_overdue_books': ("SELECT b.title, l.loan_date FROM loans l JOIN books b ON l.book_id = b.book_id "
+                          "WHERE l.return_date IS NULL AND l.due_date < %s", (date.today(),)),
+    'get_top_rated_books': ("SELECT b.book_id, s.avg_rating FROM book_stats s JOIN books b ON b.book_id = s.book_id "
+                            "ORDER BY s.avg_rating DESC, s.book_id DESC LIMIT 5", ()),
+    'get_most_borrowed_books': ("SELECT b.title, s.loan_count FROM book_stats s JOIN books b ON b.book_id = s.book_id "
+                                "WHERE s.loan_count > 0 ORDER BY s.loan_count DESC, s.book_id DESC LIMIT 5", ()),
+    'get_book_recommendations': ("SELECT book_id FROM books WHERE genre IN (%s) OR category_id IN (%s)",
+                                 ('Fiction', 1)),
+    'search_books': ("SELECT book_id FROM books WHERE title LIKE %s ORDER BY title, book_id LIMIT 20", ('a%',)),
+}
+
+def explain_hot_queries(cursor):
+    for name, (query, params) in HOT_QUERIES.items():
+        try:
+            plan = storage.explain(cursor, query, params)
+            print(f"  {name}:")
+            for step in plan:
+                print(f"    {step}")
+        except Error as e:
+            print(f"  {name}: unable to explain ({e})")
+
+def get_schema_version(cursor, dry_run=False):
+    if dry_run and not table_exists(cursor, 'schema_migrations'):
+        # A dry run changes nothing, not even the bookkeeping table; a database
+        # that never ran a migration is at version 0
+        return 0
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cursor.fetchone()[0]
+
+def run_migrations(connection, dry_run=False):
+    cursor = connection.cursor()
+    version = get_schema_version(cursor, dry_run)
+    pending = [m for m in MIGRATIONS if m[0] > version]
+    if not pending:
+        print(f"Schema is up to date (version {version})")
+        return
+
+    print("Query plans before migrating:")
+    explain_hot_queries(cursor)
+    for number, description, migration in pending:
+        print(f"Migration {number}: {description}")
+        for statement in migration(cursor):
+            print(f"  {statement}")
+            if not dry_run:
+                cursor.execute(statement)
+        if not dry_run:
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                           (number, description))
+            connection.commit()
+    if dry_run:
+        print("Dry run: no changes were applied")
+    else:
+        print("Query plans after migrating:")
+        explain_hot_queries(cursor)
+
+def create_database(database='library_management'):
+    connection = None
+    try:
+        connection = connect()
         
         if connection.is_connected():
             cursor = connection.cursor()
             
-            # Create database
-            cursor.execute("CREATE DATABASE IF NOT EXISTS library_management")
-            print("Database created successfully")
-            
-            # Switch to the new database
-            cursor.execute("USE library_management")
+            if storage.BACKEND == 'mysql':
+                # Create database
+                cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
+                print("Database created successfully")
+
+                # Switch to the new database
+                cursor.execute(f"USE {database}")
             
             # Create users table
-            cursor.execute("""
+            cursor.execute(storage.ddl("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INT AUTO_INCREMENT PRIMARY KEY,
                 username VARCHAR(50) UNIQUE NOT NULL,
@@ -32,20 +480,20 @@ def create_database():
                 password VARCHAR(255) NOT NULL,
                 is_admin BOOLEAN DEFAULT FALSE
             )
-            """)
+            """))
             print("Users table created successfully")
 
             # Create categories table
-            cursor.execute("""
+            cursor.execute(storage.ddl("""
             CREATE TABLE IF NOT EXISTS categories (
                 category_id INT AUTO_INCREMENT PRIMARY KEY,
                 name VARCHAR(100) UNIQUE NOT NULL
             )
-            """)
+            """))
             print("Categories table created successfully")
                         
             # Create books table
-            cursor.execute("""
+            cursor.execute(storage.ddl("""
             CREATE TABLE IF NOT EXISTS books (
                 book_id INT AUTO_INCREMENT PRIMARY KEY,
                 title VARCHAR(255) NOT NULL,
@@ -60,11 +508,11 @@ def create_database():
                 cover_image VARCHAR(255),
                 FOREIGN KEY (category_id) REFERENCES categories(category_id)
             )
-            """)
+            """))
             print("Books table created successfully") 
 
             # Create loans table
-            cursor.execute("""
+            cursor.execute(storage.ddl("""
             CREATE TABLE IF NOT EXISTS loans (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 user_id INT NOT NULL,
@@ -74,11 +522,11 @@ def create_database():
                 FOREIGN KEY (user_id) REFERENCES users(user_id),
                 FOREIGN KEY (book_id) REFERENCES books(book_id)
             )
-            """)
+            """))
             print("Loans table created successfully")
 
             # Create reviews table
-            cursor.execute("""
+            cursor.execute(storage.ddl("""
             CREATE TABLE IF NOT EXISTS reviews (
                 id INT AUTO_INCREMENT PRIMARY KEY,
                 user_id INT NOT NULL,
@@ -89,16 +537,81 @@ def create_database():
                 FOREIGN KEY (user_id) REFERENCES users(user_id),
                 FOREIGN KEY (book_id) REFERENCES books(book_id)
             )
-            """)
+            """))
             print("Reviews table created successfully")
 
+            run_migrations(connection)
+
     except Error as e:
         print(f"Error: {e}")
     finally:
-        if connection.is_connected():
+        if connection is not None and connection.is_connected():
             cursor.close()
             connection.close()
-            print("MySQL connection is closed")
+            print("Database connection is closed")
+
+def rebuild_book_stats():
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        cursor.execute(rebuild_book_stats_statement())
+        cursor.execute("DELETE FROM book_stats WHERE book_id NOT IN (SELECT book_id FROM books)")
+        connection.commit()
+        print("Book stats rebuilt successfully")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+def verify_book_stats():
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(f"""
+            SELECT e.book_id,
+                   s.review_count, e.review_count as expected_review_count,
+                   s.rating_sum, e.rating_sum as expected_rating_sum,
+                   s.loan_count, e.loan_count as expected_loan_count,
+                   s.active_loans, e.active_loans as expected_active_loans
+            FROM ({book_stats_query()}) e
+            LEFT JOIN book_stats s ON s.book_id = e.book_id
+            WHERE s.book_id IS NULL
+               OR s.review_count <> e.review_count OR s.rating_sum <> e.rating_sum
+               OR s.loan_count <> e.loan_count OR s.active_loans <> e.active_loans
+        """)
+        drifted = cursor.fetchall()
+        for row in drifted:
+            print(f"Book {row['book_id']}: reviews {row['review_count']}/{row['expected_review_count']}, "
+                  f"rating sum {row['rating_sum']}/{row['expected_rating_sum']}, "
+                  f"loans {row['loan_count']}/{row['expected_loan_count']}, "
+                  f"active loans {row['active_loans']}/{row['expected_active_loans']}")
+        print(f"{len(drifted)} book(s) with drifted stats")
+        connection.close()
+        return len(drifted)
+    except Error as e:
+        print(f"Error: {e}")
+
+def migrate(dry_run=False):
+    try:
+        connection = connect('library_management')
+        run_migrations(connection, dry_run=dry_run)
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
 
 if __name__ == "__main__":
-    create_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create or migrate the library database")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print pending migrations and current query plans without applying them")
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help="recompute the per-book rating and loan aggregates from history")
+    parser.add_argument('--verify-stats', action='store_true',
+                        help="report books whose stored aggregates drifted from history")
+    args = parser.parse_args()
+    if args.dry_run:
+        migrate(dry_run=True)
+    elif args.rebuild_stats:
+        rebuild_book_stats()
+    elif args.verify_stats:
+        verify_book_stats()
+    else:
+        create_database()
\ No newline at end of file
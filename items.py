@@ -0,0 +1,282 @@
+from mysql.connector import Error
+import argparse
+import time
+import storage
+from storage import connect
+
+# Per-copy inventory. Every physical copy is a row in items with its own
+# barcode, branch and status, and each loan records the copy that went out.
+# branch_stock holds quantity and available_quantity per branch and title,
+# and the same columns on books roll them up across branches. All of them
+# are counters over the items rows: circulation moves them one step at a
+# time in the same transaction as the copy (see adjust_stock), and everything
+# else recomputes them from items (see refresh_counts).
+#
+# Copy status: available, loaned, held (set aside for a ready hold), transit
+# (on its way to another branch) or withdrawn (no longer in stock, kept for
+# loan history).
+
+DEFAULT_BRANCH = 1
+BATCH_SIZE = 1000
+# Copies numbered per title, counting withdrawn ones. Generated barcodes are
+# "<book_id>-<copy number>", which no other title's barcodes can match.
+MAX_COPIES = 9999
+
+# Recomputes both counters from items; callers add the WHERE clause
+REFRESH_COUNTS = """
+    UPDATE books SET
+        quantity = (SELECT COUNT(*) FROM items i WHERE i.book_id = books.book_id AND i.status <> 'withdrawn'),
+        available_quantity = (SELECT COUNT(*) FROM items i WHERE i.book_id = books.book_id AND i.status = 'available')
+"""
+# Per-branch counters from items; callers add the WHERE and GROUP BY clauses
+BRANCH_COUNTS = """
+    SELECT branch_id, book_id,
+           SUM(CASE WHEN status <> 'withdrawn' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN status = 'available' THEN 1 ELSE 0 END)
+    FROM items
+"""
+
+def copy_barcode(book_id, copy_number):
+    return f"{book_id}-{copy_number}"
+
+def find_item(cursor, barcode):
+    # The desk's lookup: one probe of the unique barcode index
+    cursor.execute("SELECT item_id, book_id, status FROM items WHERE barcode = %s", (barcode,))
+    return cursor.fetchone()
+
+def adjust_stock(cursor, book_id, branch_id, quantity=0, available=0):
+    # Moves the branch's counters and the rolled-up ones on books together
+    cursor.execute("""
+        UPDATE books SET quantity = quantity + %s, available_quantity = available_quantity + %s
+        WHERE book_id = %s
+    """, (quantity, available, book_id))
+    cursor.execute(storage.query('adjust_branch_stock'), (branch_id, book_id, quantity, available))
+
+def take_copy(cursor, book_id, item_id=None, branch_id=None, status='loaned'):
+    # Takes a copy off the shelf, the given one or any (at the given branch),
+    # and gives it `status`; returns its id, or None if there is none.
+    # Callers hold the book row lock, which serializes borrowers of the title.
+    if item_id is not None:
+        cursor.execute("SELECT item_id, branch_id FROM items WHERE item_id = %s AND book_id = %s AND status = 'available'",
+                       (item_id, book_id))
+    elif branch_id is not None:
+        # The branch's own slice of idx_items_branch_book
+        cursor.execute("""
+            SELECT item_id, branch_id FROM items
+            WHERE branch_id = %s AND book_id = %s AND status = 'available'
+            ORDER BY item_id
+            LIMIT 1
+        """, (branch_id, book_id))
+    else:
+        cursor.execute("""
+            SELECT item_id, branch_id FROM items
+            WHERE book_id = %s AND status = 'available'
+            ORDER BY item_id
+            LIMIT 1
+        """, (book_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    item_id, branch_id = row
+    cursor.execute("UPDATE items SET status = %s WHERE item_id = %s AND status = 'available'", (status, item_id))
+    if cursor.rowcount == 0:
+        return None
+    adjust_stock(cursor, book_id, branch_id, available=-1)
+    return item_id
+
+def shelve_copy(cursor, book_id, item_id):
+    cursor.execute("SELECT branch_id FROM items WHERE item_id = %s", (item_id,))
+    branch_id = cursor.fetchone()[0]
+    cursor.execute("UPDATE items SET status = 'available' WHERE item_id = %s", (item_id,))
+    adjust_stock(cursor, book_id, branch_id, available=1)
+
+def move_copy(cursor, book_id, item_id, branch_id):
+    # Rehomes a copy that is off the shelf (lent, held or in transit) at the
+    # branch it arrived at
+    cursor.execute("SELECT branch_id FROM items WHERE item_id = %s", (item_id,))
+    old_branch_id = cursor.fetchone()[0]
+    if old_branch_id == branch_id:
+        return
+    cursor.execute("UPDATE items SET branch_id = %s WHERE item_id = %s", (branch_id, item_id))
+    cursor.execute(storage.query('adjust_branch_stock'), (old_branch_id, book_id, -1, 0))
+    cursor.execute(storage.query('adjust_branch_stock'), (branch_id, book_id, 1, 0))
+
+def add_copies(cursor, book_id, count, branch_id=DEFAULT_BRANCH):
+    # Counters are left to the caller's refresh_counts()
+    cursor.execute("SELECT COUNT(*) FROM items WHERE book_id = %s", (book_id,))
+    numbered = cursor.fetchone()[0]
+    if numbered + count > MAX_COPIES:
+        raise Error(msg=f"a title can have at most {MAX_COPIES} copies, counting withdrawn ones")
+    cursor.executemany("INSERT INTO items (book_id, barcode, branch_id, status) VALUES (%s, %s, %s, 'available')",
+                       [(book_id, copy_barcode(book_id, numbered + n), branch_id) for n in range(1, count + 1)])
+
+def refresh_counts(cursor, book_ids):
+    placeholders = ', '.join(['%s'] * len(book_ids))
+    cursor.execute(f"{REFRESH_COUNTS} WHERE book_id IN ({placeholders})", book_ids)
+    cursor.execute(f"DELETE FROM branch_stock WHERE book_id IN ({placeholders})", book_ids)
+    cursor.execute(f"""
+        INSERT INTO branch_stock (branch_id, book_id, quantity, available_quantity)
+        {BRANCH_COUNTS}
+        WHERE book_id IN ({placeholders})
+        GROUP BY branch_id, book_id
+    """, book_ids)
+
+def set_copy_count(cursor, book_id, quantity, branch_id=DEFAULT_BRANCH):
+    # Adds copies at the branch, or withdraws ones on the shelf anywhere,
+    # until the book has `quantity` in stock. Returns False, changing
+    # nothing, when more copies would have to go than are on the shelf.
+    cursor.execute("""
+        SELECT COALESCE(SUM(CASE WHEN status <> 'withdrawn' THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN status = 'available' THEN 1 ELSE 0 END), 0)
+        FROM items
+        WHERE book_id = %s
+    """, (book_id,))
+    copies, on_shelf = cursor.fetchone()
+    if copies - quantity > on_shelf:
+        return False
+    if quantity > copies:
+        add_copies(cursor, book_id, quantity - copies, branch_id)
+    elif quantity < copies:
+        cursor.execute("""
+            SELECT item_id FROM items
+            WHERE book_id = %s AND status = 'available'
+            ORDER BY item_id DESC
+            LIMIT %s
+        """, (book_id, copies - quantity))
+        withdrawn = [row[0] for row in cursor.fetchall()]
+        placeholders = ', '.join(['%s'] * len(withdrawn))
+        cursor.execute(f"UPDATE items SET status = 'withdrawn' WHERE item_id IN ({placeholders})", withdrawn)
+    refresh_counts(cursor, [book_id])
+    return True
+
+# Reconciliation. Counter drift is repaired from the items table; copies
+# whose status disagrees with the loans, holds and transfers are only
+# reported, since fixing them needs someone to look at the shelf.
+
+DRIFT_QUERY = """
+    SELECT b.book_id, b.quantity, b.available_quantity,
+           COALESCE(c.copies, 0) as copies, COALESCE(c.on_shelf, 0) as on_shelf
+    FROM books b
+    LEFT JOIN (
+        SELECT book_id,
+               SUM(CASE WHEN status <> 'withdrawn' THEN 1 ELSE 0 END) as copies,
+               SUM(CASE WHEN status = 'available' THEN 1 ELSE 0 END) as on_shelf
+        FROM items
+        WHERE book_id > %s AND book_id <= %s
+        GROUP BY book_id
+    ) c ON c.book_id = b.book_id
+    WHERE b.book_id > %s AND b.book_id <= %s
+      AND (b.quantity <> COALESCE(c.copies, 0) OR b.available_quantity <> COALESCE(c.on_shelf, 0))
+"""
+
+# Branch rows that disagree with the copies, and branch rows left over for a
+# branch that has no copies of the title at all
+BRANCH_DRIFT_QUERY = """
+    SELECT c.branch_id, c.book_id, COALESCE(s.quantity, 0) as quantity,
+           COALESCE(s.available_quantity, 0) as available_quantity, c.copies, c.on_shelf
+    FROM (
+        SELECT branch_id, book_id,
+               SUM(CASE WHEN status <> 'withdrawn' THEN 1 ELSE 0 END) as copies,
+               SUM(CASE WHEN status = 'available' THEN 1 ELSE 0 END) as on_shelf
+        FROM items
+        WHERE book_id > %s AND book_id <= %s
+        GROUP BY branch_id, book_id
+    ) c
+    LEFT JOIN branch_stock s ON s.branch_id = c.branch_id AND s.book_id = c.book_id
+    WHERE COALESCE(s.quantity, 0) <> c.copies OR COALESCE(s.available_quantity, 0) <> c.on_shelf
+    UNION ALL
+    SELECT s.branch_id, s.book_id, s.quantity, s.available_quantity, 0, 0
+    FROM branch_stock s
+    WHERE s.book_id > %s AND s.book_id <= %s
+      AND NOT EXISTS (SELECT 1 FROM items i WHERE i.branch_id = s.branch_id AND i.book_id = s.book_id)
+"""
+
+MISMATCHES = {
+    "open loans without a copy":
+        "SELECT COUNT(*) FROM loans WHERE return_date IS NULL AND item_id IS NULL",
+    "open loans of a copy not marked loaned":
+        """SELECT COUNT(*) FROM loans l JOIN items i ON i.item_id = l.item_id
+           WHERE l.return_date IS NULL AND i.status <> 'loaned'""",
+    "copies marked loaned with no open loan":
+        """SELECT COUNT(*) FROM items i WHERE i.status = 'loaned'
+           AND NOT EXISTS (SELECT 1 FROM loans l WHERE l.item_id = i.item_id AND l.return_date IS NULL)""",
+    "copies marked held with no ready hold":
+        """SELECT COUNT(*) FROM items i WHERE i.status = 'held'
+           AND NOT EXISTS (SELECT 1 FROM holds h WHERE h.item_id = i.item_id AND h.status = 'ready')""",
+    "copies in transit with no open transfer":
+        """SELECT COUNT(*) FROM items i WHERE i.status = 'transit'
+           AND NOT EXISTS (SELECT 1 FROM transfers t WHERE t.item_id = i.item_id AND t.status = 'in_transit')""",
+}
+
+def reconcile(fix=True, batch_size=BATCH_SIZE):
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor(dictionary=True)
+        start = time.perf_counter()
+        cursor.execute("SELECT COALESCE(MAX(book_id), 0) as last FROM books")
+        last_id = cursor.fetchone()['last']
+        drifted = 0
+        # One short transaction per range of book ids
+        for low in range(0, last_id, batch_size):
+            high = low + batch_size
+            cursor.execute(DRIFT_QUERY, (low, high, low, high))
+            rows = cursor.fetchall()
+            for row in rows:
+                print(f"Book {row['book_id']}: quantity {row['quantity']}/{row['copies']}, "
+                      f"available {row['available_quantity']}/{row['on_shelf']}")
+            cursor.execute(BRANCH_DRIFT_QUERY, (low, high, low, high))
+            branch_rows = cursor.fetchall()
+            for row in branch_rows:
+                print(f"Book {row['book_id']} at branch {row['branch_id']}: quantity {row['quantity']}/{row['copies']}, "
+                      f"available {row['available_quantity']}/{row['on_shelf']}")
+            book_ids = sorted({row['book_id'] for row in rows + branch_rows})
+            if book_ids and fix:
+                refresh_counts(cursor, book_ids)
+                connection.commit()
+            drifted += len(book_ids)
+        action = "recounted" if fix else "with drifted counts"
+        print(f"{drifted} book(s) {action} ({time.perf_counter() - start:.1f}s)")
+        cursor = connection.cursor()
+        for description, sql in MISMATCHES.items():
+            cursor.execute(sql)
+            mismatched = cursor.fetchone()[0]
+            if mismatched:
+                print(f"{mismatched} {description}")
+        connection.close()
+        return drifted
+    except Error as e:
+        print(f"Error: {e}")
+
+def lookup(barcode):
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT i.item_id, b.title, i.status, br.name, l.user_id, l.due_date
+            FROM items i
+            JOIN books b ON b.book_id = i.book_id
+            JOIN branches br ON br.branch_id = i.branch_id
+            LEFT JOIN loans l ON l.item_id = i.item_id AND l.return_date IS NULL
+            WHERE i.barcode = %s
+        """, (barcode,))
+        row = cursor.fetchone()
+        if row is None:
+            print(f"No copy has barcode {barcode}")
+        else:
+            item_id, title, status, branch, user_id, due_date = row
+            loan = f", lent to user {user_id} until {due_date}" if user_id else ""
+            print(f"Copy {item_id} of '{title}' at {branch}: {status}{loan}")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile book counts with the per-copy inventory")
+    parser.add_argument('--dry-run', action='store_true', help="report drift without fixing it")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="book ids per transaction")
+    parser.add_argument('--lookup', metavar='BARCODE', help="print where one copy is")
+    args = parser.parse_args()
+    if args.lookup:
+        lookup(args.lookup)
+    else:
+        reconcile(fix=not args.dry_run, batch_size=args.batch_size)
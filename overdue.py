@@ -0,0 +1,73 @@
+from mysql.connector import Error
+from datetime import date, datetime, timedelta
+import argparse
+import os
+import time
+from storage import connect
+
+# Loan policy for categories without a row in loan_policies
+DEFAULT_LOAN_DAYS = int(os.getenv('LOAN_DAYS', 14))
+DEFAULT_DAILY_FINE = float(os.getenv('DAILY_FINE', 0.25))
+BATCH_SIZE = 1000
+
+def loan_due_date(cursor, book_id, loan_date):
+    # Expects a plain (tuple) cursor, as used by the borrow transaction
+    cursor.execute("""
+        SELECT p.loan_days
+        FROM books b
+        LEFT JOIN loan_policies p ON p.category_id = b.category_id
+        WHERE b.book_id = %s
+    """, (book_id,))
+    row = cursor.fetchone()
+    loan_days = row[0] if row and row[0] is not None else DEFAULT_LOAN_DAYS
+    return loan_date + timedelta(days=loan_days)
+
+def fine_for(days_overdue, daily_fine):
+    return round(days_overdue * float(daily_fine), 2)
+
+def refresh_overdue(as_of=None):
+    # Rebuilds the overdue_loans snapshot read by the report page. Only open
+    # loans past their due date are read, through idx_loans_open_due.
+    as_of = as_of or date.today()
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        start = time.perf_counter()
+        cursor.execute("""
+            SELECT l.id, l.user_id, l.book_id, b.title, u.username, l.loan_date, l.due_date,
+                   COALESCE(p.daily_fine, %s)
+            FROM loans l
+            JOIN books b ON b.book_id = l.book_id
+            JOIN users u ON u.user_id = l.user_id
+            LEFT JOIN loan_policies p ON p.category_id = b.category_id
+            WHERE l.return_date IS NULL AND l.due_date < %s
+        """, (DEFAULT_DAILY_FINE, as_of))
+        refreshed_at = datetime.now().replace(microsecond=0)
+        rows = []
+        for loan_id, user_id, book_id, title, username, loan_date, due_date, daily_fine in cursor.fetchall():
+            days_overdue = (as_of - due_date).days
+            rows.append((loan_id, user_id, book_id, title, username, loan_date, due_date,
+                         days_overdue, fine_for(days_overdue, daily_fine), refreshed_at))
+
+        # Replace the snapshot in one transaction so the report never sees it
+        # half built
+        cursor.execute("DELETE FROM overdue_loans")
+        for batch_start in range(0, len(rows), BATCH_SIZE):
+            cursor.executemany("""
+                INSERT INTO overdue_loans (loan_id, user_id, book_id, title, username, loan_date, due_date,
+                                           days_overdue, fine, refreshed_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, rows[batch_start:batch_start + BATCH_SIZE])
+        connection.commit()
+        total_fines = sum(row[8] for row in rows)
+        print(f"{len(rows)} overdue loans, {total_fines:.2f} in fines, as of {as_of} "
+              f"({time.perf_counter() - start:.1f}s)")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the overdue loans list and fines shown on the report page")
+    parser.add_argument('--as-of', type=date.fromisoformat, help="date to compute overdue days for (default today)")
+    args = parser.parse_args()
+    refresh_overdue(args.as_of)
@@ -0,0 +1,337 @@
+from mysql.connector import Error
+from collections import Counter, defaultdict
+import argparse
+import functools
+import random
+import statistics
+import time
+import numpy as np
+import storage
+from storage import connect
+
+NEIGHBORS_PER_BOOK = 50
+RECOMMENDATIONS_PER_USER = 20
+# Very long histories add little signal but cost quadratic pair counting
+MAX_BASKET_SIZE = 200
+# Book pairs counted at once while building similarities
+PAIR_CHUNK = 5_000_000
+AFFINITY_WEIGHT = 0.1
+BATCH_SIZE = 500
+
+# Serving
+
+def fetch_recommendations(cursor, user_id, limit=5):
+    cursor.execute("""
+        SELECT b.book_id, b.title, b.author, b.genre, c.name as category_name, s.avg_rating
+        FROM user_recommendations ur
+        JOIN books b ON b.book_id = ur.book_id
+        LEFT JOIN categories c ON b.category_id = c.category_id
+        LEFT JOIN book_stats s ON s.book_id = b.book_id
+        WHERE ur.user_id = %s
+        ORDER BY ur.score DESC
+        LIMIT %s
+    """, (user_id, limit))
+    return cursor.fetchall()
+
+def refresh_user_recommendations(cursor, user_id, book_id):
+    # Called inside the borrow/review transaction: the book stops being a
+    # recommendation and its precomputed neighbours are folded into the
+    # user's list until the next batch run re-ranks everything.
+    cursor.execute("DELETE FROM user_recommendations WHERE user_id = %s AND book_id = %s", (user_id, book_id))
+    cursor.execute(storage.query('add_similar_recommendations'), (user_id, book_id, user_id))
+
+def recommend_with_sql(cursor, user_id, limit=5):
+    # Per-request query used before recommendations were precomputed. Still
+    # serves users the batch job has not seen yet.
+    cursor.execute("""
+        SELECT DISTINCT b.book_id, b.title, b.author, b.genre, c.name as category_name
+        FROM books b
+        JOIN loans l ON b.book_id = l.book_id
+        JOIN categories c ON b.category_id = c.category_id
+        WHERE l.user_id = %s
+        UNION
+        SELECT DISTINCT b.book_id, b.title, b.author, b.genre, c.name as category_name
+        FROM books b
+        JOIN reviews r ON b.book_id = r.book_id
+        JOIN categories c ON b.category_id = c.category_id
+        WHERE r.user_id = %s AND r.rating >= 4
+    """, (user_id, user_id))
+    user_preferences = cursor.fetchall()
+
+    if not user_preferences:
+        return []
+
+    genres = set(book['genre'] for book in user_preferences)
+    categories = set(book['category_name'] for book in user_preferences)
+
+    placeholders = ', '.join(['%s'] * len(genres))
+    category_placeholders = ', '.join(['%s'] * len(categories))
+
+    cursor.execute(f"""
+        SELECT b.book_id, b.title, b.author, b.genre, c.name as category_name,
+               AVG(r.rating) as avg_rating
+        FROM books b
+        LEFT JOIN reviews r ON b.book_id = r.book_id
+        JOIN categories c ON b.category_id = c.category_id
+        WHERE b.genre IN ({placeholders})
+           OR c.name IN ({category_placeholders})
+           AND b.book_id NOT IN (
+               SELECT book_id FROM loans WHERE user_id = %s
+           )
+        GROUP BY b.book_id
+        ORDER BY avg_rating IS NULL, avg_rating DESC
+        LIMIT %s
+    """, (*genres, *categories, user_id, limit))
+    return cursor.fetchall()
+
+# Batch model
+
+def load_interactions(cursor):
+    # user_id -> {book_id: most recent interaction date}; loans and positive
+    # reviews both count as a signal of interest, archived history included
+    interactions = defaultdict(dict)
+    cursor.execute("""
+        SELECT user_id, book_id, MAX(loan_date) FROM loan_history GROUP BY user_id, book_id
+        UNION ALL
+        SELECT user_id, book_id, MAX(review_date) FROM review_history WHERE rating >= 4 GROUP BY user_id, book_id
+    """)
+    for user_id, book_id, last_date in cursor:
+        items = interactions[user_id]
+        if book_id not in items or items[book_id] < last_date:
+            items[book_id] = last_date
+    return interactions
+
+def load_books(cursor):
+    cursor.execute("""
+        SELECT b.book_id, b.genre, b.category_id, COALESCE(s.avg_rating, 0)
+        FROM books b
+        LEFT JOIN book_stats s ON s.book_id = b.book_id
+    """)
+    return {book_id: {'genre': genre, 'category_id': category_id, 'avg_rating': float(avg_rating)}
+            for book_id, genre, category_id, avg_rating in cursor}
+
+def build_similarities(baskets):
+    # Cosine similarity between the book columns of the sparse user x book
+    # matrix. Co-occurrence is counted only for books that share a reader, and
+    # both the counting and the top NEIGHBORS_PER_BOOK cut work in chunks of
+    # about PAIR_CHUNK pairs so memory stays bounded on large libraries.
+    histories = [sorted(basket, key=basket.get, reverse=True)[:MAX_BASKET_SIZE] for basket in baskets.values()]
+    book_ids, columns = np.unique(np.fromiter((book_id for items in histories for book_id in items), dtype=np.int64),
+                                  return_inverse=True)
+    size = len(book_ids)
+    popularity = np.bincount(columns, minlength=size)
+    first, second, counts = co_occurrence(histories, columns, size)
+    scores = counts / np.sqrt(popularity[first] * popularity[second])
+
+    similarities = {}
+    neighbours = np.bincount(first, minlength=size) + np.bincount(second, minlength=size)
+    edges = np.searchsorted(np.cumsum(neighbours), np.arange(PAIR_CHUNK, len(first) * 2, PAIR_CHUNK)) + 1
+    bounds = [0, *np.unique(edges[edges < size]).tolist(), size]
+    for low, high in zip(bounds, bounds[1:]):
+        # Both directions of every pair touching books low..high; pairs are
+        # ordered by their first book, so that side is a slice
+        head = slice(*np.searchsorted(first, [low, high]))
+        tail = (second >= low) & (second < high)
+        sources = np.concatenate([first[head], second[tail]])
+        targets = np.concatenate([second[head], first[tail]])
+        block_scores = np.concatenate([scores[head], scores[tail]])
+        # Scores lie in (0, 1], so one sort groups by book and puts the best
+        # neighbours first within it
+        order = np.argsort(2.0 * sources + (1.0 - block_scores))
+        sources, targets, block_scores = sources[order], targets[order], block_scores[order]
+        block_neighbours = neighbours[low:high]
+        rank = np.arange(len(sources)) - (np.cumsum(block_neighbours) - block_neighbours)[sources - low]
+        keep = rank < NEIGHBORS_PER_BOOK
+        for book_id, other_id, score in zip(book_ids[sources[keep]].tolist(), book_ids[targets[keep]].tolist(),
+                                            block_scores[keep].tolist()):
+            similarities.setdefault(book_id, []).append((other_id, score))
+    return similarities
+
+def co_occurrence(histories, columns, size):
+    # Number of readers of every pair of book columns that share one, as
+    # (first, second, count) arrays ordered by first with first < second.
+    # columns holds each history's books in turn.
+    chunks, pending, pending_pairs, start = [], [], 0, 0
+    for items in histories:
+        basket = np.sort(columns[start:start + len(items)])
+        start += len(items)
+        if len(basket) < 2:
+            continue
+        upper, lower = upper_triangle(len(basket))
+        pending.append(basket[upper] * size + basket[lower])
+        pending_pairs += len(upper)
+        if pending_pairs >= PAIR_CHUNK:
+            chunks.append(np.unique(np.concatenate(pending), return_counts=True))
+            pending, pending_pairs = [], 0
+    if pending:
+        chunks.append(np.unique(np.concatenate(pending), return_counts=True))
+    if not chunks:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    if len(chunks) == 1:
+        codes, counts = chunks[0]
+    else:
+        codes, positions = np.unique(np.concatenate([codes for codes, _ in chunks]), return_inverse=True)
+        counts = np.bincount(positions, weights=np.concatenate([counts for _, counts in chunks]))
+    first, second = np.divmod(codes, size)
+    return first, second, counts
+
+@functools.lru_cache(maxsize=MAX_BASKET_SIZE)
+def upper_triangle(size):
+    return np.triu_indices(size, 1)
+
+def build_top_rated_by_genre(books):
+    by_genre = defaultdict(list)
+    for book_id, book in books.items():
+        by_genre[book['genre']].append(book_id)
+    return {genre: sorted(ids, key=lambda b: books[b]['avg_rating'], reverse=True)[:NEIGHBORS_PER_BOOK]
+            for genre, ids in by_genre.items()}
+
+def recommend_for_user(basket, similarities, books, top_rated_by_genre, limit=RECOMMENDATIONS_PER_USER):
+    # basket maps the user's books to their last interaction date
+    if not basket:
+        return []
+
+    # Genre and category affinity: the share of the user's history in each
+    genres = Counter(books[b]['genre'] for b in basket if b in books)
+    categories = Counter(books[b]['category_id'] for b in basket if b in books)
+    total = sum(genres.values()) or 1
+
+    def affinity(book_id):
+        book = books.get(book_id)
+        if not book:
+            return 0
+        return (genres[book['genre']] + categories[book['category_id']]) / (2 * total)
+
+    scores = defaultdict(float)
+    for book_id in basket:
+        for other_id, score in similarities.get(book_id, ()):
+            if other_id not in basket:
+                scores[other_id] += score
+    for book_id in scores:
+        scores[book_id] += AFFINITY_WEIGHT * affinity(book_id)
+
+    # Thin co-borrow data: fill with the best rated books of favourite genres
+    if len(scores) < limit:
+        for genre, _ in genres.most_common(3):
+            for book_id in top_rated_by_genre.get(genre, ()):
+                if book_id not in basket and book_id not in scores:
+                    scores[book_id] = AFFINITY_WEIGHT * affinity(book_id) * 0.5
+
+    ranked = sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+    return ranked[:limit]
+
+def store_similarities(connection, similarities):
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM book_similarities")
+    rows = [(book_id, other_id, score)
+            for book_id, neighbours in similarities.items()
+            for other_id, score in neighbours]
+    for start in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany("INSERT INTO book_similarities (book_id, similar_book_id, score) VALUES (%s, %s, %s)",
+                           rows[start:start + BATCH_SIZE])
+    connection.commit()
+
+def store_recommendations(connection, recommendations):
+    cursor = connection.cursor()
+    users = list(recommendations)
+    # Replace each batch of users in its own transaction so readers never
+    # see an empty table while the job runs
+    for start in range(0, len(users), BATCH_SIZE):
+        batch = users[start:start + BATCH_SIZE]
+        placeholders = ', '.join(['%s'] * len(batch))
+        cursor.execute(f"DELETE FROM user_recommendations WHERE user_id IN ({placeholders})", batch)
+        rows = [(user_id, book_id, score) for user_id in batch for book_id, score in recommendations[user_id]]
+        if rows:
+            cursor.executemany("INSERT INTO user_recommendations (user_id, book_id, score) VALUES (%s, %s, %s)", rows)
+        connection.commit()
+
+def build_recommendations():
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor()
+        start = time.perf_counter()
+        interactions = load_interactions(cursor)
+        books = load_books(cursor)
+        similarities = build_similarities(interactions)
+        top_rated_by_genre = build_top_rated_by_genre(books)
+        recommendations = {user_id: recommend_for_user(basket, similarities, books, top_rated_by_genre)
+                           for user_id, basket in interactions.items()}
+        print(f"Built recommendations for {len(recommendations)} users "
+              f"from {len(similarities)} books in {time.perf_counter() - start:.1f}s")
+        store_similarities(connection, similarities)
+        store_recommendations(connection, recommendations)
+        print(f"Recommendations stored in {time.perf_counter() - start:.1f}s")
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+# Benchmark
+
+def summarize(name, timings, hits, sample_size, limit):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1] if len(timings_ms) >= 20 else timings_ms[-1]
+    print(f"{name:<12} mean {statistics.mean(timings_ms):8.2f} ms   p95 {p95:8.2f} ms   "
+          f"hit rate@{limit} {hits / sample_size:.3f}")
+
+def benchmark(sample_size=200, limit=5):
+    # Holds out each sampled user's most recent interaction and checks whether
+    # each path recommends it. The SQL path sees the held-out rows deleted
+    # inside a transaction that is always rolled back; run this against a
+    # copy of the database rather than the live one.
+    try:
+        connection = connect('library_management')
+        cursor = connection.cursor(dictionary=True)
+        plain_cursor = connection.cursor()
+        interactions = load_interactions(plain_cursor)
+        books = load_books(plain_cursor)
+        users = [user_id for user_id, items in interactions.items() if len(items) >= 2]
+        if not users:
+            print("Not enough loan history to benchmark")
+            return
+        sample = random.Random(42).sample(users, min(sample_size, len(users)))
+        held_out = {user_id: max(interactions[user_id], key=interactions[user_id].get) for user_id in sample}
+
+        baskets = {user_id: {book_id: last_date for book_id, last_date in items.items()
+                             if book_id != held_out.get(user_id)}
+                   for user_id, items in interactions.items()}
+        similarities = build_similarities(baskets)
+        top_rated_by_genre = build_top_rated_by_genre(books)
+        engine_hits = 0
+        for user_id in sample:
+            ranked = recommend_for_user(baskets[user_id], similarities, books, top_rated_by_genre, limit)
+            engine_hits += held_out[user_id] in {book_id for book_id, _ in ranked}
+
+        sql_timings, sql_hits = [], 0
+        for user_id in sample:
+            cursor.execute("DELETE FROM loans WHERE user_id = %s AND book_id = %s", (user_id, held_out[user_id]))
+            cursor.execute("DELETE FROM reviews WHERE user_id = %s AND book_id = %s", (user_id, held_out[user_id]))
+            start = time.perf_counter()
+            recommendations = recommend_with_sql(cursor, user_id, limit)
+            sql_timings.append(time.perf_counter() - start)
+            connection.rollback()
+            sql_hits += held_out[user_id] in {book['book_id'] for book in recommendations}
+
+        lookup_timings = []
+        for user_id in sample:
+            start = time.perf_counter()
+            fetch_recommendations(cursor, user_id, limit)
+            lookup_timings.append(time.perf_counter() - start)
+
+        print(f"{len(sample)} users, {len(books)} books")
+        summarize("SQL", sql_timings, sql_hits, len(sample), limit)
+        summarize("Precomputed", lookup_timings, engine_hits, len(sample), limit)
+        connection.close()
+    except Error as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build precomputed book recommendations")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="compare latency and hit rate of the SQL and precomputed paths")
+    parser.add_argument('--sample', type=int, default=200, help="users sampled by --benchmark")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(sample_size=args.sample)
+    else:
+        build_recommendations()
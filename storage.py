@@ -0,0 +1,509 @@
+import mysql.connector
+from mysql.connector import errors, pooling
+from mysql.connector.errors import PoolError
+from dotenv import load_dotenv
+from collections import deque
+from datetime import date, datetime
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+load_dotenv()
+
+# Storage backends. DB_BACKEND picks MySQL (the default) or an embedded
+# SQLite database file for single-node deployments and CI. Everything that
+# differs between the two lives in this module; callers write MySQL-style
+# %s placeholders and catch mysql.connector errors for either backend.
+BACKEND = os.getenv('DB_BACKEND', 'mysql').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'library.db')
+# Compiled statements kept per SQLite connection and reused on re-execution
+SQLITE_STATEMENT_CACHE = 256
+# Read replicas: MySQL hosts (host or host:port, same credentials as the
+# primary) or, for SQLite, database files kept up to date by a replication
+# tool. Comma separated; empty means every read goes to the primary.
+REPLICAS = [replica.strip() for replica in os.getenv('DB_REPLICAS', '').split(',') if replica.strip()]
+
+SQLITE_PRAGMAS = (
+    # Readers never block the writer and the writer never blocks readers
+    "PRAGMA journal_mode = WAL",
+    # Durable at checkpoints; with WAL a crash can lose only the last commits
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+def mysql_config(database=None, replica=None):
+    config = dict(
+        host=os.getenv('DB_HOST'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD')
+    )
+    if replica:
+        host, _, port = replica.partition(':')
+        config['host'] = host
+        if port:
+            config['port'] = int(port)
+    if database:
+        config['database'] = database
+    return config
+
+def connect(database=None, replica=None):
+    if BACKEND == 'sqlite':
+        # The file is the database, so there is nothing to select
+        return SQLiteConnection(replica or SQLITE_PATH)
+    return mysql.connector.connect(**mysql_config(database, replica))
+
+def create_pool(pool_size, replica=None):
+    if BACKEND == 'sqlite':
+        return SQLitePool(replica or SQLITE_PATH, pool_size)
+    return pooling.MySQLConnectionPool(
+        pool_name=f"library_replica_{replica}" if replica else "library_pool",
+        pool_size=pool_size,
+        pool_reset_session=True,
+        **mysql_config('library_management', replica)
+    )
+
+# SQLite adapter. Mirrors the parts of the mysql.connector connection and
+# cursor API the app uses.
+
+@functools.lru_cache(maxsize=SQLITE_STATEMENT_CACHE)
+def to_qmark(operation):
+    return operation.replace('%s', '?')
+
+def dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+def translate_error(e):
+    # A busy database maps to MySQL's lock wait timeout so run_transaction()
+    # retries it like any other lock conflict
+    message = str(e)
+    if isinstance(e, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=message, errno=1062 if 'UNIQUE' in message else 1452)
+    if isinstance(e, sqlite3.OperationalError) and ('locked' in message or 'busy' in message):
+        return errors.DatabaseError(msg=message, errno=1205)
+    return errors.DatabaseError(msg=message)
+
+class SQLiteCursor:
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        if dictionary:
+            cursor.row_factory = dict_row
+        self._fetched = 0
+
+    def execute(self, operation, params=()):
+        self._fetched = 0
+        try:
+            self._cursor.execute(to_qmark(operation), tuple(params or ()))
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def executemany(self, operation, seq_params):
+        self._fetched = 0
+        try:
+            self._cursor.executemany(to_qmark(operation), seq_params)
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._fetched += 1
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._fetched += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._fetched += 1
+            yield row
+
+    @property
+    def rowcount(self):
+        # SQLite reports -1 for SELECTs; count what was fetched, like MySQL
+        return self._fetched if self._cursor.rowcount == -1 else self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection:
+    def __init__(self, path, pool=None):
+        self._path = path
+        self._pool = pool
+        self._cnx = None
+        self.reconnect()
+
+    def reconnect(self):
+        if self._cnx is not None:
+            self._cnx.close()
+        try:
+            self._cnx = sqlite3.connect(self._path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                        check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+            for pragma in SQLITE_PRAGMAS:
+                self._cnx.execute(pragma)
+            self.opened_at = time.monotonic()
+        except sqlite3.Error as e:
+            self._cnx = None
+            raise translate_error(e) from e
+
+    def is_connected(self):
+        return self._cnx is not None
+
+    def cursor(self, dictionary=False):
+        return SQLiteCursor(self._cnx.cursor(), dictionary)
+
+    def start_transaction(self, isolation_level=None):
+        # SQLite has a single writer; taking the write lock up front stops two
+        # readers from deadlocking when both try to upgrade. Every isolation
+        # level is serializable here.
+        try:
+            self._cnx.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def commit(self):
+        try:
+            self._cnx.commit()
+        except sqlite3.Error as e:
+            raise translate_error(e) from e
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def close(self):
+        if self._pool is not None:
+            # Like pool_reset_session: never hand back an open transaction
+            self._cnx.rollback()
+            self._pool.put_connection(self)
+        elif self._cnx is not None:
+            self._cnx.close()
+            self._cnx = None
+
+class SQLitePool:
+    # Same borrowing contract as MySQLConnectionPool: get_connection() raises
+    # PoolError when every connection is lent out and close() returns it
+    def __init__(self, path, pool_size):
+        self._path = path
+        self._pool_size = pool_size
+        self._idle = deque()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._opened >= self._pool_size:
+                raise PoolError("Failed getting connection; pool exhausted")
+            self._opened += 1
+        try:
+            return SQLiteConnection(self._path, pool=self)
+        except errors.Error:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def put_connection(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+def opened_at(connection):
+    # time.monotonic() when the database connection behind a pooled one was
+    # opened. SQLite connections record it themselves; a MySQL connection is
+    # stamped the first time it is seen, and again whenever its connection id
+    # changes because the pool or a recycle reconnected it.
+    if BACKEND == 'sqlite':
+        return connection.opened_at
+    cnx = connection._cnx
+    if getattr(cnx, 'opened_as', None) != cnx.connection_id:
+        cnx.opened_as = cnx.connection_id
+        cnx.opened_at = time.monotonic()
+    return cnx.opened_at
+
+# Schema introspection and DDL
+
+def list_tables(cursor):
+    if BACKEND == 'sqlite':
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    else:
+        cursor.execute("SHOW TABLES")
+    return {row[0] for row in cursor.fetchall()}
+
+def table_exists(cursor, table):
+    if BACKEND == 'sqlite':
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s
+        """, (table,))
+    return cursor.fetchone()[0] > 0
+
+def index_exists(cursor, table, index_name):
+    if BACKEND == 'sqlite':
+        cursor.execute("""
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = %s AND name = %s
+        """, (table, index_name))
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, index_name))
+    return cursor.fetchone()[0] > 0
+
+def column_exists(cursor, table, column):
+    if BACKEND == 'sqlite':
+        cursor.execute("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name = %s", (table, column))
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+    return cursor.fetchone()[0] > 0
+
+def ddl(statement):
+    # Table definitions are written for MySQL; SQLite only needs its own
+    # spelling of auto-increment keys and has no row formats
+    if BACKEND == 'sqlite':
+        return (statement.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT")
+                .replace("ROW_FORMAT=COMPRESSED", ""))
+    return statement
+
+def insert_ignore(statement):
+    # INSERT that skips rows whose key is already taken, for seed rows a
+    # re-run may find in place
+    return statement.replace("INSERT", "INSERT OR IGNORE" if BACKEND == 'sqlite' else "INSERT IGNORE", 1)
+
+def create_view(name, select):
+    if BACKEND == 'sqlite':
+        return f"CREATE VIEW IF NOT EXISTS {name} AS {select}"
+    return f"CREATE OR REPLACE VIEW {name} AS {select}"
+
+def create_index(table, index_name, columns):
+    if BACKEND == 'sqlite':
+        return f"CREATE INDEX {index_name} ON {table} ({columns})"
+    # Online DDL keeps the table readable and writable while the index builds
+    return f"ALTER TABLE {table} ADD INDEX {index_name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+
+def fulltext_table(table):
+    return f"{table}_fts"
+
+def fulltext_exists(cursor, table, index_name):
+    if BACKEND == 'sqlite':
+        return table_exists(cursor, fulltext_table(table))
+    return index_exists(cursor, table, index_name)
+
+def create_fulltext_index(table, index_name, columns, key):
+    if BACKEND != 'sqlite':
+        return [f"ALTER TABLE {table} ADD FULLTEXT INDEX {index_name} ({columns})"]
+    # An external-content FTS5 table indexes the rows in place; triggers keep
+    # it in step with the base table
+    fts = fulltext_table(table)
+    names = [c.strip() for c in columns.split(',')]
+    new_values = ', '.join(f"new.{c}" for c in names)
+    old_values = ', '.join(f"old.{c}" for c in names)
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5({columns}, content='{table}', content_rowid='{key}')",
+        f"""CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {columns}) VALUES (new.{key}, {new_values});
+        END""",
+        f"""CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {columns}) VALUES ('delete', old.{key}, {old_values});
+        END""",
+        f"""CREATE TRIGGER {fts}_update AFTER UPDATE OF {columns} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {columns}) VALUES ('delete', old.{key}, {old_values});
+            INSERT INTO {fts} (rowid, {columns}) VALUES (new.{key}, {new_values});
+        END""",
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+    ]
+
+def explain(cursor, query, params):
+    # One line per plan step
+    if BACKEND == 'sqlite':
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        return [row[3] for row in cursor.fetchall()]
+    cursor.execute(f"EXPLAIN {query}", params)
+    # id, select_type, table, partitions, type, possible_keys, key, key_len, ref, rows, filtered, Extra
+    return [f"table={row[2]} type={row[4]} key={row[6]} rows={row[9]} extra={row[11]}"
+            for row in cursor.fetchall()]
+
+# Dialect-specific queries
+
+def add_days(column, days):
+    # SQL expression for a DATE column moved forward by a whole number of days
+    if BACKEND == 'sqlite':
+        return f"date({column}, '+{int(days)} days')"
+    return f"DATE_ADD({column}, INTERVAL {int(days)} DAY)"
+
+def concat(*parts):
+    # SQL expression joining strings; SQLite before 3.44 has no CONCAT()
+    if BACKEND == 'sqlite':
+        return ' || '.join(parts)
+    return f"CONCAT({', '.join(parts)})"
+
+def update_from(table, column, value, sources, condition):
+    # UPDATE of one column of `table`, aliased t, from rows joined out of
+    # other tables or derived tables
+    if BACKEND == 'sqlite':
+        return f"UPDATE {table} AS t SET {column} = {value} FROM {sources} WHERE {condition}"
+    return f"UPDATE {table} t, {sources} SET t.{column} = {value} WHERE {condition}"
+
+def fulltext_search(columns, terms, after=None, limit_clause="", join="", join_params=()):
+    # Every term must match; the trailing * makes each one a prefix match so
+    # partially typed words still find results. Results are ranked by score,
+    # and `after` continues from the last row of the previous page. `join`
+    # adds a join to the books row, with its own parameters.
+    if BACKEND == 'sqlite':
+        params = [*join_params, ' '.join(f'"{term}"*' for term in terms)]
+        keyset = ""
+        if after:
+            keyset = "WHERE score < %s OR (score = %s AND book_id > %s)"
+            params += [after['score'], after['score'], after['book_id']]
+        # bm25() is lower for better matches; negate it to rank like MySQL
+        return f"""
+            SELECT * FROM (
+                SELECT {columns}, -bm25({fulltext_table('books')}) as score
+                FROM {fulltext_table('books')}
+                JOIN books b ON b.book_id = {fulltext_table('books')}.rowid
+                LEFT JOIN categories c ON b.category_id = c.category_id
+                {join}
+                WHERE {fulltext_table('books')} MATCH %s
+            ) matches
+            {keyset}
+            ORDER BY score DESC, book_id
+            {limit_clause}
+        """, params
+    against = ' '.join(f'+{term}*' for term in terms)
+    params = [against, *join_params, against]
+    keyset = ""
+    if after:
+        keyset = "HAVING score < %s OR (score = %s AND book_id > %s)"
+        params += [after['score'], after['score'], after['book_id']]
+    return f"""
+        SELECT {columns},
+               MATCH(b.title, b.author) AGAINST (%s IN BOOLEAN MODE) as score
+        FROM books b
+        LEFT JOIN categories c ON b.category_id = c.category_id
+        {join}
+        WHERE MATCH(b.title, b.author) AGAINST (%s IN BOOLEAN MODE)
+        {keyset}
+        ORDER BY score DESC, b.book_id
+        {limit_clause}
+    """, params
+
+# Column lists shared by the archive tables, their views and archive.py
+LOAN_COLUMNS = "id, user_id, book_id, loan_date, due_date, return_date"
+# Loans record the copy lent from migration 9 on
+ITEM_LOAN_COLUMNS = f"{LOAN_COLUMNS}, item_id"
+REVIEW_COLUMNS = "id, user_id, book_id, rating, comment, review_date"
+
+QUERIES = {
+    # Params: user_id, book_id, user_id
+    'add_similar_recommendations': {
+        'mysql': """
+            INSERT INTO user_recommendations (user_id, book_id, score)
+            SELECT %s, s.similar_book_id, s.score
+            FROM book_similarities s
+            WHERE s.book_id = %s
+              AND s.similar_book_id NOT IN (SELECT book_id FROM loans WHERE user_id = %s)
+            ON DUPLICATE KEY UPDATE score = user_recommendations.score + VALUES(score)
+        """,
+        'sqlite': """
+            INSERT INTO user_recommendations (user_id, book_id, score)
+            SELECT %s, s.similar_book_id, s.score
+            FROM book_similarities s
+            WHERE s.book_id = %s
+              AND s.similar_book_id NOT IN (SELECT book_id FROM loans WHERE user_id = %s)
+            ON CONFLICT (user_id, book_id) DO UPDATE SET score = score + excluded.score
+        """,
+    },
+    # Params: category_id, loan_days, daily_fine
+    'set_loan_policy': {
+        'mysql': """
+            INSERT INTO loan_policies (category_id, loan_days, daily_fine)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE loan_days = VALUES(loan_days), daily_fine = VALUES(daily_fine)
+        """,
+        'sqlite': """
+            INSERT INTO loan_policies (category_id, loan_days, daily_fine)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (category_id) DO UPDATE SET loan_days = excluded.loan_days, daily_fine = excluded.daily_fine
+        """,
+    },
+    # Existing ISBNs are updated in place; available copies move by the
+    # change in quantity
+    'upsert_book': {
+        # MySQL applies the assignments left to right, so quantity is still
+        # the old value when available_quantity is computed
+        'mysql': """
+            INSERT INTO books (title, author, isbn, publication_year, genre, description,
+                               quantity, available_quantity, category_id, cover_image)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                available_quantity = GREATEST(available_quantity + VALUES(quantity) - quantity, 0),
+                quantity = VALUES(quantity),
+                title = VALUES(title), author = VALUES(author),
+                publication_year = VALUES(publication_year), genre = VALUES(genre),
+                description = VALUES(description), category_id = VALUES(category_id),
+                cover_image = VALUES(cover_image)
+        """,
+        'sqlite': """
+            INSERT INTO books (title, author, isbn, publication_year, genre, description,
+                               quantity, available_quantity, category_id, cover_image)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (isbn) DO UPDATE SET
+                available_quantity = MAX(available_quantity + excluded.quantity - quantity, 0),
+                quantity = excluded.quantity,
+                title = excluded.title, author = excluded.author,
+                publication_year = excluded.publication_year, genre = excluded.genre,
+                description = excluded.description, category_id = excluded.category_id,
+                cover_image = excluded.cover_image
+        """,
+    },
+    # Locks a book row for the rest of the transaction; on SQLite the
+    # transaction already holds the write lock from BEGIN IMMEDIATE
+    'lock_book': {
+        'mysql': "SELECT available_quantity FROM books WHERE book_id = %s FOR UPDATE",
+        'sqlite': "SELECT available_quantity FROM books WHERE book_id = %s",
+    },
+    # Params: branch_id, book_id, change in quantity, change in available copies
+    'adjust_branch_stock': {
+        'mysql': """
+            INSERT INTO branch_stock (branch_id, book_id, quantity, available_quantity)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity),
+                                    available_quantity = available_quantity + VALUES(available_quantity)
+        """,
+        'sqlite': """
+            INSERT INTO branch_stock (branch_id, book_id, quantity, available_quantity)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (branch_id, book_id) DO UPDATE SET quantity = quantity + excluded.quantity,
+                available_quantity = available_quantity + excluded.available_quantity
+        """,
+    },
+    # Records a write-behind event as applied; affects no row if it already was
+    'claim_event': {
+        'mysql': "INSERT IGNORE INTO applied_events (event_id, applied_at) VALUES (%s, %s)",
+        'sqlite': "INSERT OR IGNORE INTO applied_events (event_id, applied_at) VALUES (%s, %s)",
+    },
+}
+
+def query(name):
+    return QUERIES[name][BACKEND]
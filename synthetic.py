@@ -0,0 +1,211 @@
+from mysql.connector import Error
+from datetime import date, timedelta
+import argparse
+import itertools
+import os
+import random
+import time
+import auth
+import items
+from storage import connect
+from init_db import create_database, rebuild_book_stats
+from overdue import DEFAULT_LOAN_DAYS, refresh_overdue
+from recommend import build_recommendations
+
+# Synthetic libraries for load tests and benchmarks. Everything is derived
+# from the seed, so the same arguments always build the same library.
+# Borrowing follows a Zipf-like popularity curve over books and over users,
+# so a few titles and readers account for most of the loans. Copies are
+# spread evenly over the branches.
+
+USER_PREFIX = 'synthetic_user_'
+PASSWORD = 'synthetic-password'
+BATCH_SIZE = 1000
+BOOK_SKEW = 1.1
+USER_SKEW = 0.8
+REVIEW_RATE = 0.3
+# Share of loans in the last LOST_WITHIN_DAYS never returned, which make up
+# the overdue list
+LOST_RATE = 0.02
+LOST_WITHIN_DAYS = 180
+
+CATEGORIES = ['Fiction', 'Mystery', 'Science Fiction', 'Fantasy', 'Biography', 'History',
+              'Science', 'Children', 'Poetry', 'Travel', 'Cooking', 'Philosophy']
+GENRES = ['Novel', 'Thriller', 'Romance', 'Adventure', 'Classic', 'Memoir', 'Essay',
+          'Reference', 'Short Stories', 'Graphic Novel']
+TITLE_WORDS = ['Shadow', 'River', 'Garden', 'Night', 'Silver', 'House', 'Winter', 'Stone', 'Light',
+               'Empire', 'Secret', 'Island', 'Journey', 'Glass', 'Storm', 'Memory', 'Forest', 'City',
+               'Crown', 'Harbor', 'Letter', 'Mountain', 'Daughter', 'Clock', 'Ocean', 'Library', 'Fire',
+               'Map', 'Summer', 'Wolf', 'Mirror', 'Road', 'Song', 'Bridge', 'Tower', 'Star']
+FIRST_NAMES = ['Ada', 'Ben', 'Clara', 'David', 'Elena', 'Farid', 'Grace', 'Hiro', 'Ines', 'Jonas',
+               'Kemi', 'Liam', 'Maya', 'Nikolai', 'Olga', 'Pablo', 'Quinn', 'Rosa', 'Samir', 'Tess']
+LAST_NAMES = ['Abbott', 'Brennan', 'Castillo', 'Dubois', 'Eriksen', 'Fischer', 'Garcia', 'Haddad',
+              'Ito', 'Jensen', 'Kowalski', 'Lindqvist', 'Moreau', 'Nakamura', 'Okafor', 'Petrov']
+BRANCH_NAMES = ['Riverside', 'Old Town', 'Northgate', 'Harbor', 'Hillcrest', 'Eastfield', 'Westbrook']
+COMMENTS = ['Loved it.', 'Could not put it down.', 'Slow start, strong finish.', 'Not for me.',
+            'A classic for a reason.', 'Good, but too long.', 'Would borrow again.', None]
+
+def cumulative_weights(count, skew):
+    # Rank r is drawn with probability proportional to 1 / r**skew
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+def isbn13(number):
+    digits = f"978{number:09d}"
+    check = (10 - sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits)) % 10) % 10
+    return digits + str(check)
+
+def generate(books=10000, users=2000, years=3, loans_per_user_year=12, seed=42, today=None, branches=1):
+    rng = random.Random(seed)
+    today = today or date.today()
+    library = {'categories': [(i, name) for i, name in enumerate(CATEGORIES, 1)]}
+    # Branch 1 is created with the schema; names repeat with a number once
+    # the list runs out
+    library['branches'] = []
+    for branch_id in range(2, branches + 1):
+        lap, index = divmod(branch_id - 2, len(BRANCH_NAMES))
+        library['branches'].append((branch_id, f"{BRANCH_NAMES[index]} {lap + 1}" if lap else BRANCH_NAMES[index]))
+
+    book_rows, quantities, quality = [], {}, {}
+    for book_id in range(1, books + 1):
+        title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 4)))
+        author = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        quantities[book_id] = rng.choice([1, 1, 2, 2, 3, 5])
+        quality[book_id] = rng.gauss(3.6, 0.6)
+        book_rows.append([book_id, f"The {title}", author, isbn13(book_id), rng.randint(1900, today.year),
+                          rng.choice(GENRES), f"A synthetic book about {title.lower()}.", quantities[book_id],
+                          quantities[book_id], rng.randint(1, len(CATEGORIES)), None])
+
+    # Every synthetic user shares one password, hashed once at the app's cost
+    password = auth.hash_password(PASSWORD, int(os.getenv('BCRYPT_ROUNDS', 12)))
+    library['users'] = [(user_id, f"{USER_PREFIX}{user_id}", f"{USER_PREFIX}{user_id}@example.com", password)
+                        for user_id in range(1, users + 1)]
+
+    # Popularity ranks are shuffled so popular books are spread over the
+    # catalog rather than being the lowest ids
+    book_ids = rng.sample(range(1, books + 1), books)
+    user_ids = rng.sample(range(1, users + 1), users)
+    total_loans = int(users * years * loans_per_user_year)
+    first_day = today - timedelta(days=365 * years)
+    loan_days = sorted(rng.randrange(365 * years) for _ in range(total_loans))
+    borrowed_books = rng.choices(book_ids, cum_weights=cumulative_weights(books, BOOK_SKEW), k=total_loans)
+    borrowers = rng.choices(user_ids, cum_weights=cumulative_weights(users, USER_SKEW), k=total_loans)
+
+    # Copies are numbered book by book, so copy k of a book is item
+    # first_item[book_id] + k - 1
+    first_item, item_rows = {}, []
+    for book_id in range(1, books + 1):
+        first_item[book_id] = len(item_rows) + 1
+        item_rows += [[first_item[book_id] + k - 1, book_id, items.copy_barcode(book_id, k),
+                       (book_id + k) % branches + 1, 'available'] for k in range(1, quantities[book_id] + 1)]
+
+    loans, reviews, open_loans = [], [], {}
+    for loan_day, book_id, user_id in zip(loan_days, borrowed_books, borrowers):
+        loan_date = first_day + timedelta(days=loan_day)
+        return_date = loan_date + timedelta(days=rng.randint(3, 28))
+        if return_date > today or ((today - loan_date).days < LOST_WITHIN_DAYS and rng.random() < LOST_RATE):
+            # Still out, as long as the library has a copy left to lend
+            if open_loans.get(book_id, 0) >= quantities[book_id]:
+                continue
+            open_loans[book_id] = open_loans.get(book_id, 0) + 1
+            return_date = None
+            # Open loans hold the first copies of the book
+            copy_number = open_loans[book_id]
+        else:
+            copy_number = len(loans) % quantities[book_id] + 1
+        loans.append((len(loans) + 1, user_id, book_id, loan_date, loan_date + timedelta(days=DEFAULT_LOAN_DAYS),
+                      return_date, first_item[book_id] + copy_number - 1))
+        if return_date and rng.random() < REVIEW_RATE:
+            rating = min(5, max(1, round(quality[book_id] + rng.gauss(0, 1))))
+            reviews.append((len(reviews) + 1, user_id, book_id, rating, rng.choice(COMMENTS), return_date))
+
+    for row in book_rows:
+        row[8] -= open_loans.get(row[0], 0)
+    for book_id, count in open_loans.items():
+        for item_id in range(first_item[book_id], first_item[book_id] + count):
+            item_rows[item_id - 1][4] = 'loaned'
+    library['books'] = [tuple(row) for row in book_rows]
+    library['items'] = [tuple(row) for row in item_rows]
+    stock = {}
+    for _, book_id, _, branch_id, status in item_rows:
+        counts = stock.setdefault((branch_id, book_id), [0, 0])
+        counts[0] += 1
+        counts[1] += status == 'available'
+    library['branch_stock'] = [(*key, *counts) for key, counts in sorted(stock.items())]
+    library['loans'] = loans
+    library['reviews'] = reviews
+    return library
+
+INSERTS = {
+    'categories': "INSERT INTO categories (category_id, name) VALUES (%s, %s)",
+    'books': """
+        INSERT INTO books (book_id, title, author, isbn, publication_year, genre, description,
+                           quantity, available_quantity, category_id, cover_image)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """,
+    'branches': "INSERT INTO branches (branch_id, name) VALUES (%s, %s)",
+    'items': "INSERT INTO items (item_id, book_id, barcode, branch_id, status) VALUES (%s, %s, %s, %s, %s)",
+    'branch_stock': """
+        INSERT INTO branch_stock (branch_id, book_id, quantity, available_quantity)
+        VALUES (%s, %s, %s, %s)
+    """,
+    'users': "INSERT INTO users (user_id, username, email, password) VALUES (%s, %s, %s, %s)",
+    'loans': """
+        INSERT INTO loans (id, user_id, book_id, loan_date, due_date, return_date, item_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """,
+    'reviews': """
+        INSERT INTO reviews (id, user_id, book_id, rating, comment, review_date)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """,
+}
+
+def bulk_load(library, batch_size=BATCH_SIZE):
+    connection = connect('library_management')
+    cursor = connection.cursor()
+    for table in ('categories', 'books', 'users'):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        if cursor.fetchone()[0]:
+            connection.close()
+            raise Error(msg=f"the {table} table is not empty; load synthetic data into a scratch database")
+    for table, sql in INSERTS.items():
+        start = time.perf_counter()
+        rows = library[table]
+        for batch_start in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[batch_start:batch_start + batch_size])
+        connection.commit()
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {len(rows)} {table} ({len(rows) / max(elapsed, 1e-9):.0f} rows/s)")
+    connection.close()
+
+def build(books, users, years, loans_per_user_year, seed, batch_size=BATCH_SIZE, branches=1):
+    # Creates the schema if needed, loads the library and runs the jobs that
+    # derive the materialized tables from it
+    start = time.perf_counter()
+    library = generate(books, users, years, loans_per_user_year, seed, branches=branches)
+    print(f"Generated {len(library['books'])} books ({len(library['items'])} copies at {branches} branches), "
+          f"{len(library['users'])} users, "
+          f"{len(library['loans'])} loans and {len(library['reviews'])} reviews "
+          f"({time.perf_counter() - start:.1f}s)")
+    create_database()
+    try:
+        bulk_load(library, batch_size)
+    except Error as e:
+        print(f"Error: {e}")
+        return
+    rebuild_book_stats()
+    refresh_overdue()
+    build_recommendations()
+    print(f"Synthetic library ready in {time.perf_counter() - start:.1f}s; "
+          f"users {USER_PREFIX}1..{users} log in with password '{PASSWORD}'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic library and bulk-load it into an empty database")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--years', type=int, default=3, help="years of loan and review history")
+    parser.add_argument('--loans-per-user-year', type=float, default=12)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--branches', type=int, default=1, help="branches to spread the copies over")
+    args = parser.parse_args()
+    build(args.books, args.users, args.years, args.loans_per_user_year, args.seed, args.batch_size, args.branches)
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+import streamlit as st
+
+import init_db
+import storage
+from benchmark import headless_session
+
+# Hundreds of sessions borrowing, and then returning and re-borrowing, the
+# same title at once on the SQLite backend. Loans may never outnumber copies,
+# and every stored count has to agree with the loans table afterwards.
+SESSIONS = 300
+MAIN_COPIES = 3
+EAST_COPIES = 2
+
+@pytest.fixture
+def app(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'BACKEND', 'sqlite')
+    monkeypatch.setattr(storage, 'SQLITE_PATH', str(tmp_path / 'library.db'))
+    # Sessions queue for a connection rather than give up
+    monkeypatch.setenv('DB_POOL_TIMEOUT', '120')
+    init_db.create_database()
+    import app
+    monkeypatch.setattr(app, 'WRITE_BEHIND', False)
+    st.cache_resource.clear()
+    headless_session()
+    yield app
+    st.cache_resource.clear()
+
+@pytest.fixture
+def book(app):
+    with app.get_cursor() as cursor:
+        cursor.execute("INSERT INTO categories (name) VALUES ('Fiction')")
+        cursor.executemany("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
+                           [(f"reader{i}", f"reader{i}@example.com", "x") for i in range(SESSIONS)])
+    app.add_book('Hot Title', 'Someone', '9780743273565', 2001, 'Novel', '', MAIN_COPIES, 1, None)
+    app.add_branch('East')
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT book_id FROM books")
+        book_id = cursor.fetchone()[0]
+        cursor.execute("SELECT user_id FROM users ORDER BY user_id")
+        user_ids = [row[0] for row in cursor.fetchall()]
+    app.add_branch_copies(book_id, EAST_COPIES, 2)
+    return book_id, user_ids
+
+def all_at_once(work, args):
+    # Runs work(arg) for every arg, each in its own session thread, released
+    # together; returns the args for which it returned True
+    barrier = threading.Barrier(len(args))
+    succeeded, lock = [], threading.Lock()
+
+    def run(arg):
+        headless_session()
+        barrier.wait()
+        if work(arg):
+            with lock:
+                succeeded.append(arg)
+
+    threads = [threading.Thread(target=run, args=(arg,)) for arg in args]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return succeeded
+
+def assert_consistent(app, book_id):
+    copies = MAIN_COPIES + EAST_COPIES
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM loans WHERE book_id = %s AND return_date IS NULL", (book_id,))
+        open_loans = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM loans WHERE book_id = %s", (book_id,))
+        all_loans = cursor.fetchone()[0]
+        cursor.execute("SELECT quantity, available_quantity FROM books WHERE book_id = %s", (book_id,))
+        quantity, available = cursor.fetchone()
+        cursor.execute("SELECT active_loans, loan_count FROM book_stats WHERE book_id = %s", (book_id,))
+        active_loans, loan_count = cursor.fetchone()
+        cursor.execute("""
+            SELECT s.branch_id, s.quantity, s.available_quantity,
+                   (SELECT COUNT(*) FROM items i WHERE i.book_id = s.book_id AND i.branch_id = s.branch_id
+                    AND i.status <> 'withdrawn'),
+                   (SELECT COUNT(*) FROM items i WHERE i.book_id = s.book_id AND i.branch_id = s.branch_id
+                    AND i.status = 'available')
+            FROM branch_stock s
+            WHERE s.book_id = %s
+        """, (book_id,))
+        stock = cursor.fetchall()
+        cursor.execute("""
+            SELECT COUNT(*) FROM loans l JOIN items i ON i.item_id = l.item_id
+            WHERE l.book_id = %s AND l.return_date IS NULL AND i.status = 'loaned'
+        """, (book_id,))
+        loaned_items = cursor.fetchone()[0]
+
+    assert open_loans <= copies
+    assert (quantity, available) == (copies, copies - open_loans)
+    assert (active_loans, loan_count) == (open_loans, all_loans)
+    assert loaned_items == open_loans
+    for branch_id, branch_quantity, branch_available, items_there, items_available in stock:
+        assert (branch_quantity, branch_available) == (items_there, items_available), branch_id
+    assert sum(row[1] for row in stock) == quantity
+    assert sum(row[2] for row in stock) == available
+    return open_loans
+
+def test_concurrent_borrows_never_oversell(app, book):
+    book_id, user_ids = book
+    borrowers = all_at_once(lambda user_id: app.borrow_book(user_id, book_id), user_ids)
+    assert len(borrowers) == MAIN_COPIES + EAST_COPIES
+    assert assert_consistent(app, book_id) == len(borrowers)
+
+    # The borrowers return while everyone else tries again
+    def return_or_borrow(user_id):
+        if user_id in borrowers:
+            return app.return_book(user_id, book_id)
+        return app.borrow_book(user_id, book_id)
+
+    succeeded = all_at_once(return_or_borrow, user_ids)
+    assert set(borrowers) <= set(succeeded)
+    reborrowed = len(succeeded) - len(borrowers)
+    assert reborrowed <= MAIN_COPIES + EAST_COPIES
+    assert assert_consistent(app, book_id) == reborrowed
@@ -0,0 +1,123 @@
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import covers
+
+def make_image(color, size=(400, 600)):
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, format='PNG')
+    return output.getvalue()
+
+# Path served -> image bytes; anything else is a 404
+IMAGES = {
+    '/red.png': make_image((200, 30, 30)),
+    '/red-copy.png': make_image((200, 30, 30)),
+    '/blue.png': make_image((30, 30, 200)),
+    '/green.png': make_image((30, 200, 30)),
+}
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        image = IMAGES.get(self.path)
+        if image is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(image)))
+        self.end_headers()
+        self.wfile.write(image)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def url(server):
+    server.requests.clear()
+    return lambda path: f"http://127.0.0.1:{server.server_port}{path}"
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = covers.CoverCache(str(tmp_path), max_bytes=1024 * 1024, wait_timeout=5)
+    yield cache
+    cache.executor.shutdown()
+
+def blob_bytes(cache):
+    return sum(entry.stat().st_size for entry in os.scandir(cache.blob_dir))
+
+def test_miss_fetches_a_thumbnail_then_hits_disk(cache, server, url):
+    thumbnail = cache.get(url('/red.png'))
+    with Image.open(io.BytesIO(thumbnail)) as image:
+        assert image.format == 'JPEG'
+        assert image.size[0] <= covers.THUMBNAIL_SIZE[0] and image.size[1] <= covers.THUMBNAIL_SIZE[1]
+
+    assert cache.get(url('/red.png')) == thumbnail
+    assert server.requests == ['/red.png']
+    stats = cache.get_stats()
+    assert (stats['misses'], stats['hits'], stats['fetched']) == (1, 1, 1)
+    assert stats['size_bytes'] == blob_bytes(cache)
+
+def test_same_image_is_stored_and_counted_once(cache, url, monkeypatch):
+    red = cache.get(url('/red.png'))
+    assert cache.get(url('/red-copy.png')) == red
+
+    # Fetches racing to store the same image: each one finds no blob before
+    # taking the lock, as if the others had not renamed theirs into place yet
+    exists = os.path.exists
+
+    def racing_exists(path):
+        if path.startswith(cache.blob_dir) and not cache.lock.locked():
+            return False
+        return exists(path)
+
+    monkeypatch.setattr(os.path, 'exists', racing_exists)
+    thumbnail = covers.make_thumbnail(IMAGES['/blue.png'])
+    for i in range(3):
+        cache.store(url(f'/blue-{i}.png'), thumbnail)
+    monkeypatch.undo()
+
+    # One blob each, no temporary files left behind
+    assert len(os.listdir(cache.blob_dir)) == 2
+    assert cache.get_stats()['size_bytes'] == blob_bytes(cache) == len(red) + len(thumbnail)
+
+def test_failed_fetch_serves_placeholder_without_retrying(cache, server, url, caplog):
+    assert cache.get(url('/missing.png')) == cache.placeholder
+    assert cache.get(url('/missing.png')) == cache.placeholder
+    assert server.requests == ['/missing.png']
+    assert [(record.name, record.levelname) for record in caplog.records] == [('covers', 'WARNING')]
+    stats = cache.get_stats()
+    assert (stats['failures'], stats['placeholders']) == (1, 2)
+
+def test_oversized_download_is_rejected(cache, url, monkeypatch):
+    monkeypatch.setattr(covers, 'MAX_DOWNLOAD_BYTES', 1024)
+    assert cache.get(url('/red.png')) == cache.placeholder
+    assert cache.get_stats()['failures'] == 1
+    assert blob_bytes(cache) == 0
+
+def test_eviction_drops_least_recently_used_blobs(cache, url):
+    cached = len(cache.get(url('/red.png'))) + len(cache.get(url('/blue.png')))
+    # Blue is the least recently used, and green only just does not fit
+    os.utime(cache.lookup(url('/blue.png')), (0, 0))
+    cache.max_bytes = cached + len(covers.make_thumbnail(IMAGES['/green.png'])) - 1
+    cache.get(url('/green.png'))
+
+    assert cache.lookup(url('/blue.png')) is None
+    assert cache.lookup(url('/red.png')) is not None
+    assert cache.get_stats()['evicted'] == 1
+    assert cache.get_stats()['size_bytes'] == blob_bytes(cache) <= cache.max_bytes
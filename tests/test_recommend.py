@@ -0,0 +1,35 @@
+import math
+
+import pytest
+
+import recommend
+
+def test_similarities_are_cosine_over_shared_readers():
+    baskets = {
+        1: {10: 1, 11: 2, 12: 3},
+        2: {10: 1, 11: 2},
+        3: {10: 1},
+        4: {13: 1},
+    }
+    similarities = recommend.build_similarities(baskets)
+    # Book 13 shares no reader with anything
+    assert set(similarities) == {10, 11, 12}
+    assert similarities[10] == [(11, pytest.approx(2 / math.sqrt(3 * 2))), (12, pytest.approx(1 / math.sqrt(3)))]
+    assert similarities[12] == [(11, pytest.approx(1 / math.sqrt(2))), (10, pytest.approx(1 / math.sqrt(3)))]
+    assert all(type(other_id) is int and type(score) is float
+               for neighbours in similarities.values() for other_id, score in neighbours)
+
+def test_similarities_keep_the_best_neighbours_in_any_chunking(monkeypatch):
+    monkeypatch.setattr(recommend, 'NEIGHBORS_PER_BOOK', 3)
+    # Book 0 is read with every other book, book b by b readers
+    baskets = {(b, reader): {0: 0, b: 1} for b in range(1, 8) for reader in range(b)}
+    baskets['everything'] = dict.fromkeys(range(8), 0)
+    expected = recommend.build_similarities(baskets)
+    assert [other_id for other_id, _ in expected[0]] == [7, 6, 5]
+
+    monkeypatch.setattr(recommend, 'PAIR_CHUNK', 2)
+    assert recommend.build_similarities(baskets) == expected
+
+def test_similarities_of_no_pairs_are_empty():
+    assert recommend.build_similarities({}) == {}
+    assert recommend.build_similarities({1: {10: 1}}) == {}
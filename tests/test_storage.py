@@ -0,0 +1,183 @@
+import sqlite3
+
+import pytest
+from mysql.connector import Error, errors
+
+import init_db
+import storage
+from items import DEFAULT_BRANCH
+
+# Every backend-specific statement in storage.py is run against each backend
+# that is available: SQLite always, MySQL when DB_HOST/DB_USER/DB_PASSWORD
+# reach a server, in a scratch database that is dropped afterwards.
+TEST_DATABASE = 'library_management_test'
+
+@pytest.fixture(scope='module', params=['sqlite', 'mysql'])
+def backend(request, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(storage, 'BACKEND', request.param)
+        if request.param == 'sqlite':
+            patch.setattr(storage, 'SQLITE_PATH', str(tmp_path_factory.mktemp('sqlite') / 'library.db'))
+        else:
+            try:
+                storage.connect().close()
+            except Error as e:
+                pytest.skip(f"MySQL is not available: {e}")
+        init_db.create_database(TEST_DATABASE)
+        yield request.param
+        if request.param == 'mysql':
+            connection = storage.connect()
+            connection.cursor().execute(f"DROP DATABASE IF EXISTS {TEST_DATABASE}")
+            connection.close()
+
+@pytest.fixture
+def connection(backend):
+    connection = storage.connect(TEST_DATABASE)
+    yield connection
+    connection.rollback()
+    connection.close()
+
+def add_book(cursor, title, isbn, quantity=3, author='Test Author'):
+    cursor.execute(storage.query('upsert_book'),
+                   (title, author, isbn, 2001, 'Novel', '', quantity, quantity, None, None))
+    cursor.execute("SELECT book_id FROM books WHERE isbn = %s", (isbn,))
+    return cursor.fetchone()[0]
+
+def book_counts(cursor, book_id):
+    cursor.execute("SELECT quantity, available_quantity FROM books WHERE book_id = %s", (book_id,))
+    return tuple(cursor.fetchone())
+
+def test_upsert_book_inserts_then_updates_in_place(connection):
+    cursor = connection.cursor()
+    book_id = add_book(cursor, 'Upsert', '9780000000011')
+    assert book_counts(cursor, book_id) == (3, 3)
+
+    # Two copies out on loan: available copies follow the change in quantity
+    cursor.execute("UPDATE books SET available_quantity = 1 WHERE book_id = %s", (book_id,))
+    assert add_book(cursor, 'Upsert, revised', '9780000000011', quantity=5) == book_id
+    assert book_counts(cursor, book_id) == (5, 3)
+    cursor.execute("SELECT title FROM books WHERE book_id = %s", (book_id,))
+    assert cursor.fetchone()[0] == 'Upsert, revised'
+
+    # Shrinking below the copies on loan never leaves a negative count
+    add_book(cursor, 'Upsert, revised', '9780000000011', quantity=1)
+    assert book_counts(cursor, book_id) == (1, 0)
+
+def test_lock_book_returns_available_copies(connection):
+    book_id = add_book(connection.cursor(), 'Lock', '9780000000028', quantity=2)
+    connection.commit()
+
+    connection.start_transaction()
+    cursor = connection.cursor()
+    cursor.execute(storage.query('lock_book'), (book_id,))
+    assert cursor.fetchone()[0] == 2
+    cursor.execute(storage.query('lock_book'), (-1,))
+    assert cursor.fetchone() is None
+
+def test_claim_event_is_idempotent(connection):
+    cursor = connection.cursor()
+    cursor.execute(storage.query('claim_event'), ('a' * 32, '2026-01-01 10:00:00'))
+    assert cursor.rowcount == 1
+    cursor.execute(storage.query('claim_event'), ('a' * 32, '2026-01-02 10:00:00'))
+    assert cursor.rowcount == 0
+    cursor.execute("SELECT COUNT(*) FROM applied_events WHERE event_id = %s", ('a' * 32,))
+    assert cursor.fetchone()[0] == 1
+
+def test_adjust_branch_stock_inserts_then_adds(connection):
+    cursor = connection.cursor()
+    book_id = add_book(cursor, 'Stock', '9780000000035')
+    cursor.execute("DELETE FROM branch_stock WHERE book_id = %s", (book_id,))
+
+    cursor.execute(storage.query('adjust_branch_stock'), (DEFAULT_BRANCH, book_id, 2, 2))
+    cursor.execute(storage.query('adjust_branch_stock'), (DEFAULT_BRANCH, book_id, 1, -1))
+    cursor.execute("SELECT quantity, available_quantity FROM branch_stock WHERE branch_id = %s AND book_id = %s",
+                   (DEFAULT_BRANCH, book_id))
+    assert tuple(cursor.fetchone()) == (3, 1)
+
+@pytest.fixture
+def search_books(connection):
+    # Committed, because MySQL full-text indexes only see committed rows
+    cursor = connection.cursor()
+    books = {
+        'best': add_book(cursor, 'Zephyrine Zephyrine', '9780000000042', author='Quillon Marsh'),
+        'title': add_book(cursor, 'Zephyrine Winds', '9780000000059', author='Ada Stone'),
+        'author': add_book(cursor, 'Northern Lights', '9780000000066', author='Zephyrine Quillon'),
+    }
+    # Only two of them are stocked at the main branch
+    for key, book_id in books.items():
+        cursor.execute("DELETE FROM branch_stock WHERE book_id = %s", (book_id,))
+        if key != 'title':
+            cursor.execute(storage.query('adjust_branch_stock'), (DEFAULT_BRANCH, book_id, 3, 3))
+    connection.commit()
+    return books
+
+def search(connection, terms, after=None, limit_clause="", join="", join_params=()):
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(*storage.fulltext_search("b.book_id, b.title", terms, after, limit_clause, join, join_params))
+    return cursor.fetchall()
+
+def test_fulltext_search_matches_prefixes_of_title_and_author(connection, search_books):
+    rows = search(connection, ['zephyr'])
+    assert {row['book_id'] for row in rows} == set(search_books.values())
+    assert rows[0]['book_id'] == search_books['best']
+    assert [row['score'] for row in rows] == sorted((row['score'] for row in rows), reverse=True)
+
+    # Every term has to match
+    assert [row['book_id'] for row in search(connection, ['zephyr', 'quill'])] == \
+        [search_books['best'], search_books['author']]
+
+def test_fulltext_search_pages_by_keyset(connection, search_books):
+    everything = search(connection, ['zephyr'])
+    after = None
+    paged = []
+    while True:
+        page = search(connection, ['zephyr'], after, "LIMIT 1")
+        if not page:
+            break
+        paged += page
+        after = page[-1]
+    assert [row['book_id'] for row in paged] == [row['book_id'] for row in everything]
+
+def test_fulltext_search_join_params_come_first(connection, search_books):
+    join = "JOIN branch_stock s ON s.branch_id = %s AND s.book_id = b.book_id"
+    rows = search(connection, ['zephyr'], join=join, join_params=[DEFAULT_BRANCH])
+    assert {row['book_id'] for row in rows} == {search_books['best'], search_books['author']}
+
+def test_duplicate_key_raises_integrity_error(connection):
+    cursor = connection.cursor()
+    add_book(cursor, 'Duplicate', '9780000000073')
+    with pytest.raises(errors.IntegrityError) as raised:
+        cursor.execute("INSERT INTO books (title, author, isbn, quantity, available_quantity) "
+                       "VALUES (%s, %s, %s, %s, %s)", ('Again', 'Someone', '9780000000073', 1, 1))
+    assert raised.value.errno == 1062
+
+def test_missing_parent_row_raises_integrity_error(connection):
+    with pytest.raises(errors.IntegrityError) as raised:
+        connection.cursor().execute("INSERT INTO reviews (user_id, book_id, rating, review_date) "
+                                    "VALUES (%s, %s, %s, %s)", (-1, -1, 5, '2026-01-01'))
+    assert raised.value.errno == 1452
+
+@pytest.mark.parametrize('error, expected_type, errno', [
+    (sqlite3.IntegrityError('UNIQUE constraint failed: books.isbn'), errors.IntegrityError, 1062),
+    (sqlite3.IntegrityError('FOREIGN KEY constraint failed'), errors.IntegrityError, 1452),
+    (sqlite3.OperationalError('database is locked'), errors.DatabaseError, 1205),
+    (sqlite3.OperationalError('no such table: shelves'), errors.DatabaseError, -1),
+])
+def test_translate_error(error, expected_type, errno):
+    translated = storage.translate_error(error)
+    assert type(translated) is expected_type
+    assert translated.errno == errno
+    assert str(error) in str(translated)
+
+def test_busy_sqlite_database_reads_as_lock_wait_timeout(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'BACKEND', 'sqlite')
+    monkeypatch.setattr(storage, 'SQLITE_PATH', str(tmp_path / 'busy.db'))
+    writer, waiter = storage.connect(), storage.connect()
+    waiter._cnx.execute("PRAGMA busy_timeout = 0")
+    writer.start_transaction()
+    with pytest.raises(errors.DatabaseError) as raised:
+        waiter.start_transaction()
+    assert raised.value.errno == 1205
+    writer.rollback()
+    writer.close()
+    waiter.close()